@@ -3,11 +3,12 @@ from django.contrib import admin
 # Register your models here.
 from django.contrib import admin, messages
 from django import forms
-from django.urls import path
-from django.shortcuts import redirect
-from django.utils.html import format_html
-from .models import Tile, Profile, QueuedAction, ProgressAction, StatusAction, UniversalGoods, GameDate
-from .views import resolve_actions
+from django.urls import path, reverse
+from django.shortcuts import redirect, get_object_or_404
+from django.http import JsonResponse
+from django.utils.html import format_html, format_html_join
+from .models import Tile, Profile, QueuedAction, ProgressAction, Shipment, StatusAction, TileInventory, PlayerStats, UniversalGoods, GameDate, TurnJob, TurnReport
+from .jobs import enqueue_turn, read_progress
 
 class TileAdminForm(forms.ModelForm):
     """Custom form for Tile admin."""
@@ -20,6 +21,7 @@ class TileAdminForm(forms.ModelForm):
         # Load universal goods and create fields dynamically
         universal_goods = UniversalGoods.objects.all()
         goods_dict = self.instance.goods if self.instance else {}
+        self.initial.setdefault('goods', goods_dict)
         self.goods_fields = []
 
         for good in universal_goods:
@@ -47,30 +49,18 @@ class TileAdminForm(forms.ModelForm):
         if goods_data is None:
             goods_data = {}
 
-        # If this is a new tile, initialize its goods with all universal goods set to 0
-        if instance.pk is None:  # This check ensures we're dealing with a new instance
-            # Initialize the goods with universal goods set to 0
-            universal_goods = UniversalGoods.objects.all()
-            for good in universal_goods:
-                goods_data[good.name] = 0
-
-        instance.goods = goods_data  # Store the goods data in the instance
-
         if commit:
             instance.save()
+            # Goods live in TileInventory, which needs the tile saved first
+            instance.set_goods(goods_data)
+        else:
+            # Saved by save_m2m() along with the tile's other related rows
+            save_m2m = self.save_m2m
 
-        # Check if there are any goods that are not part of the UniversalGoods
-        for good_name in goods_data.keys():
-            if not UniversalGoods.objects.filter(name=good_name).exists():
-                UniversalGoods.objects.create(name=good_name)
-
-        # Find goods that have been removed from this tile
-        existing_good_names = set(instance.goods.keys())
-        all_universal_goods = set(UniversalGoods.objects.values_list('name', flat=True))
-        removed_goods = all_universal_goods - existing_good_names
-        # Remove from UniversalGoods
-        UniversalGoods.objects.filter(name__in=removed_goods).delete()
-
+            def save_related():
+                save_m2m()
+                instance.set_goods(goods_data)
+            self.save_m2m = save_related
 
         return instance
 
@@ -101,11 +91,13 @@ class QueuedActionAdmin(admin.ModelAdmin):
     list_filter = ('action_type',)
     search_fields = ('user__username',)
 
-    # Custom button to resolve actions
+    # Custom button to resolve actions: queue the turn for the worker and follow its progress
     def resolve_actions_view(self, request):
-        resolve_actions(request)  # Call the resolve function
-        self.message_user(request, "All actions resolved successfully!", level=messages.SUCCESS)
-        return redirect(request.META.get('HTTP_REFERER', 'admin:app_queuedaction_changelist'))
+        if request.method != 'POST':
+            return redirect('admin:game_queuedaction_changelist')
+        job = enqueue_turn(user=request.user, end_turn=bool(request.POST.get('end_turn', False)))
+        self.message_user(request, "Turn queued, it will be resolved by the turn worker.", level=messages.SUCCESS)
+        return redirect(reverse('admin:game_turnjob_change', args=[job.id]))
 
     # Add custom URL for resolve action
     def get_urls(self):
@@ -147,6 +139,49 @@ class ProgressActionAdmin(admin.ModelAdmin):
 admin.site.register(ProgressAction, ProgressActionAdmin)
 
 
+class ShipmentAdmin(admin.ModelAdmin):
+    list_display = ('good', 'quantity', 'tile', 'step', 'owner')
+    list_filter = ('good',)
+    search_fields = ('owner__username',)
+    raw_id_fields = ('action', 'tile')
+
+
+admin.site.register(Shipment, ShipmentAdmin)
+
+
+class TileInventoryAdmin(admin.ModelAdmin):
+    list_display = ('good', 'quantity', 'tile')
+    list_filter = ('good',)
+    search_fields = ('tile__owner__username',)
+    raw_id_fields = ('tile',)
+    list_select_related = ('good', 'tile')
+
+
+admin.site.register(TileInventory, TileInventoryAdmin)
+
+
+class PlayerStatsAdmin(admin.ModelAdmin):
+    """Read-only, the stats follow the tiles; rebuild them if they ever drift."""
+    list_display = ('user', 'tiles', 'population', 'goods')
+    search_fields = ('user__username',)
+    readonly_fields = ('user', 'tiles', 'population', 'goods')
+    actions = ['rebuild_stats']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.action(description="Rebuild stats of selected players")
+    def rebuild_stats(self, request, queryset):
+        count = PlayerStats.rebuild(list(queryset.values_list('user_id', flat=True)))
+        self.message_user(request, f"Rebuilt stats for {count} players.", messages.SUCCESS)
+
+
+admin.site.register(PlayerStats, PlayerStatsAdmin)
+
+
 class GoodsForm(forms.Form):
     """Form for managing goods in tiles."""
     good_name = forms.CharField(max_length=100, required=True)
@@ -166,3 +201,95 @@ class GameDateAdmin(admin.ModelAdmin):
 
 
 admin.site.register(GameDate, GameDateAdmin)
+
+
+class TurnJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'phase', 'processed', 'total', 'elapsed_display', 'created', 'requested_by')
+    list_filter = ('status',)
+    readonly_fields = (
+        'status', 'phase', 'processed', 'total', 'end_turn', 'summary', 'error',
+        'requested_by', 'created', 'started', 'finished', 'elapsed_display',
+    )
+    change_form_template = "admin/game/turnjob/change_form.html"
+
+    @admin.display(description='Elapsed')
+    def elapsed_display(self, obj):
+        return f"{obj.elapsed:.1f}s"
+
+    def has_add_permission(self, request):
+        return False  # Jobs are queued with the End Turn button
+
+    # JSON status polled by the change page while the job runs
+    def status_view(self, request, job_id):
+        job = get_object_or_404(TurnJob, pk=job_id)
+        if job.status == 'running':
+            # The worker can't write to the database mid-turn, it reports to a file
+            progress = read_progress(job.id)
+            if progress:
+                job.phase, job.processed, job.total = progress['phase'], progress['processed'], progress['total']
+        return JsonResponse({
+            'status': job.status,
+            'phase': job.phase,
+            'processed': job.processed,
+            'total': job.total,
+            'elapsed': round(job.elapsed, 1),
+            'summary': job.summary,
+            'error': job.error,
+        })
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('<int:job_id>/status/', self.admin_site.admin_view(self.status_view), name='game_turnjob_status'),
+        ]
+        return custom_urls + urls
+
+
+admin.site.register(TurnJob, TurnJobAdmin)
+
+
+class TurnReportAdmin(admin.ModelAdmin):
+    list_display = ('game_date', 'created', 'seconds_display', 'queries', 'query_seconds_display', 'slowest_phase', 'workers')
+    date_hierarchy = 'created'
+    readonly_fields = (
+        'game_date', 'created', 'seconds', 'queries', 'query_seconds', 'phase_table',
+        'actions', 'rows_written', 'summary', 'workers',
+    )
+    exclude = ('phases',)
+
+    @admin.display(description='Time', ordering='seconds')
+    def seconds_display(self, obj):
+        return f"{obj.seconds:.2f}s"
+
+    @admin.display(description='Query time', ordering='query_seconds')
+    def query_seconds_display(self, obj):
+        return f"{obj.query_seconds:.2f}s"
+
+    @admin.display(description='Slowest phase')
+    def slowest_phase(self, obj):
+        if not obj.phases:
+            return '-'
+        name, phase = max(obj.phases.items(), key=lambda item: item[1]['seconds'])
+        return f"{name} ({phase['seconds']:.2f}s)"
+
+    @admin.display(description='Phases')
+    def phase_table(self, obj):
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}s</td><td>{}</td><td>{}s</td></tr>',
+            (
+                (name, f"{phase['seconds']:.3f}", phase['queries'], f"{phase['query_seconds']:.3f}")
+                for name, phase in obj.phases.items()
+            ),
+        )
+        return format_html(
+            '<table><tr><th>Phase</th><th>Time</th><th>Queries</th><th>Query time</th></tr>{}</table>', rows,
+        )
+
+    def has_add_permission(self, request):
+        return False  # Written by resolve_turn
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(TurnReport, TurnReportAdmin)
@@ -0,0 +1,252 @@
+"""
+Game state export and import.
+
+A world file is gzip-compressed JSON Lines. The first line is a header, then each section
+starts with {"section": name, "fields": [...]} followed by one JSON array per row in
+that field order, and a last {"end": true, "rows": {section: count}} line marks a
+complete file:
+
+    {"format": "wargame-world", "version": 1, "created": "..."}
+    {"section": "tile", "fields": ["id", "x", "y", ...]}
+    [1, 0, 0, ...]
+    ...
+    {"end": true, "rows": {"tile": 1000000, ...}}
+
+Both directions stream: export iterates the tables in chunks and import inserts the rows
+in batches as it reads them. Players are matched by username, existing accounts are kept
+as they are. Tile and action ids are kept because action details refer to tiles by id.
+Player stats, map versions, cached map images and the ownership index are derived and
+rebuilt after import.
+"""
+from datetime import datetime, timezone
+import gzip
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, reset_queries, transaction
+
+from . import maptiles, ownership
+from .models import (
+    GameDate, MapVersion, PlayerStats, Profile, ProgressAction, QueuedAction, Shipment, StatusAction, Tile,
+    TileInventory, UniversalGoods,
+)
+from .pathfinding import terrain_grid
+
+FORMAT = 'wargame-world'
+VERSION = 1
+
+# Rows per SELECT chunk and per INSERT
+BATCH_SIZE = 2000
+
+# (section, model, fields) in the order they are written and restored
+SECTIONS = [
+    ('user', User, ['id', 'username', 'password', 'email', 'first_name', 'last_name',
+                    'is_active', 'is_staff', 'is_superuser', 'date_joined']),
+    ('profile', Profile, ['user_id', 'money', 'display_name', 'color']),
+    ('good', UniversalGoods, ['id', 'name']),
+    ('tile', Tile, ['id', 'x', 'y', 'owner_id', 'population', 'buildings', 'resources', 'image', 'terrain']),
+    ('inventory', TileInventory, ['tile_id', 'good_id', 'quantity']),
+    ('queued_action', QueuedAction, ['id', 'user_id', 'action_type', 'details', 'timestamp']),
+    ('progress_action', ProgressAction, ['id', 'user_id', 'action_type', 'details', 'turn']),
+    ('shipment', Shipment, ['action_id', 'owner_id', 'good', 'quantity', 'tile_id', 'step']),
+    ('status_action', StatusAction, ['user_id', 'action_type', 'details', 'completion_date']),
+    ('game_date', GameDate, ['current_date']),
+]
+
+# Fields holding a user id, remapped on import
+USER_FIELDS = {'user_id', 'owner_id'}
+
+# Field types whose JSON values need converting for the database, the rest are inserted as read
+PREPARED_FIELDS = {'JSONField', 'DateField', 'DateTimeField', 'BooleanField'}
+
+
+def export_world(path, progress=None):
+    """
+    Write the game state to a world file; returns rows written per section.
+
+    The tables are read in one transaction. That is a single snapshot on SQLite, which
+    holds its read lock until the end, and on PostgreSQL, where the transaction runs as
+    REPEATABLE READ (unless export_world is called inside an outer transaction). Other
+    databases give their default isolation, stop turn resolution while exporting there.
+    """
+    encoder = _Encoder(separators=(',', ':'))
+    counts = {}
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write(encoder.encode({
+            'format': FORMAT, 'version': VERSION, 'created': datetime.now(timezone.utc),
+        }) + '\n')
+        outermost = not connection.in_atomic_block
+        with transaction.atomic():
+            if outermost and connection.vendor == 'postgresql':
+                # Read committed would let a turn committing mid-export show in later sections
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            for section, model, fields in SECTIONS:
+                file.write(encoder.encode({'section': section, 'fields': fields}) + '\n')
+                count = 0
+                rows = model.objects.order_by('pk').values_list(*fields).iterator(chunk_size=BATCH_SIZE)
+                for row in rows:
+                    file.write(encoder.encode(row) + '\n')
+                    count += 1
+                counts[section] = count
+                if progress:
+                    progress(section, count)
+        file.write(encoder.encode({'end': True, 'rows': counts}) + '\n')
+    return counts
+
+
+class _Encoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder rounds times to milliseconds, keep them exact."""
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def import_world(path, replace=False, progress=None):
+    """
+    Restore the game state from a world file; returns rows read per section.
+
+    The map must be empty unless replace is set, which deletes the current tiles, goods,
+    actions and date first. Everything happens in one transaction.
+    """
+    counts = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as file, transaction.atomic():
+        header = json.loads(next(file, 'null'))
+        if not header or header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise ValueError("Not a world file of a supported version")
+        if Tile.objects.exists() or QueuedAction.objects.exists() or ProgressAction.objects.exists():
+            if not replace:
+                raise ValueError("The game already has a map or actions, import with replace")
+        _clear()
+
+        loader = None
+        finished = False
+        for line in file:
+            record = json.loads(line)
+            if isinstance(record, list):
+                loader.add(record)
+                continue
+            if loader:
+                counts[loader.section] = loader.finish()
+                if progress:
+                    progress(loader.section, counts[loader.section])
+                loader = None
+            if record.get('end'):
+                finished = True
+                break
+            loader = _Loader(record['section'], record['fields'])
+        if not finished:
+            raise ValueError("The world file is incomplete")
+
+        _reset_sequences()
+        PlayerStats.rebuild()
+        MapVersion.record_all(reason='import')
+        transaction.on_commit(terrain_grid.invalidate)
+        transaction.on_commit(maptiles.invalidate_all)
+        transaction.on_commit(ownership.invalidate_all)
+    return counts
+
+
+class _Loader:
+    """Inserts the rows of one section in batches."""
+
+    # User ids of the file mapped to ids in this database, shared by every section
+    users = {}
+
+    def __init__(self, section, fields):
+        sections = {name: (model, known) for name, model, known in SECTIONS}
+        if section not in sections:
+            raise ValueError(f"Unknown section {section!r}")
+        self.section = section
+        self.model, known = sections[section]
+        unknown = set(fields) - set(known)
+        if unknown:
+            raise ValueError(f"Unknown {section} fields: {', '.join(sorted(unknown))}")
+        self.fields = fields
+        self.batch = []
+        self.count = 0
+        if section == 'user':
+            _Loader.users = {}
+
+    def add(self, row):
+        values = dict(zip(self.fields, row))
+        for field in USER_FIELDS & values.keys():
+            if values[field] is not None:
+                values[field] = _Loader.users[values[field]]
+        self.batch.append(values)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        getattr(self, f'_save_{self.section}', self._save)(self.batch)
+        self.count += len(self.batch)
+        self.batch = []
+        reset_queries()  # With DEBUG on every INSERT would be kept in memory
+
+    def finish(self):
+        self.flush()
+        return self.count
+
+    def _save(self, rows):
+        # A plain INSERT, bulk_create spends most of its time preparing values that need no preparing
+        fields = [self.model._meta.get_field(name) for name in self.fields]
+        prepare = [
+            field.get_db_prep_save if field.get_internal_type() in PREPARED_FIELDS else None
+            for field in fields
+        ]
+        quote = connection.ops.quote_name
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            quote(self.model._meta.db_table),
+            ', '.join(quote(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+        params = [
+            [value if convert is None or value is None else convert(value, connection)
+             for convert, value in zip(prepare, (values[name] for name in self.fields))]
+            for values in rows
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    def _save_user(self, rows):
+        # Existing accounts stay as they are, new ones get the next free ids
+        existing = dict(User.objects.filter(username__in=[r['username'] for r in rows]).values_list('username', 'id'))
+        new = [values for values in rows if values['username'] not in existing]
+        User.objects.bulk_create([User(**{k: v for k, v in values.items() if k != 'id'}) for values in new])
+        ids = dict(User.objects.filter(username__in=[r['username'] for r in rows]).values_list('username', 'id'))
+        for values in rows:
+            _Loader.users[values['id']] = ids[values['username']]
+
+    def _save_profile(self, rows):
+        # Profiles of existing accounts are overwritten with the saved ones
+        Profile.objects.filter(user_id__in=[values['user_id'] for values in rows]).delete()
+        self._save(rows)
+
+    def _save_progress_action(self, rows):
+        # Files written before the turn column was used keep the turn in the details
+        for values in rows:
+            if 'turn' in values['details']:
+                values['turn'] = values['details'].pop('turn')
+        self._save(rows)
+
+
+def _clear():
+    """Delete the game state in a few statements, without per-tile signals."""
+    for model in (QueuedAction, ProgressAction, StatusAction, TileInventory, GameDate):
+        model.objects.all().delete()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {connection.ops.quote_name(Tile._meta.db_table)}')
+    UniversalGoods.objects.all().delete()
+
+
+def _reset_sequences():
+    """Rows were inserted with their ids, move the id sequences past them (PostgreSQL, Oracle)."""
+    statements = connection.ops.sequence_reset_sql(no_style(), [User, UniversalGoods, Tile, QueuedAction, ProgressAction])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
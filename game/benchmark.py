@@ -0,0 +1,306 @@
+"""
+Synthetic load for measuring the game endpoints and the turn engine.
+
+build_world() seeds a database with players, a procedural map, owned tiles holding goods,
+queued actions and goods in transit, all from one seed. run() drives the real views through
+Django's test client, each scenario a number of times, and measures latency percentiles,
+throughput and queries per request. compare() checks the results against a saved baseline.
+
+It writes to whatever database is configured, use the benchmark management command, which
+runs it in a throwaway test database.
+"""
+import json
+import math
+import random
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+
+from . import ownership
+from .instrumentation import QueryRecorder
+from .jobs import claim_next_job, run_job
+from .mapgen import terrain_rows
+from .models import (
+    GameDate, PlayerStats, Profile, ProgressAction, QueuedAction, Shipment, Tile, TileInventory, UniversalGoods,
+)
+from .pathfinding import plan_path, terrain_grid
+
+GOODS = ['iron', 'wood', 'grain']
+
+# Rows per INSERT while seeding
+BATCH_SIZE = 5000
+
+
+class World:
+    """A seeded game: players, the tiles each owns and helpers adding actions."""
+
+    def __init__(self, users, tiles, queued, in_flight, seed):
+        self.params = {'users': users, 'tiles': tiles, 'queued': queued, 'in_flight': in_flight, 'seed': seed}
+        self.rng = random.Random(seed)
+        self.players = []
+        self.staff = None
+        self.owned = {}  # user id -> [(tile_id, x, y)]
+        self.width = self.height = 0
+
+    def move(self, user, steps=1):
+        """
+        Details of a move_goods action between two tiles of user with at least `steps` tiles
+        on its path (the start is not on it), or None if there is no such route.
+        """
+        for attempt in range(20):
+            (from_id, *start), (to_id, *goal) = self.rng.sample(self.owned[user.id], 2)
+            path, time = plan_path(tuple(start), tuple(goal))
+            if len(path) >= steps:
+                return {
+                    'good': self.rng.choice(GOODS),
+                    'quantity': self.rng.randint(1, 5),
+                    'cost': 1,
+                    'from': {'tileId': str(from_id)},
+                    'to': {'tileId': str(to_id)},
+                    'path': path,
+                    'time': time,
+                }
+        return None
+
+    def refill(self):
+        """Top queued actions and goods in transit back up to the world's numbers."""
+        queued = []
+        for i in range(self.params['queued'] - QueuedAction.objects.count()):
+            user = self.rng.choice(self.players)
+            details = self.move(user)
+            if details:
+                queued.append(QueuedAction(user=user, action_type='move_goods', details=details))
+        QueuedAction.objects.bulk_create(queued, batch_size=BATCH_SIZE)
+
+        actions = []
+        for i in range(self.params['in_flight'] - ProgressAction.objects.count()):
+            user = self.rng.choice(self.players)
+            details = self.move(user, steps=2)
+            if details:
+                actions.append(ProgressAction(
+                    user=user, action_type='move_goods', details=details,
+                    turn=self.rng.randint(1, len(details['path']) - 1),
+                ))
+        ProgressAction.objects.bulk_create(actions, batch_size=BATCH_SIZE)
+        Shipment.objects.bulk_create([
+            Shipment(
+                action=action, owner=action.user, good=action.details['good'],
+                quantity=action.details['quantity'], step=action.turn - 1,
+                tile_id=action.details['path'][action.turn - 1]['tileId'],
+            )
+            for action in actions
+        ], batch_size=BATCH_SIZE)
+
+
+def build_world(users=20, tiles=10000, queued=200, in_flight=200, seed=0):
+    """
+    Seed the database with a World and return it.
+
+    The map is a square-ish block of procedural terrain with `tiles` tiles. Each player owns
+    a patch of land holding goods; about a quarter of the land is owned in all.
+    """
+    world = World(users, tiles, queued, in_flight, seed)
+    rng = world.rng
+
+    world.players = User.objects.bulk_create([User(username=f'bench{i}') for i in range(users)])
+    world.staff = User.objects.create(username='bench-admin', is_staff=True)
+    Profile.objects.bulk_create([Profile(user=user, money=1000000) for user in world.players])
+
+    world.width = math.ceil(math.sqrt(tiles))
+    world.height = math.ceil(tiles / world.width)
+    batch = []
+    for y, row in terrain_rows(0, 0, world.width, world.height, seed):
+        batch.extend(Tile(x=x, y=y, terrain=terrain, population=population) for x, terrain, population in row)
+    Tile.objects.bulk_create(batch[:tiles], batch_size=BATCH_SIZE)
+
+    land = {
+        (x, y): tile_id
+        for tile_id, x, y in Tile.objects.exclude(terrain='water').values_list('id', 'x', 'y')
+    }
+    side = max(2, int(math.sqrt(len(land) / 4 / max(users, 1))))
+    free = set(land)
+    for user in world.players:
+        left, top = rng.randrange(world.width), rng.randrange(world.height)
+        patch = [(x, y) for x in range(left, left + side) for y in range(top, top + side) if (x, y) in free]
+        if len(patch) < 2:  # Water or taken, anywhere will do
+            patch = rng.sample(sorted(free), 2)
+        free.difference_update(patch)
+        world.owned[user.id] = [(land[x, y], x, y) for x, y in patch]
+        Tile.objects.filter(id__in=[land[position] for position in patch]).update(owner=user)
+
+    goods = {good.name: good for good in UniversalGoods.objects.bulk_create([UniversalGoods(name=n) for n in GOODS])}
+    TileInventory.objects.bulk_create([
+        TileInventory(tile_id=tile_id, good=goods[name], quantity=rng.randint(20, 200))
+        for owned in world.owned.values()
+        for tile_id, x, y in owned
+        for name in GOODS
+    ], batch_size=BATCH_SIZE)
+
+    GameDate.objects.create()
+    PlayerStats.rebuild()
+    terrain_grid.invalidate()  # The tiles were bulk inserted without signals
+    ownership.invalidate_all()
+    world.refill()
+    return world
+
+
+# Scenarios: name -> function(world, client, user) making one request as user
+
+def _map_view(world, client, user):
+    return client.get('/map/')
+
+
+def _map_chunks(world, client, user):
+    size = settings.MAP_CHUNK_SIZE
+    chunks = ';'.join(
+        f'{world.rng.randrange(math.ceil(world.width / size))},{world.rng.randrange(math.ceil(world.height / size))}'
+        for i in range(4)
+    )
+    return client.get('/map_chunks/', {'chunks': chunks})
+
+
+def _calculate_path(world, client, user):
+    start, goal = (
+        (world.rng.randrange(world.width), world.rng.randrange(world.height)) for i in range(2)
+    )
+    return client.get('/calculate_path/', {
+        'start_x': start[0], 'start_y': start[1], 'goal_x': goal[0], 'goal_y': goal[1],
+    })
+
+
+def _check_ownership(world, client, user):
+    tile_ids = [tile_id for tile_id, x, y in world.owned[user.id][:25]]
+    tile_ids += [world.rng.randrange(1, world.params['tiles']) for i in range(25)]
+    return client.post('/check_ownership/', json.dumps({'tile_ids': tile_ids}), content_type='application/json')
+
+
+def _get_user_data(world, client, user):
+    return client.get('/get_user_data/')
+
+
+def _get_user_actions(world, client, user):
+    return client.get('/get_user_actions/')
+
+
+def _queue_action(world, client, user):
+    details = world.move(user)
+    return client.post('/queue_action/', json.dumps({'action_type': 'move_goods', 'details': details}),
+                       content_type='application/json')
+
+
+def _queue_actions(world, client, user):
+    actions = []
+    for i in range(10):
+        (from_id, *start), (to_id, *goal) = world.rng.sample(world.owned[user.id], 2)
+        actions.append({
+            'action_type': 'move_goods', 'good': world.rng.choice(GOODS), 'quantity': world.rng.randint(1, 5),
+            'from': from_id, 'to': to_id,
+        })
+    return client.post('/queue_actions/', json.dumps({'actions': actions}), content_type='application/json')
+
+
+def _economy_totals(world, client, user):
+    return client.get('/economy/totals/', {'good': world.rng.choice(GOODS), 'limit': 20})
+
+
+def _resolve_actions(world, client, user):
+    # Queueing the turn and resolving it as the worker would
+    response = client.post('/resolve_actions/')
+    run_job(claim_next_job())
+    return response
+
+
+SCENARIOS = {
+    'map_view': _map_view,
+    'map_chunks': _map_chunks,
+    'calculate_path': _calculate_path,
+    'check_ownership': _check_ownership,
+    'get_user_data': _get_user_data,
+    'get_user_actions': _get_user_actions,
+    'queue_action': _queue_action,
+    'queue_actions': _queue_actions,
+    'economy_totals': _economy_totals,
+    'resolve_actions': _resolve_actions,
+}
+
+# Scenarios run by staff, the rest by a random player
+STAFF_SCENARIOS = {'resolve_actions'}
+
+# Scenarios changing the world, refilled before each request outside the timing
+TURN_SCENARIOS = {'resolve_actions'}
+
+
+def run(world, scenarios=None, requests=50, turns=3, warmup=1):
+    """
+    Run each scenario and return {name: stats}, times in milliseconds.
+
+    Turn scenarios run `turns` times, the rest `requests` times, after `warmup` untimed
+    requests. A response other than 200 or a redirect is an error.
+    """
+    results = {}
+    for name in scenarios or SCENARIOS:
+        scenario = SCENARIOS[name]
+        client = Client()
+        user = world.staff if name in STAFF_SCENARIOS else world.rng.choice(world.players)
+        client.force_login(user)
+        count = turns if name in TURN_SCENARIOS else requests
+
+        latencies = []
+        recorder = QueryRecorder()
+        for i in range(warmup + count):
+            if name in TURN_SCENARIOS:
+                world.refill()
+            timed = i >= warmup
+            started = perf_counter()
+            if timed:
+                with connection.execute_wrapper(recorder):
+                    response = scenario(world, client, user)
+            else:
+                response = scenario(world, client, user)
+            elapsed = perf_counter() - started
+            if response.status_code not in (200, 302):
+                raise RuntimeError(f"{name} returned {response.status_code}")
+            if timed:
+                latencies.append(elapsed * 1000)
+
+        latencies.sort()
+        results[name] = {
+            'requests': count,
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1],
+            'mean': sum(latencies) / count,
+            'rps': count / (sum(latencies) / 1000),
+            'queries': recorder.count / count,
+        }
+    return results
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted list."""
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def compare(results, baseline, threshold):
+    """
+    Regressions of results against a baseline, as messages; empty if there are none.
+
+    A scenario regresses when its p50 or p90 latency or its queries per request are more
+    than `threshold` (e.g. 0.25 for 25%) above the baseline.
+    """
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('p50', 'p90', 'queries'):
+            if stats[key] > base[key] * (1 + threshold) + 1e-9:
+                regressions.append(
+                    f"{name} {key}: {stats[key]:.2f} against {base[key]:.2f} "
+                    f"(+{(stats[key] / base[key] - 1) * 100 if base[key] else math.inf:.0f}%)"
+                )
+    return regressions
@@ -0,0 +1,89 @@
+"""
+Live updates for the map page.
+
+Resolving a turn or changing tiles publishes a small event on the broker once the
+transaction commits. The /events/ stream (views.events) waits on the broker and then
+sends the client what changed: the new date, the tiles changed since the map version it
+has and its own action lists.
+
+LocalBroker only reaches streams in the same process. Turns resolved elsewhere, e.g. by
+the `resolve_turns` worker, are picked up by the streams checking the map version and
+date every EVENTS_POLL_SECONDS, so a stream never needs outside services to be correct;
+the broker only makes it faster.
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Events published while subscribed, read from one event loop."""
+
+    def __init__(self, broker, loop):
+        self.broker = broker
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    async def wait(self, timeout):
+        """Events published so far, waiting up to `timeout` seconds for one; [] on timeout."""
+        try:
+            events = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process publish/subscribe; publish() may be called from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+
+    def subscribe(self):
+        subscription = Subscription(self, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, event)
+            except RuntimeError:
+                # The stream's loop has closed, it unsubscribes on its way out
+                pass
+
+
+broker = LocalBroker()
+
+
+def publish_on_commit(event):
+    """Publish once the current transaction commits (straight away outside one)."""
+    transaction.on_commit(lambda: broker.publish(event))
+
+
+def format_event(name, data, event_id=None):
+    """One Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {name}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
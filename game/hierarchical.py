@@ -0,0 +1,346 @@
+"""
+Hierarchical pathfinding (HPA*) over the terrain grid.
+
+The map is cut into square clusters. Every border between two neighbouring clusters gets
+one or two transitions per run of passable tiles, plus one for each diagonal step across
+it that no such run covers, and the cheapest routes between the
+transitions of a cluster are precomputed. A route is found by searching that small
+abstract graph first and then running the regular A* only inside the clusters it passes
+through. Terrain changes mark their cluster dirty and only dirty clusters are rebuilt.
+"""
+from collections import defaultdict
+from heapq import heappush, heappop
+from math import inf
+import threading
+
+from django.conf import settings
+
+from .pathfinding import NEIGHBOR_OFFSETS, chebyshev_distance, find_path, format_path, search_path, terrain_grid
+
+# Border runs longer than this get a transition at each end instead of one in the middle
+MAX_SINGLE_TRANSITION = 6
+
+# Marker for the goal in the abstract search
+GOAL = -1
+
+
+class HierarchicalPathfinder:
+    """HPA* engine bound to a TerrainGrid."""
+
+    def __init__(self, grid, cluster_size=16):
+        self.grid = grid
+        self.cluster_size = cluster_size
+        self.lock = threading.RLock()
+        self.pending_lock = threading.Lock()
+        self.built = False
+        self.dirty = set()
+        self.shape = None
+        self.columns = 0
+        self.rows = 0
+        self.borders = {}  # (cluster, lower or right cluster) -> [(index, index), ...]
+        self.links = defaultdict(set)  # transition index -> transition indices across a border
+        self.nodes = {}  # cluster -> transition indices inside it
+        self.edges = {}  # cluster -> {index: [(other index, cost), ...]}, filled on demand
+        grid.listeners.append(self.terrain_changed)
+
+    def terrain_changed(self, index):
+        """Grid listener; only touches pending state so it never waits on self.lock."""
+        with self.pending_lock:
+            if index is None:
+                self.built = False
+            elif self.built:
+                self.dirty.add(self.cluster_of(index))
+
+    def cluster_of(self, index):
+        width = self.grid.width
+        return (index % width // self.cluster_size, index // width // self.cluster_size)
+
+    def cluster_bounds(self, cluster):
+        """Inclusive (x0, y0, x1, y1) of a cluster in grid-local coordinates."""
+        x0 = cluster[0] * self.cluster_size
+        y0 = cluster[1] * self.cluster_size
+        return (
+            x0, y0,
+            min(x0 + self.cluster_size, self.grid.width) - 1,
+            min(y0 + self.cluster_size, self.grid.height) - 1,
+        )
+
+    def borders_of(self, cluster):
+        cx, cy = cluster
+        keys = [
+            ((cx - 1, cy), cluster), (cluster, (cx + 1, cy)), ((cx, cy - 1), cluster), (cluster, (cx, cy + 1)),
+            ((cx - 1, cy - 1), cluster), (cluster, (cx + 1, cy + 1)),
+            ((cx + 1, cy - 1), cluster), (cluster, (cx - 1, cy + 1)),
+        ]
+        return [
+            (a, b) for a, b in keys
+            if all(0 <= c[0] < self.columns and 0 <= c[1] < self.rows for c in (a, b))
+        ]
+
+    def sync(self):
+        """Bring the abstract graph up to date with the grid."""
+        grid = self.grid
+        shape = (grid.min_x, grid.min_y, grid.width, grid.height)
+        with self.pending_lock:
+            dirty, self.dirty = self.dirty, set()
+            rebuild = not self.built or shape != self.shape
+            self.built = True
+        if rebuild:
+            self.build(shape)
+        elif dirty:
+            self.rebuild_clusters(dirty)
+
+    def build(self, shape):
+        """Precompute transitions and intra-cluster costs for the whole map."""
+        self.shape = shape
+        self.columns = -(-self.grid.width // self.cluster_size)
+        self.rows = -(-self.grid.height // self.cluster_size)
+        self.borders = {}
+        self.links = defaultdict(set)
+        self.nodes = {}
+        self.edges = {}
+        for cy in range(self.rows):
+            for cx in range(self.columns):
+                if cx + 1 < self.columns:
+                    self.build_border((cx, cy), (cx + 1, cy))
+                if cy + 1 < self.rows:
+                    self.build_border((cx, cy), (cx, cy + 1))
+                    if cx + 1 < self.columns:
+                        self.build_border((cx, cy), (cx + 1, cy + 1))
+                    if cx > 0:
+                        self.build_border((cx, cy), (cx - 1, cy + 1))
+        for cy in range(self.rows):
+            for cx in range(self.columns):
+                self.build_cluster((cx, cy))
+
+    def rebuild_clusters(self, clusters):
+        """Rebuild the borders of changed clusters and every cluster touching them."""
+        affected = set()
+        for cluster in clusters:
+            for key in self.borders_of(cluster):
+                self.build_border(*key)
+                affected.update(key)
+            affected.add(cluster)
+        for cluster in affected:
+            self.build_cluster(cluster)
+
+    def build_border(self, a, b):
+        for i, j in self.borders.pop((a, b), ()):
+            self.links[i].discard(j)
+            self.links[j].discard(i)
+
+        costs = self.grid.costs
+        width = self.grid.width
+        x0, y0, x1, y1 = self.cluster_bounds(a)
+        transitions = []
+        if b[1] == a[1]:
+            # Vertical border: right column of a against left column of b
+            pairs = [(y * width + x1, y * width + x1 + 1) for y in range(y0, y1 + 1)]
+            diagonals = [(y * width + x1, (y + d) * width + x1 + 1) for y in range(y0, y1 + 1) for d in (-1, 1)
+                         if y0 <= y + d <= y1]
+        elif b[0] == a[0]:
+            # Horizontal border: bottom row of a against top row of b
+            pairs = [(y1 * width + x, (y1 + 1) * width + x) for x in range(x0, x1 + 1)]
+            diagonals = [(y1 * width + x, (y1 + 1) * width + x + d) for x in range(x0, x1 + 1) for d in (-1, 1)
+                         if x0 <= x + d <= x1]
+        else:
+            # Clusters touching at a corner: the corner tiles of a and b
+            pairs = []
+            x = x1 if b[0] > a[0] else x0
+            diagonals = [(y1 * width + x, (y1 + 1) * width + x + b[0] - a[0])]
+
+        run = []
+        for pair in pairs + [None]:
+            if pair is not None and costs[pair[0]] and costs[pair[1]]:
+                run.append(pair)
+                continue
+            if len(run) > MAX_SINGLE_TRANSITION:
+                transitions += [run[0], run[-1]]
+            elif run:
+                transitions.append(run[len(run) // 2])
+            run = []
+
+        for i, j in diagonals:
+            # A diagonal step is covered by the runs unless both other tiles of its square are impassable
+            if costs[i] and costs[j] and not costs[i - i % width + j % width] and not costs[j - j % width + i % width]:
+                transitions.append((i, j))
+
+        self.borders[(a, b)] = transitions
+        for i, j in transitions:
+            self.links[i].add(j)
+            self.links[j].add(i)
+
+    def build_cluster(self, cluster):
+        nodes = set()
+        for key in self.borders_of(cluster):
+            for i, j in self.borders.get(key, ()):
+                nodes.add(i if self.cluster_of(i) == cluster else j)
+        self.nodes[cluster] = nodes
+        # Intra-cluster costs are only computed once a search actually enters the cluster
+        self.edges.pop(cluster, None)
+
+    def cluster_edges(self, cluster):
+        edges = self.edges.get(cluster)
+        if edges is None:
+            nodes = self.nodes[cluster]
+            edges = {}
+            for node in nodes:
+                dist = self.cluster_search(cluster, node, targets=nodes)
+                edges[node] = [(other, dist[other]) for other in nodes if other != node and other in dist]
+            self.edges[cluster] = edges
+        return edges
+
+    def cluster_search(self, cluster, source, reverse=False, targets=None):
+        """
+        Dijkstra from source limited to one cluster.
+
+        Returns {index: cost}. With reverse=True the costs are those of travelling
+        from each tile *to* source instead. If targets is given the search stops once
+        all of them are settled.
+        """
+        costs = self.grid.costs
+        width = self.grid.width
+        x0, y0, x1, y1 = self.cluster_bounds(cluster)
+        dist = {source: 0}
+        heap = [(0, source)]
+        remaining = len(targets) if targets is not None else -1
+        while heap:
+            d, current = heappop(heap)
+            if d > dist[current]:
+                continue
+            if targets is not None and current in targets:
+                remaining -= 1
+                if not remaining:
+                    break
+            cx = current % width
+            cy = current // width
+            for dx, dy in NEIGHBOR_OFFSETS:
+                nx = cx + dx
+                ny = cy + dy
+                if nx < x0 or nx > x1 or ny < y0 or ny > y1:
+                    continue
+                neighbor = ny * width + nx
+                step = costs[neighbor]
+                if not step:
+                    continue
+                if reverse:
+                    step = costs[current]
+                nd = d + step
+                if nd < dist.get(neighbor, inf):
+                    dist[neighbor] = nd
+                    heappush(heap, (nd, neighbor))
+        return dist
+
+    def abstract_search(self, start, goal):
+        """A* over the transition graph; returns the transitions on the route or None."""
+        costs = self.grid.costs
+        width = self.grid.width
+        start_cluster = self.cluster_of(start)
+        goal_cluster = self.cluster_of(goal)
+        start_costs = self.cluster_search(start_cluster, start)
+        goal_costs = self.cluster_search(goal_cluster, goal, reverse=True)
+        gx = goal % width
+        gy = goal // width
+
+        def heuristic(index):
+            return max(abs(index % width - gx), abs(index // width - gy))
+
+        open_set = []
+        g_score = {}
+        came_from = {}
+        for node in self.nodes.get(start_cluster, ()):
+            if node in start_costs:
+                g_score[node] = start_costs[node]
+                heappush(open_set, (start_costs[node] + heuristic(node), node))
+
+        while open_set:
+            f, current = heappop(open_set)
+            if current == GOAL:
+                break
+            d = g_score[current]
+            if f > d + heuristic(current):
+                continue  # Stale entry
+
+            cluster = self.cluster_of(current)
+            if cluster == goal_cluster and current in goal_costs:
+                total = d + goal_costs[current]
+                if total < g_score.get(GOAL, inf):
+                    g_score[GOAL] = total
+                    came_from[GOAL] = current
+                    heappush(open_set, (total, GOAL))
+
+            neighbors = list(self.cluster_edges(cluster).get(current, ()))
+            neighbors += [(other, costs[other]) for other in self.links.get(current, ())]
+            for other, cost in neighbors:
+                tentative = d + cost
+                if tentative < g_score.get(other, inf):
+                    g_score[other] = tentative
+                    came_from[other] = current
+                    heappush(open_set, (tentative + heuristic(other), other))
+
+        if GOAL not in came_from:
+            return None
+        route = []
+        current = came_from[GOAL]
+        while current in came_from:
+            route.append(current)
+            current = came_from[current]
+        route.append(current)
+        route.reverse()
+        return route
+
+    def find_path(self, start, goal, speed=2):
+        """Same contract as pathfinding.find_path, using the cluster hierarchy."""
+        grid = self.grid
+        grid.ensure_loaded()
+        with self.lock:
+            path = self.search(start, goal)
+        if path is None:
+            # Outside the lock, so other long routes don't wait on the flat search
+            return find_path(start, goal, grid, speed)
+        if not path:
+            return [], 0  # No route
+        return format_path(path, goal, grid, speed)
+
+    def search(self, start, goal):
+        """
+        The tiles of the route like pathfinding.search_path, [] if the abstract graph has no
+        route, or None where the flat search should decide. Call with self.lock held.
+        """
+        grid = self.grid
+        self.sync()
+        start_index = grid.index(*start)
+        goal_index = grid.index(*goal)
+        if start_index is None or not grid.costs[start_index] or not grid.contains(goal) \
+                or chebyshev_distance(start, goal) <= 1:
+            return None  # Trivial for the flat search
+
+        start_cluster = self.cluster_of(start_index)
+        goal_cluster = self.cluster_of(goal_index)
+        if max(abs(start_cluster[0] - goal_cluster[0]), abs(start_cluster[1] - goal_cluster[1])) <= 1:
+            # Close by, try the two clusters on their own first
+            path = search_path(start, goal, grid, allowed=self.corridor_filter({start_cluster, goal_cluster}))
+            if path is not None:
+                return path
+        route = self.abstract_search(start_index, goal_index)
+        if route is None:
+            # Every crossing between clusters is covered by a transition, so there is no route at all
+            return []
+        # Refine: regular A* restricted to the clusters of the chosen corridor
+        corridor = {self.cluster_of(node) for node in route}
+        corridor.update((start_cluster, goal_cluster))
+        return search_path(start, goal, grid, allowed=self.corridor_filter(corridor))
+
+    def corridor_filter(self, corridor):
+        """Build a find_path `allowed` callable accepting only tiles inside the given clusters."""
+        size = self.cluster_size
+        origin_x = self.grid.min_x
+        origin_y = self.grid.min_y
+
+        def allowed(x, y):
+            return ((x - origin_x) // size, (y - origin_y) // size) in corridor
+
+        return allowed
+
+
+hierarchical_pathfinder = HierarchicalPathfinder(terrain_grid, getattr(settings, 'HPA_CLUSTER_SIZE', 16))
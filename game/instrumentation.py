@@ -0,0 +1,149 @@
+"""
+Timing and query counting helpers.
+
+QueryRecorder is installed with connection.execute_wrapper() and counts every SQL
+statement run on that connection and the time spent in it. PhaseTimer splits a longer
+piece of work into named phases and records wall time and queries per phase.
+QueryInstrumentationMiddleware records the queries of each request, and @query_budget
+checks those of a view against a maximum.
+"""
+from functools import wraps
+import heapq
+import logging
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """
+    execute_wrapper counting queries and their total time in seconds.
+
+    With keep > 0 the `keep` slowest statements are kept too, see slowest().
+    """
+
+    def __init__(self, keep=0):
+        self.count = 0
+        self.time = 0.0
+        self.keep = keep
+        self._slowest = []  # Heap of (seconds, sql), fastest first
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = perf_counter() - start
+            self.count += 1
+            self.time += elapsed
+            if self.keep:
+                if len(self._slowest) < self.keep:
+                    heapq.heappush(self._slowest, (elapsed, sql))
+                elif elapsed > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, (elapsed, sql))
+
+    def slowest(self):
+        """[(seconds, sql)] of the slowest statements, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+
+class PhaseTimer:
+    """
+    Records {phase: {'seconds', 'queries', 'query_seconds'}} for consecutive phases.
+
+    start(name) ends the running phase and starts the next one; stop() ends the last.
+    Pass the QueryRecorder that is installed on the connection to get query numbers.
+    """
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder or QueryRecorder()
+        self.phases = {}
+        self.created = perf_counter()
+        self.current = None
+
+    def start(self, name):
+        self.stop()
+        self.current = (name, perf_counter(), self.recorder.count, self.recorder.time)
+
+    def stop(self):
+        if self.current is None:
+            return
+        name, started, count, query_time = self.current
+        self.current = None
+        phase = self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0, 'query_seconds': 0.0})
+        phase['seconds'] += perf_counter() - started
+        phase['queries'] += self.recorder.count - count
+        phase['query_seconds'] += self.recorder.time - query_time
+
+    @property
+    def total(self):
+        return perf_counter() - self.created
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more queries than its @query_budget allows."""
+
+
+def query_budget(queries):
+    """
+    Decorator setting the most queries a view may run per request, counting those of the
+    decorators below it (e.g. loading request.user for @login_required) but not those of
+    the middleware. Over budget, QueryBudgetExceeded is raised when QUERY_BUDGET_RAISE is
+    set (tests, the benchmark) and a warning logged otherwise. Needs
+    QueryInstrumentationMiddleware, without it nothing is checked.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            recorder = getattr(request, 'query_recorder', None)
+            if recorder is None:
+                return view(request, *args, **kwargs)
+            before = recorder.count
+            response = view(request, *args, **kwargs)
+            used = recorder.count - before
+            if used > queries:
+                message = f"{request.method} {request.path} ran {used} queries, its budget is {queries}"
+                if settings.QUERY_BUDGET_RAISE:
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+            return response
+        wrapper.query_budget = queries
+        return wrapper
+    return decorator
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Counts the queries of each request and the time spent in them.
+
+    With QUERY_INSTRUMENTATION_HEADERS the numbers go out as X-Query-Count and
+    X-Query-Time (milliseconds) and in Server-Timing for the browser's network panel.
+    Requests spending over QUERY_SLOW_REQUEST_SECONDS in SQL are logged with their
+    slowest statements. Streamed responses only count the queries run before streaming.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(keep=settings.QUERY_SLOWEST_KEPT)
+        request.query_recorder = recorder  # For @query_budget
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+
+        if settings.QUERY_INSTRUMENTATION_HEADERS:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time'] = f'{recorder.time * 1000:.1f}'
+            response['Server-Timing'] = f'db;dur={recorder.time * 1000:.1f};desc="{recorder.count} queries"'
+
+        if recorder.time >= settings.QUERY_SLOW_REQUEST_SECONDS:
+            logger.info(
+                "%s %s spent %.3fs in %d queries, slowest:\n%s", request.method, request.path,
+                recorder.time, recorder.count,
+                "\n".join(f"  {seconds:.3f}s {sql}" for seconds, sql in recorder.slowest()),
+            )
+
+        return response
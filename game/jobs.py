@@ -0,0 +1,194 @@
+"""
+Background turn resolution.
+
+The admin only enqueues a TurnJob; the `resolve_turns` management command picks queued
+jobs up and resolves them outside the request cycle, recording phase, processed counts
+and timings as it goes.
+
+The turn runs inside one write transaction, which on SQLite locks out every other writer,
+so progress is not written to the database while the turn runs. The worker keeps it in a
+small JSON file per job under TURN_JOB_PROGRESS_DIR, rewritten every second, and the job
+status view reads it from there. The file doubles as the worker's heartbeat: a running
+job whose file has not been touched for TURN_JOB_STALE_SECONDS lost its worker and is
+recovered by recover_stale_jobs().
+"""
+import json
+import logging
+import os
+import threading
+import traceback
+from datetime import timedelta
+from pathlib import Path
+from time import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import TurnJob, TurnReport
+from .turns import resolve_turn
+
+logger = logging.getLogger(__name__)
+
+
+def _progress_path(job_id):
+    return Path(settings.TURN_JOB_PROGRESS_DIR) / f'{job_id}.json'
+
+
+def read_progress(job_id):
+    """The progress the worker last wrote for a running job, or None."""
+    try:
+        return json.loads(_progress_path(job_id).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+class JobProgress:
+    """
+    progress callback for resolve_turn that records the progress of a TurnJob.
+
+    Calls only keep the latest progress; a thread writes it to the job's progress file
+    every `interval` seconds, whether it changed or not, as a heartbeat.
+    """
+
+    def __init__(self, job, interval=1.0):
+        self.job_id = job.id
+        self.path = _progress_path(job.id)
+        self.interval = interval
+        self.latest = ('starting', 0, 0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __call__(self, phase, processed, total):
+        self.latest = (phase, processed, total)
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._write()
+        self.thread.start()
+
+    def stop(self):
+        """Stop writing and remove the file; returns the last progress reported."""
+        self.stopped.set()
+        self.thread.join()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+        return self.latest
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        phase, processed, total = self.latest
+        temporary = self.path.with_suffix('.tmp')
+        try:
+            temporary.write_text(json.dumps({
+                'phase': phase, 'processed': processed, 'total': total, 'updated': time(),
+            }))
+            os.replace(temporary, self.path)  # Readers never see a half written file
+        except OSError:
+            logger.warning("Could not record progress of turn job %s", self.job_id, exc_info=True)
+
+
+def enqueue_turn(user=None, end_turn=False):
+    """Queue a turn for the worker, reusing a job that is already waiting."""
+    job = TurnJob.objects.filter(status='queued').first()
+    if job is None:
+        job = TurnJob.objects.create(requested_by=user, end_turn=end_turn)
+    elif end_turn and not job.end_turn:
+        job.end_turn = True
+        job.save(update_fields=['end_turn'])
+    return job
+
+
+def claim_next_job():
+    """Mark the oldest queued job as running and return it, or None if there is none."""
+    for job in TurnJob.objects.filter(status='queued').order_by('created'):
+        # Only one worker can move a job out of "queued"
+        claimed = TurnJob.objects.filter(pk=job.pk, status='queued').update(
+            status='running', started=timezone.now(), phase='starting',
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Resolve the turn for a claimed job and record the outcome on it.
+
+    The job is done as soon as the turn commits. Logging players out comes after that, if
+    it fails the error is kept on the done job; the turn is not resolved again.
+    """
+    from .views import log_out_users
+
+    reporter = JobProgress(job)
+    reporter.start()
+    try:
+        summary = resolve_turn(progress=reporter)
+    except Exception:
+        # Keep the last reported phase so it shows where the turn failed
+        job.phase, job.processed, job.total = reporter.stop()
+        logger.exception("Turn job %s failed", job.id)
+        job.status = 'failed'
+        job.error = traceback.format_exc()
+        job.finished = timezone.now()
+        job.save(update_fields=['status', 'phase', 'processed', 'total', 'error', 'finished'])
+        return job
+
+    reporter.stop()
+    job.status = 'done'
+    job.phase = 'done'
+    job.summary = summary
+    job.processed = job.total = summary['queued'] + summary['shipments']
+    job.finished = timezone.now()
+    job.save()
+
+    if job.end_turn:
+        try:
+            log_out_users()
+        except Exception:
+            logger.exception("Turn job %s resolved the turn but could not log players out", job.id)
+            job.error = traceback.format_exc()
+            job.save(update_fields=['error'])
+    return job
+
+
+def recover_stale_jobs():
+    """
+    Close running jobs whose worker stopped (killed, crashed, machine restarted).
+
+    A worker that dies mid-turn leaves its transaction uncommitted, so such a job failed and
+    a new turn can be queued. If the turn did commit and the worker died just before
+    recording it, its TurnReport is there and the job is marked done. Returns the jobs closed.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.TURN_JOB_STALE_SECONDS)
+    recovered = []
+    for job in TurnJob.objects.filter(status='running', started__lt=stale):
+        progress = read_progress(job.id)
+        if progress and progress['updated'] >= stale.timestamp():
+            continue  # Still reporting
+        report = TurnReport.objects.filter(created__gte=job.started).order_by('created').first()
+        if report:
+            job.status = 'done'
+            job.phase = 'done'
+            job.summary = report.summary
+            job.finished = report.created
+        else:
+            job.status = 'failed'
+            job.error = "The turn worker stopped before finishing the turn, nothing was resolved."
+            job.finished = timezone.now()
+            if progress:
+                job.phase, job.processed, job.total = progress['phase'], progress['processed'], progress['total']
+        # Unless another worker got to it first
+        if TurnJob.objects.filter(pk=job.pk, status='running').update(
+            status=job.status, phase=job.phase, processed=job.processed, total=job.total,
+            summary=job.summary, error=job.error, finished=job.finished,
+        ):
+            _progress_path(job.id).unlink(missing_ok=True)
+            logger.warning("Recovered turn job %s left running by a stopped worker as %s", job.id, job.status)
+            recovered.append(job)
+    return recovered
@@ -0,0 +1,83 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from game.benchmark import SCENARIOS, build_world, compare, run
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the game views and turn resolution on a seeded world in a throwaway test "
+        "database, and compare the results with a saved baseline. Record the baseline with "
+        "--save-baseline on a known good commit, it is written to BENCHMARK_BASELINE "
+        "(benchmark_baseline.json next to manage.py) unless --baseline names another file. "
+        "Without a baseline the results are only printed, use --require-baseline to fail instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--tiles', type=int, default=10000)
+        parser.add_argument('--queued', type=int, default=200, help="Queued actions.")
+        parser.add_argument('--in-flight', type=int, default=200, help="Actions with goods in transit.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--requests', type=int, default=50, help="Requests per view scenario.")
+        parser.add_argument('--turns', type=int, default=3, help="Turns resolved.")
+        parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help="Run only this scenario, may be repeated.")
+        parser.add_argument('--baseline', default=str(settings.BENCHMARK_BASELINE),
+                            help="Baseline file, BENCHMARK_BASELINE by default.")
+        parser.add_argument('--save-baseline', action='store_true', help="Write the results as the new baseline.")
+        parser.add_argument('--require-baseline', action='store_true',
+                            help="Fail if there is no baseline to compare with, e.g. in CI.")
+        parser.add_argument('--threshold', type=float, default=settings.BENCHMARK_THRESHOLD,
+                            help="Allowed slowdown as a fraction, e.g. 0.25.")
+
+    def handle(self, *args, **options):
+        params = {name: options[name] for name in ('users', 'tiles', 'queued', 'in_flight', 'seed')}
+        if min(options['users'], options['requests'], options['turns']) < 1 or options['tiles'] < 4:
+            raise CommandError("Need at least one user, request and turn, and four tiles.")
+        path = options['baseline']
+        if options['require_baseline'] and not options['save_baseline'] and not os.path.exists(path):
+            raise CommandError(f"No baseline at {path}, record one with --save-baseline.")
+
+        setup_test_environment(debug=False)
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.stdout.write("Seeding world...")
+            world = build_world(**params)
+            with override_settings(QUERY_BUDGET_RAISE=True):  # A view over its budget is a failure too
+                results = run(world, options['scenario'], options['requests'], options['turns'])
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{'scenario':<18}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}")
+        for name, stats in results.items():
+            self.stdout.write(
+                f"{name:<18}{stats['requests']:>5}{stats['p50']:>10.2f}{stats['p90']:>10.2f}"
+                f"{stats['p99']:>10.2f}{stats['rps']:>10.1f}{stats['queries']:>9.1f}"
+            )
+
+        if options['save_baseline']:
+            with open(path, 'w') as file:
+                json.dump({'world': params, 'results': results}, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {path}."))
+            return
+
+        try:
+            with open(path) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            if options['require_baseline']:
+                raise CommandError(f"No baseline at {path}, record one with --save-baseline.")
+            self.stdout.write(self.style.WARNING(f"No baseline at {path}, run with --save-baseline to record one."))
+            return
+        if baseline['world'] != params:
+            raise CommandError(f"The baseline was recorded with another world: {baseline['world']}")
+        regressions = compare(results, baseline['results'], options['threshold'])
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}."))
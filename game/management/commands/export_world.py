@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.backup import export_world
+
+
+class Command(BaseCommand):
+    help = "Write tiles, players, goods, actions and the game date to a compressed world file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to write, e.g. season3.jsonl.gz")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        counts = export_world(options['path'], progress=self.report)
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {sum(counts.values())} rows to {options['path']} in {time.monotonic() - started:.1f}s."
+        ))
+
+    def report(self, section, count):
+        self.stdout.write(f"  {section}: {count}")
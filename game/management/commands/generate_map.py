@@ -0,0 +1,79 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+
+from game import maptiles, ownership
+from game.mapgen import terrain_rows
+from game.models import MapVersion, PlayerStats, ProgressAction, QueuedAction, Shipment, Tile, TileInventory
+from game.pathfinding import terrain_grid
+
+
+class Command(BaseCommand):
+    help = "Generate a width x height map of procedural terrain, streaming the tiles into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('width', type=int)
+        parser.add_argument('height', type=int)
+        parser.add_argument('--seed', type=int, default=0, help="Same seed, same map.")
+        parser.add_argument('--scale', type=float, default=32.0, help="Size in tiles of the biggest features.")
+        parser.add_argument('--x', type=int, default=0, help="Column of the top left tile.")
+        parser.add_argument('--y', type=int, default=0, help="Row of the top left tile.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Tiles per INSERT.")
+        parser.add_argument('--clear', action='store_true',
+                            help="Delete every tile first, with its goods and the actions in progress.")
+
+    def handle(self, *args, **options):
+        width, height = options['width'], options['height']
+        x0, y0 = options['x'], options['y']
+        batch_size = options['batch_size']
+        if width <= 0 or height <= 0 or batch_size <= 0:
+            raise CommandError("Width, height and batch size must be positive.")
+
+        with transaction.atomic():
+            if options['clear']:
+                self.clear()
+            elif Tile.objects.filter(x__gte=x0, x__lt=x0 + width, y__gte=y0, y__lt=y0 + height).exists():
+                raise CommandError("There are tiles in that area already, use --clear or another --x/--y.")
+
+            started = time.monotonic()
+            created = 0
+            batch = []
+            for y, row in terrain_rows(x0, y0, width, height, options['seed'], options['scale']):
+                batch.extend(Tile(x=x, y=y, terrain=terrain, population=population) for x, terrain, population in row)
+                while len(batch) >= batch_size:
+                    Tile.objects.bulk_create(batch[:batch_size])
+                    created += batch_size
+                    del batch[:batch_size]
+                    reset_queries()  # With DEBUG on every INSERT would be kept in memory
+                if (y - y0 + 1) % max(1, height // 10) == 0:
+                    self.report(created + len(batch), width * height, started)
+            Tile.objects.bulk_create(batch)
+            created += len(batch)
+
+            # Bulk inserts skip the signals keeping these in step
+            MapVersion.record_all(reason='generate')
+            if options['clear']:
+                PlayerStats.rebuild()
+            transaction.on_commit(terrain_grid.invalidate)
+            transaction.on_commit(maptiles.invalidate_all)
+            transaction.on_commit(ownership.invalidate_all)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {created} tiles in {elapsed:.1f}s ({created / max(elapsed, 1e-9):.0f} tiles/s)."
+        ))
+        self.stdout.write("Restart running web and worker processes so they reload the terrain grid.")
+
+    def clear(self):
+        """Delete the whole map in a few statements, without per-tile signals."""
+        QueuedAction.objects.all().delete()
+        Shipment.objects.all().delete()
+        ProgressAction.objects.all().delete()
+        TileInventory.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {connection.ops.quote_name(Tile._meta.db_table)}')
+
+    def report(self, done, total, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f"  {done}/{total} tiles, {done / max(elapsed, 1e-9):.0f} tiles/s")
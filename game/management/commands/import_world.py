@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.backup import import_world
+
+
+class Command(BaseCommand):
+    help = "Restore the game from a world file written by export_world."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--replace', action='store_true',
+                            help="Delete the current map, goods and actions first.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            counts = import_world(options['path'], replace=options['replace'], progress=self.report)
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not import {options['path']}: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {sum(counts.values())} rows in {time.monotonic() - started:.1f}s."
+        ))
+        self.stdout.write("Restart running web and worker processes so they reload the terrain grid.")
+
+    def report(self, section, count):
+        self.stdout.write(f"  {section}: {count}")
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from game.models import PlayerStats
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-player stats from the tiles, e.g. after bulk changes to the map."
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help="Only rebuild these players (default: everybody).")
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options['usernames']:
+            users = dict(User.objects.filter(username__in=options['usernames']).values_list('username', 'id'))
+            unknown = set(options['usernames']) - users.keys()
+            if unknown:
+                raise CommandError(f"Unknown users: {', '.join(sorted(unknown))}")
+            user_ids = list(users.values())
+
+        count = PlayerStats.rebuild(user_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stats for {count} players."))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.jobs import claim_next_job, enqueue_turn, recover_stale_jobs, run_job
+from game.models import TurnReport
+
+
+class Command(BaseCommand):
+    help = "Resolve queued turn jobs outside the web request cycle."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--now', action='store_true', help="Queue a turn first, e.g. when run from cron.")
+        parser.add_argument('--end-turn', action='store_true', help="With --now, log players out afterwards.")
+        parser.add_argument('--wait', action='store_true', help="Keep running and poll for new jobs.")
+        parser.add_argument('--interval', type=float, default=2.0, help="Seconds between polls with --wait.")
+
+    def handle(self, *args, **options):
+        if options['now']:
+            enqueue_turn(end_turn=options['end_turn'])
+
+        while True:
+            for job in recover_stale_jobs():
+                self.stdout.write(self.style.WARNING(f"Turn job {job.id} had lost its worker, marked {job.status}."))
+            job = claim_next_job()
+            if job is None:
+                if not options['wait']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f"Resolving turn job {job.id}...")
+            job = run_job(job)
+            if job.status == 'done':
+                self.stdout.write(self.style.SUCCESS(f"Turn job {job.id} done in {job.elapsed:.1f}s: {job.summary}"))
+                report = TurnReport.objects.first()
+                if report:
+                    for name, phase in report.phases.items():
+                        self.stdout.write(
+                            f"  {name}: {phase['seconds']:.3f}s, {phase['queries']} queries ({phase['query_seconds']:.3f}s)"
+                        )
+            else:
+                self.stdout.write(self.style.ERROR(f"Turn job {job.id} failed, see the job in the admin."))
@@ -0,0 +1,206 @@
+"""
+Packed binary representation of the map.
+
+A MapSnapshot holds a rectangle of the map as flat columns indexed by
+(y - min_y) * width + (x - min_x), one entry per cell whether or not a tile exists there:
+
+    tile_ids    uint64  0 where there is no tile (tile ids are 64 bit)
+    owners      uint32  index into the owner palette, 0 for no owner
+    population  int32
+    goods       int32   one column per UniversalGoods name
+    terrain     uint8   index into TERRAIN_TYPES + 1, 0 where there is no tile
+
+Encoded, everything is little-endian and every section starts on a boundary of its item
+size (8 bytes for tile_ids, 4 for the rest) so it can be wrapped in a typed array directly
+on the client:
+
+    header      magic b"WGMS", version uint16, 0 uint16,
+                min_x int32, min_y int32, width uint32, height uint32,
+                owner count uint32, good count uint32, meta length uint32
+    meta        UTF-8 JSON {"owners": [{"id", "display", "color"}, ...], "goods": [name, ...]},
+                owner 0 being null
+    columns     tile_ids, owners, population, one column per good, terrain
+"""
+from array import array
+import json
+import struct
+import sys
+
+from django.db.models import Max, Min
+
+from .models import Profile, Tile, TileInventory, UniversalGoods
+from .pathfinding import TERRAIN_TYPES
+
+MAGIC = b'WGMS'
+VERSION = 2
+HEADER = struct.Struct('<4sHHiiIIIII')
+
+CONTENT_TYPE = 'application/octet-stream'
+
+
+def _padding(length, boundary=4):
+    return b'\0' * (-length % boundary)
+
+
+def _to_bytes(column):
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_bytes(typecode, data, offset, count):
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(data[offset:end])
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column.byteswap()
+    return column, end + (-end % 4)
+
+
+class MapSnapshot:
+    """In-memory columnar copy of (part of) the map, see the module docstring for the layout."""
+
+    def __init__(self, min_x, min_y, width, height, goods=(), owners=None):
+        size = width * height
+        self.min_x = min_x
+        self.min_y = min_y
+        self.width = width
+        self.height = height
+        self.tile_ids = array('Q', bytes(8 * size))
+        self.owners = array('I', bytes(4 * size))
+        self.population = array('i', bytes(4 * size))
+        self.terrain = array('B', bytes(size))
+        self.goods = {name: array('i', bytes(4 * size)) for name in goods}
+        self.palette = owners or [None]  # Owner index -> {"id", "display", "color"}
+        self.palette_index = {owner['id']: index for index, owner in enumerate(self.palette) if owner}
+
+    @classmethod
+    def load(cls, x0=None, y0=None, width=None, height=None):
+        """
+        Read the whole map, or the width x height rectangle at (x0, y0), from the database.
+
+        Takes one query for the tiles plus one each for their goods, the goods names and the
+        owners.
+        """
+        tiles = Tile.objects.all()
+        if x0 is None:
+            bounds = tiles.aggregate(min_x=Min('x'), max_x=Max('x'), min_y=Min('y'), max_y=Max('y'))
+            if bounds['min_x'] is None:
+                return cls(0, 0, 0, 0)
+            x0, y0 = bounds['min_x'], bounds['min_y']
+            width = bounds['max_x'] - x0 + 1
+            height = bounds['max_y'] - y0 + 1
+        else:
+            tiles = tiles.filter(x__gte=x0, x__lt=x0 + width, y__gte=y0, y__lt=y0 + height)
+
+        snapshot = cls(x0, y0, width, height, UniversalGoods.objects.order_by('name').values_list('name', flat=True))
+        owner_ids = []
+        indexes = {}
+        rows = tiles.values_list('id', 'x', 'y', 'terrain', 'owner_id', 'population').iterator(chunk_size=10000)
+        for tile_id, x, y, terrain, owner_id, population in rows:
+            index = snapshot.index(x, y)
+            indexes[tile_id] = index
+            snapshot.tile_ids[index] = tile_id
+            snapshot.terrain[index] = TERRAIN_TYPES.index(terrain) + 1 if terrain in TERRAIN_TYPES else 0
+            snapshot.population[index] = population
+            if owner_id is not None:
+                if owner_id not in snapshot.palette_index:
+                    snapshot.palette_index[owner_id] = len(snapshot.palette)
+                    snapshot.palette.append({'id': owner_id, 'display': '', 'color': ''})
+                    owner_ids.append(owner_id)
+                snapshot.owners[index] = snapshot.palette_index[owner_id]
+
+        inventory = TileInventory.objects.filter(tile__in=tiles).values_list('tile_id', 'good__name', 'quantity')
+        for tile_id, name, quantity in inventory.iterator(chunk_size=10000):
+            if tile_id in indexes:
+                snapshot.goods[name][indexes[tile_id]] = quantity
+
+        for user_id, display_name, color in Profile.objects.filter(user_id__in=owner_ids).values_list(
+                'user_id', 'display_name', 'color'):
+            owner = snapshot.palette[snapshot.palette_index[user_id]]
+            owner['display'] = display_name or ''
+            owner['color'] = color
+        return snapshot
+
+    def index(self, x, y):
+        """Return the flat index for (x, y), or None if it is outside the snapshot."""
+        x -= self.min_x
+        y -= self.min_y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return None
+
+    def tile(self, x, y):
+        """The tile at (x, y) as a dict, or None if there is none."""
+        index = self.index(x, y)
+        if index is None or not self.tile_ids[index]:
+            return None
+        return {
+            'id': self.tile_ids[index],
+            'x': x,
+            'y': y,
+            'terrain': TERRAIN_TYPES[self.terrain[index] - 1] if self.terrain[index] else None,
+            'owner': self.palette[self.owners[index]],
+            'population': self.population[index],
+            'goods': {name: column[index] for name, column in self.goods.items()},
+        }
+
+    def crop(self, x0, y0, width, height):
+        """Copy of the width x height rectangle at (x0, y0); cells outside this snapshot are empty."""
+        part = MapSnapshot(x0, y0, width, height, self.goods)
+        used = {}
+        for row in range(height):
+            for column in range(width):
+                source = self.index(x0 + column, y0 + row)
+                if source is None or not self.tile_ids[source]:
+                    continue
+                target = row * width + column
+                part.tile_ids[target] = self.tile_ids[source]
+                part.terrain[target] = self.terrain[source]
+                part.population[target] = self.population[source]
+                owner = self.owners[source]
+                if owner:
+                    if owner not in used:
+                        used[owner] = len(part.palette)
+                        part.palette.append(self.palette[owner])
+                    part.owners[target] = used[owner]
+                for name, values in self.goods.items():
+                    part.goods[name][target] = values[source]
+        part.palette_index = {owner['id']: index for index, owner in enumerate(part.palette) if owner}
+        return part
+
+    def to_bytes(self):
+        meta = json.dumps({'owners': self.palette, 'goods': list(self.goods)}, separators=(',', ':')).encode()
+        parts = [
+            HEADER.pack(
+                MAGIC, VERSION, 0, self.min_x, self.min_y, self.width, self.height,
+                len(self.palette), len(self.goods), len(meta),
+            ),
+            meta, _padding(HEADER.size + len(meta), 8),
+            _to_bytes(self.tile_ids), _to_bytes(self.owners), _to_bytes(self.population),
+        ]
+        parts += [_to_bytes(column) for column in self.goods.values()]
+        parts += [_to_bytes(self.terrain), _padding(len(self.terrain))]
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, _, min_x, min_y, width, height, owner_count, good_count, meta_length = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a map snapshot of a supported version")
+        offset = HEADER.size
+        meta = json.loads(bytes(data[offset:offset + meta_length]))
+        offset += meta_length
+        offset += -offset % 8
+
+        snapshot = cls(min_x, min_y, width, height, meta['goods'], meta['owners'])
+        size = width * height
+        snapshot.tile_ids, offset = _from_bytes('Q', data, offset, size)
+        snapshot.owners, offset = _from_bytes('I', data, offset, size)
+        snapshot.population, offset = _from_bytes('i', data, offset, size)
+        for name in meta['goods']:
+            snapshot.goods[name], offset = _from_bytes('i', data, offset, size)
+        snapshot.terrain, offset = _from_bytes('B', data, offset, size)
+        return snapshot
@@ -0,0 +1,110 @@
+"""
+Procedural terrain for new maps.
+
+Terrain comes from two fractal value-noise fields, elevation and moisture. Lattice
+values are hashed from (seed, octave, x, y) rather than stored, so any part of any size
+of map can be generated row by row in constant memory and the same seed always gives the
+same map. Per-column lattice cells and weights are the same for every row and are worked
+out once per octave, leaving a few multiply-adds per tile and octave.
+"""
+from array import array
+
+MASK = 0xFFFFFFFF
+
+
+def _hash(seed, ix, iy):
+    """Deterministic value in [0, 1) for a lattice point."""
+    h = (seed * 0x27D4EB2D + ix * 0x165667B1 + iy * 0x9E3779B1) & MASK
+    h ^= h >> 15
+    h = (h * 0x2C1B3C6D) & MASK
+    h ^= h >> 12
+    h = (h * 0x297A2D39) & MASK
+    h ^= h >> 15
+    return h / 4294967296.0
+
+
+def _smooth(t):
+    return t * t * (3 - 2 * t)
+
+
+class ValueNoise:
+    """
+    Fractal value noise in [0, 1) for the columns x0 .. x0 + width - 1.
+
+    scale is the size in tiles of the biggest features; each of the `octaves` layers has
+    half the size and half the weight of the one before.
+    """
+
+    def __init__(self, seed, x0, width, scale=32.0, octaves=4):
+        self.seed = seed
+        self.octaves = []
+        weight = 1.0
+        total = 0.0
+        for octave in range(octaves):
+            size = max(scale / 2 ** octave, 1.0)
+            cells = array('q')
+            weights = array('d')
+            for x in range(x0, x0 + width):
+                position = x / size
+                cell = int(position // 1)
+                cells.append(cell)
+                weights.append(_smooth(position - cell))
+            first = cells[0] if width else 0
+            self.octaves.append((size, weight, first, cells, weights, cells[-1] - first + 2 if width else 0))
+            total += weight
+            weight /= 2
+        self.total = total
+
+    def row(self, y):
+        """Noise values for row y, one per column."""
+        values = None
+        for octave, (size, weight, first, cells, weights, count) in enumerate(self.octaves):
+            position = y / size
+            iy = int(position // 1)
+            wy = _smooth(position - iy)
+            seed = self.seed * 31 + octave
+            # Lattice values above and below the row, blended vertically once per cell
+            column = [
+                (1 - wy) * _hash(seed, ix, iy) + wy * _hash(seed, ix, iy + 1)
+                for ix in range(first, first + count)
+            ]
+            scaled = weight / self.total
+            layer = [
+                scaled * (column[cell - first] + wx * (column[cell - first + 1] - column[cell - first]))
+                for cell, wx in zip(cells, weights)
+            ]
+            values = layer if values is None else [a + b for a, b in zip(values, layer)]
+        return values or []
+
+
+def terrain_for(elevation, moisture, city):
+    """Terrain type for a tile from its noise values; city is a [0, 1) roll."""
+    if elevation < 0.38:
+        return 'water'
+    if elevation > 0.68:
+        return 'mountains'
+    if moisture > 0.58:
+        return 'forest'
+    if city < 0.004:
+        return 'city'
+    if moisture < 0.42:
+        return 'fields'
+    return 'plains'
+
+
+def terrain_rows(x0, y0, width, height, seed, scale=32.0):
+    """
+    Yield (y, [(x, terrain, population), ...]) for each row of the map, top to bottom.
+
+    Cities get a population, everything else starts empty.
+    """
+    elevation = ValueNoise(seed, x0, width, scale)
+    moisture = ValueNoise(seed + 1, x0, width, scale * 0.75)
+    for y in range(y0, y0 + height):
+        row = []
+        for x, e, m in zip(range(x0, x0 + width), elevation.row(y), moisture.row(y)):
+            roll = _hash(seed + 2, x, y)
+            terrain = terrain_for(e, m, roll)
+            population = 1000 + int(roll * 1000000) if terrain == 'city' else 0
+            row.append((x, terrain, population))
+        yield y, row
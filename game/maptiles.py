@@ -0,0 +1,138 @@
+"""
+Pre-rendered map images for the zoomed out map.
+
+The map is drawn into MAP_IMAGE_SIZE pixel square PNGs at zoom levels 0 to
+MAP_IMAGE_ZOOMS - 1, a map tile being 2 ** zoom pixels wide at each level. Image
+(zoom, ix, iy) covers the map tiles with x // span == ix and y // span == iy, span being
+MAP_IMAGE_SIZE // 2 ** zoom. Images are rendered on first request and kept under
+MEDIA_ROOT/map_tiles/<zoom>/<ix>_<iy>.png; a change to a tile only deletes the images
+that show it, and those are rendered again on their next request. Only images within
+the map's extent are served, so requests can't fill the disk with empty images.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, ImageColor, ImageDraw
+
+from .mapcodec import MapSnapshot
+from .models import Tile
+from .pathfinding import TERRAIN_TYPES, get_terrain_grid
+
+# RGB per terrain code, same colours as the interactive tiles
+TERRAIN_RGB = [None] + [ImageColor.getrgb(Tile(terrain=terrain).get_terrain_color()) for terrain in TERRAIN_TYPES]
+
+
+def image_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'map_tiles')
+
+
+def zoom_levels():
+    return range(settings.MAP_IMAGE_ZOOMS)
+
+
+def span(zoom):
+    """Map tiles per image side at a zoom level."""
+    return settings.MAP_IMAGE_SIZE >> zoom
+
+
+def image_path(zoom, ix, iy):
+    return os.path.join(image_dir(), str(zoom), f'{ix}_{iy}.png')
+
+
+def render_image(zoom, ix, iy):
+    """Draw one image from the database; cells without a tile stay transparent."""
+    size = settings.MAP_IMAGE_SIZE
+    cell = 1 << zoom
+    count = span(zoom)
+    snapshot = MapSnapshot.load(ix * count, iy * count, count, count)
+
+    colors = [None] + [ImageColor.getrgb(owner['color']) if owner['color'] else None for owner in snapshot.palette[1:]]
+    bordered = cell >= 4
+
+    # One pixel per map tile first, scaled up afterwards
+    pixels = bytearray(4 * count * count)
+    for index, terrain in enumerate(snapshot.terrain):
+        if not snapshot.tile_ids[index]:
+            continue
+        color = TERRAIN_RGB[terrain] or ImageColor.getrgb('lightgray')
+        owner_color = colors[snapshot.owners[index]]
+        if owner_color and not bordered:
+            # Too small for a border, tint the tile instead
+            color = tuple((c + o) // 2 for c, o in zip(color, owner_color))
+        pixels[4 * index:4 * index + 4] = bytes((*color, 255))
+    image = Image.frombytes('RGBA', (count, count), bytes(pixels))
+    if cell > 1:
+        image = image.resize((size, size), Image.NEAREST)
+
+    if bordered:
+        # Owner border like the interactive tiles
+        draw = ImageDraw.Draw(image)
+        width = max(1, cell // 8)
+        for index, owner in enumerate(snapshot.owners):
+            if owner and colors[owner]:
+                left = index % count * cell
+                top = index // count * cell
+                draw.rectangle((left, top, left + cell - 1, top + cell - 1), outline=colors[owner], width=width)
+    return image
+
+
+def get_image(zoom, ix, iy):
+    """Path of the cached PNG, rendering it first if needed."""
+    path = image_path(zoom, ix, iy)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image = render_image(zoom, ix, iy)
+        # Write next to the target and swap it in, so readers never see half a file
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.png')
+        with os.fdopen(handle, 'wb') as file:
+            image.save(file, 'PNG', optimize=True)
+        os.replace(temporary, path)
+    return path
+
+
+def in_extent(zoom, ix, iy):
+    """Whether image (zoom, ix, iy) shows any part of the map."""
+    grid = get_terrain_grid()
+    if not grid.width:
+        return False
+    count = span(zoom)
+    return (
+        grid.min_x // count <= ix <= (grid.min_x + grid.width - 1) // count
+        and grid.min_y // count <= iy <= (grid.min_y + grid.height - 1) // count
+    )
+
+
+def invalidate_positions(positions):
+    """
+    Delete the cached images showing any of the given (x, y) positions.
+
+    They are deleted once the current transaction commits, so an image rendered meanwhile
+    from the old tiles doesn't outlive the change.
+    """
+    stale = set()
+    for x, y in positions:
+        for zoom in zoom_levels():
+            count = span(zoom)
+            stale.add((zoom, x // count, y // count))
+    transaction.on_commit(lambda: _remove(stale))
+
+
+def _remove(images):
+    for zoom, ix, iy in images:
+        try:
+            os.remove(image_path(zoom, ix, iy))
+        except FileNotFoundError:
+            pass
+
+
+def invalidate_all():
+    """Delete every cached image, e.g. after bulk changes to the map."""
+    for zoom in zoom_levels():
+        directory = os.path.join(image_dir(), str(zoom))
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if name.endswith('.png'):
+                os.remove(os.path.join(directory, name))
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def moving_goods_to_shipments(apps, schema_editor):
+    """Split each tile's moving_goods between the shipments that put them there."""
+    Tile = apps.get_model('game', 'Tile')
+    ProgressAction = apps.get_model('game', 'ProgressAction')
+    Profile = apps.get_model('game', 'Profile')
+    Shipment = apps.get_model('game', 'Shipment')
+
+    names = dict(Profile.objects.values_list('user_id', 'display_name'))
+    pools = {}
+    shipments = []
+    for action in ProgressAction.objects.filter(action_type='move_goods').order_by('id'):
+        details = action.details
+        turn = details.get('turn', 0)
+        if turn <= 0:
+            continue  # Not moved yet, the shipment is created on its first step
+        tile_id = int(details['path'][turn - 1]['tileId'])
+        if tile_id not in pools:
+            tile = Tile.objects.filter(id=tile_id).first()
+            pools[tile_id] = (tile.moving_goods or {}) if tile else {}
+        owned = pools[tile_id].get(names.get(action.user_id), {})
+        quantity = min(details['quantity'], owned.get(details['good'], 0))
+        if quantity <= 0:
+            continue  # Already lost, resolution reports it
+        owned[details['good']] -= quantity
+        shipments.append(Shipment(
+            action=action, owner_id=action.user_id, good=details['good'],
+            quantity=quantity, tile_id=tile_id, step=turn - 1,
+        ))
+    Shipment.objects.bulk_create(shipments, batch_size=500)
+
+
+def shipments_to_moving_goods(apps, schema_editor):
+    Tile = apps.get_model('game', 'Tile')
+    Profile = apps.get_model('game', 'Profile')
+    Shipment = apps.get_model('game', 'Shipment')
+
+    names = dict(Profile.objects.values_list('user_id', 'display_name'))
+    tiles = {}
+    for shipment in Shipment.objects.order_by('id'):
+        moving = tiles.setdefault(shipment.tile_id, {}).setdefault(names.get(shipment.owner_id), {})
+        moving[shipment.good] = moving.get(shipment.good, 0) + shipment.quantity
+    for tile_id, moving_goods in tiles.items():
+        Tile.objects.filter(id=tile_id).update(moving_goods=moving_goods)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('game', '0013_turnjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Shipment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('good', models.CharField(max_length=100)),
+                ('quantity', models.IntegerField()),
+                ('step', models.IntegerField(default=0)),
+                ('action', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='shipment', to='game.progressaction')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shipments', to=settings.AUTH_USER_MODEL)),
+                ('tile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shipments', to='game.tile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tile', 'owner'], name='game_shipme_tile_id_d5aa3c_idx')],
+            },
+        ),
+        migrations.RunPython(moving_goods_to_shipments, shipments_to_moving_goods),
+        migrations.RemoveField(
+            model_name='tile',
+            name='moving_goods',
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0014_shipment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TurnReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game_date', models.DateField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('seconds', models.FloatField(default=0)),
+                ('queries', models.IntegerField(default=0)),
+                ('query_seconds', models.FloatField(default=0)),
+                ('phases', models.JSONField(default=dict)),
+                ('actions', models.JSONField(default=dict)),
+                ('rows_written', models.JSONField(default=dict)),
+                ('summary', models.JSONField(default=dict)),
+                ('workers', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Turn Report',
+                'verbose_name_plural': 'Turn Reports',
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_turnreport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('reason', models.CharField(blank=True, default='', max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MapChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tile_id', models.BigIntegerField()),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='game.mapversion')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def drop_zero_goods(apps, schema_editor):
+    """Tiles used to hold every good, most at 0; keep only the goods they actually have."""
+    Tile = apps.get_model('game', 'Tile')
+    changed = []
+    for tile in Tile.objects.only('id', 'goods').iterator(chunk_size=2000):
+        goods = {name: quantity for name, quantity in (tile.goods or {}).items() if quantity}
+        if goods != tile.goods:
+            tile.goods = goods
+            changed.append(tile)
+        if len(changed) >= 2000:
+            Tile.objects.bulk_update(changed, ['goods'])
+            changed = []
+    Tile.objects.bulk_update(changed, ['goods'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_mapversion'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_zero_goods, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def goods_to_inventory(apps, schema_editor):
+    """One TileInventory row per good a tile holds; goods not in UniversalGoods are added."""
+    Tile = apps.get_model('game', 'Tile')
+    UniversalGoods = apps.get_model('game', 'UniversalGoods')
+    TileInventory = apps.get_model('game', 'TileInventory')
+
+    goods = dict(UniversalGoods.objects.values_list('name', 'id'))
+    rows = []
+    for tile_id, tile_goods in Tile.objects.values_list('id', 'goods').iterator(chunk_size=2000):
+        for name, quantity in (tile_goods or {}).items():
+            if not quantity:
+                continue
+            if name not in goods:
+                goods[name] = UniversalGoods.objects.create(name=name).id
+            rows.append(TileInventory(tile_id=tile_id, good_id=goods[name], quantity=quantity))
+        if len(rows) >= 2000:
+            TileInventory.objects.bulk_create(rows)
+            rows = []
+    TileInventory.objects.bulk_create(rows)
+
+
+def inventory_to_goods(apps, schema_editor):
+    Tile = apps.get_model('game', 'Tile')
+    TileInventory = apps.get_model('game', 'TileInventory')
+
+    tiles = {}
+    for tile_id, name, quantity in TileInventory.objects.values_list('tile_id', 'good__name', 'quantity'):
+        tiles.setdefault(tile_id, {})[name] = quantity
+    for tile_id, goods in tiles.items():
+        Tile.objects.filter(id=tile_id).update(goods=goods)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0017_sparse_goods'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('good', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='game.universalgoods')),
+                ('tile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='game.tile')),
+            ],
+            options={
+                'verbose_name': 'Tile Inventory',
+                'verbose_name_plural': 'Tile Inventories',
+                'indexes': [models.Index(fields=['good', 'tile'], name='game_tilein_good_id_9d31cd_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tileinventory',
+            constraint=models.UniqueConstraint(fields=('tile', 'good'), name='unique_tile_good'),
+        ),
+        migrations.RunPython(goods_to_inventory, inventory_to_goods),
+        migrations.RemoveField(
+            model_name='tile',
+            name='goods',
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def compute_stats(apps, schema_editor):
+    """Same as PlayerStats.rebuild(), which historical models don't have."""
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Tile = apps.get_model('game', 'Tile')
+    TileInventory = apps.get_model('game', 'TileInventory')
+    PlayerStats = apps.get_model('game', 'PlayerStats')
+
+    stats = {user_id: PlayerStats(user_id=user_id, goods={}) for user_id in User.objects.values_list('id', flat=True)}
+    for owner_id, count, population in Tile.objects.exclude(owner=None).values_list('owner_id').annotate(
+            models.Count('id'), models.Sum('population')).order_by():
+        stats[owner_id].tiles = count
+        stats[owner_id].population = population or 0
+    for owner_id, name, quantity in TileInventory.objects.exclude(tile__owner=None).values_list(
+            'tile__owner_id', 'good__name').annotate(models.Sum('quantity')).order_by():
+        if quantity:
+            stats[owner_id].goods[name] = quantity
+    PlayerStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('game', '0018_tileinventory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('tiles', models.IntegerField(default=0)),
+                ('population', models.IntegerField(default=0)),
+                ('goods', models.JSONField(default=dict)),
+            ],
+            options={
+                'verbose_name': 'Player Stats',
+                'verbose_name_plural': 'Player Stats',
+            },
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0019_playerstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapversion',
+            name='everything',
+            field=models.BooleanField(default=False),
+        ),
+    ]
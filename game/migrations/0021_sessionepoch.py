@@ -0,0 +1,21 @@
+# Generated by Django 4.2.17 on 2026-10-18 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0020_mapversion_everything'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionEpoch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField(default=0)),
+                ('changed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.17 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0021_sessionepoch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tile',
+            index=models.Index(fields=['x', 'y'], name='game_tile_x_13225e_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.17 on 2026-10-18 20:40
+
+from django.db import migrations
+
+
+def turn_to_column(apps, schema_editor):
+    """Move the turn kept in ProgressAction.details into the turn column."""
+    ProgressAction = apps.get_model('game', 'ProgressAction')
+    actions = []
+    for action in ProgressAction.objects.iterator(chunk_size=2000):
+        action.turn = action.details.pop('turn', action.turn)
+        actions.append(action)
+    ProgressAction.objects.bulk_update(actions, ['turn', 'details'], batch_size=500)
+
+
+def turn_to_details(apps, schema_editor):
+    ProgressAction = apps.get_model('game', 'ProgressAction')
+    actions = []
+    for action in ProgressAction.objects.iterator(chunk_size=2000):
+        action.details['turn'] = action.turn
+        actions.append(action)
+    ProgressAction.objects.bulk_update(actions, ['details'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0022_tile_position_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(turn_to_column, turn_to_details),
+    ]
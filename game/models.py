@@ -1,7 +1,11 @@
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
+from .events import publish_on_commit
 import random
 from datetime import date
 
@@ -21,7 +25,12 @@ class Profile(models.Model):
         return f'#{random.randint(0, 0xFFFFFF):06x}'
 
 class UniversalGoods(models.Model):
-    """A model to store all available goods."""
+    """
+    A model to store all available goods.
+
+    Tiles store goods sparsely in TileInventory: only goods a tile holds have a row and a
+    missing row means zero, so adding a good doesn't touch any tile.
+    """
     class Meta:
         verbose_name = "Universal Good"
         verbose_name_plural = "Universal Goods"
@@ -33,6 +42,9 @@ class UniversalGoods(models.Model):
 
 # Tile model
 class Tile(models.Model):
+    class Meta:
+        indexes = [models.Index(fields=['x', 'y'])]  # Viewport and chunk queries
+
     x = models.IntegerField()
     y = models.IntegerField()
     owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="tiles")
@@ -51,24 +63,35 @@ class Tile(models.Model):
         ],
         default='plains'
     )
-    goods = models.JSONField(default=dict)  # e.g., {"iron": 30, "wood": 0}
-    moving_goods = models.JSONField(default=dict, blank=True, null=True)  # Handle moving goods
 
-    def add_good(self, good_name):
-        # Ensure that the good exists in UniversalGoods
-        good, created = UniversalGoods.objects.get_or_create(name=good_name)
+    @property
+    def goods(self):
+        """Goods held as {name: quantity}; prefetch_related('inventory__good') when listing tiles."""
+        if self.pk is None:
+            return {}
+        return {row.good.name: row.quantity for row in self.inventory.all()}
 
-        # If the good wasn't already in the tile's goods list, add it with 0 quantity
-        if good_name not in self.goods:
-            self.goods[good_name] = 0
-            self.save()
+    def set_goods(self, goods):
+        """Replace the goods held with {name: quantity}, creating unknown goods."""
+        goods = {name: quantity for name, quantity in goods.items() if quantity}
+        if self.owner_id:
+            held = dict(self.inventory.values_list('good__name', 'quantity'))
+            changes = {name: goods.get(name, 0) - held.get(name, 0) for name in goods.keys() | held.keys()}
+            PlayerStats.add({self.owner_id: {'goods': changes}})
+        UniversalGoods.objects.bulk_create([UniversalGoods(name=name) for name in goods], ignore_conflicts=True)
+        ids = dict(UniversalGoods.objects.filter(name__in=goods).values_list('name', 'id'))
+        self.inventory.exclude(good_id__in=ids.values()).delete()
+        TileInventory.objects.bulk_create(
+            [TileInventory(tile=self, good_id=ids[name], quantity=quantity) for name, quantity in goods.items()],
+            update_conflicts=True, unique_fields=['tile', 'good'], update_fields=['quantity'],
+        )
+
+    def add_good(self, good_name):
+        # Ensure that the good exists in UniversalGoods; the tile holds 0 of it until it gets some
+        UniversalGoods.objects.get_or_create(name=good_name)
 
     def remove_good(self, good_name):
-        goods = self.goods  # assuming goods is a dictionary
-        if good_name in goods:
-            del goods[good_name]
-            self.goods = goods  # Update the tile's goods field
-            self.save()  # Save the tile after modification
+        self.inventory.filter(good__name=good_name).delete()
 
     def get_terrain_color(self):
         if self.terrain == 'fields':
@@ -92,6 +115,51 @@ class Tile(models.Model):
     def __str__(self):
         return f"Tile ({self.x}, {self.y})"
 
+# Goods held on a tile, one row per tile and good it holds
+class TileInventory(models.Model):
+    class Meta:
+        verbose_name = "Tile Inventory"
+        verbose_name_plural = "Tile Inventories"
+        constraints = [models.UniqueConstraint(fields=['tile', 'good'], name='unique_tile_good')]
+        indexes = [models.Index(fields=['good', 'tile'])]
+
+    tile = models.ForeignKey(Tile, on_delete=models.CASCADE, related_name='inventory')
+    good = models.ForeignKey(UniversalGoods, on_delete=models.CASCADE, related_name='inventory')
+    quantity = models.IntegerField(default=0)
+
+    @staticmethod
+    def totals(good=None, owner=None, limit=None):
+        """
+        Quantity held on owned tiles per owner and good, computed by the database.
+
+        Returns up to `limit` rows of {'owner', 'display', 'good_name', 'total'}, biggest
+        first; filter with a good name and/or an owner id.
+        """
+        rows = TileInventory.objects.exclude(tile__owner=None)
+        if good is not None:
+            rows = rows.filter(good__name=good)
+        if owner is not None:
+            rows = rows.filter(tile__owner_id=owner)
+        rows = (
+            rows.values(owner=models.F('tile__owner_id'), display=models.F('tile__owner__profile__display_name'),
+                        good_name=models.F('good__name'))
+            .annotate(total=models.Sum('quantity'))
+            .order_by('-total', 'good_name', 'owner')
+        )
+        return list(rows[:limit] if limit else rows)
+
+    @staticmethod
+    def good_totals():
+        """Quantity of each good on the whole map and the number of tiles holding it."""
+        return list(
+            TileInventory.objects.values(good_name=models.F('good__name'))
+            .annotate(total=models.Sum('quantity'), tiles=models.Count('tile'))
+            .order_by('good_name')
+        )
+
+    def __str__(self):
+        return f"{self.quantity} {self.good} at {self.tile}"
+
 class QueuedAction(models.Model):
     class Meta:
         verbose_name = "Queued Action"
@@ -111,8 +179,37 @@ class QueuedAction(models.Model):
 class ProgressAction(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     action_type = models.CharField(max_length=50)
-    details = models.JSONField()  # Includes 'turn' initialized at 0
-    turn = models.IntegerField(default=0)  # Tracks progress
+    details = models.JSONField()  # The queued action's details, written once
+    turn = models.IntegerField(default=0)  # Steps taken along details['path']
+
+# Goods in transit, one row per moving shipment
+class Shipment(models.Model):
+    action = models.OneToOneField(ProgressAction, on_delete=models.CASCADE, related_name='shipment')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shipments')
+    good = models.CharField(max_length=100)
+    quantity = models.IntegerField()
+    tile = models.ForeignKey(Tile, on_delete=models.CASCADE, related_name='shipments')  # Where the goods are now
+    step = models.IntegerField(default=0)  # Index of tile in the action's path
+
+    class Meta:
+        indexes = [models.Index(fields=['tile', 'owner'])]
+
+    @staticmethod
+    def in_transit(tile_ids=None):
+        """Goods in transit per tile as {tile_id: {display_name: {good: quantity}}}."""
+        shipments = Shipment.objects.all()
+        if tile_ids is not None:
+            shipments = shipments.filter(tile_id__in=tile_ids)
+        rows = shipments.values('tile_id', 'owner__profile__display_name', 'good').annotate(total=models.Sum('quantity'))
+        result = {}
+        for row in rows.order_by():
+            if row['total'] > 0:
+                tile = result.setdefault(row['tile_id'], {})
+                tile.setdefault(row['owner__profile__display_name'], {})[row['good']] = row['total']
+        return result
+
+    def __str__(self):
+        return f"{self.quantity} {self.good} at {self.tile}"
 
 # Status report on actions
 class StatusAction(models.Model):
@@ -122,24 +219,245 @@ class StatusAction(models.Model):
     completion_date = models.DateField()  # Log the date of completion
 
 
+# End of turn resolution running outside the request cycle
+class TurnJob(models.Model):
+    class Meta:
+        verbose_name = "Turn Job"
+        verbose_name_plural = "Turn Jobs"
+        ordering = ['-created']
+
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    phase = models.CharField(max_length=50, blank=True, default='')  # e.g., "shipments"
+    processed = models.IntegerField(default=0)  # Actions handled in the current phase
+    total = models.IntegerField(default=0)  # Actions to handle in the current phase
+    end_turn = models.BooleanField(default=False)  # Log users out once resolved
+    summary = models.JSONField(default=dict, blank=True)  # Counts returned by resolve_turn
+    error = models.TextField(blank=True, default='')
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def elapsed(self):
+        """Seconds spent resolving so far (or in total once finished)."""
+        if not self.started:
+            return 0
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    def __str__(self):
+        return f"Turn job {self.id} ({self.status})"
+
+
+# Timings and counts recorded while resolving a turn
+class TurnReport(models.Model):
+    class Meta:
+        verbose_name = "Turn Report"
+        verbose_name_plural = "Turn Reports"
+        ordering = ['-created']
+
+    game_date = models.DateField()  # Date the turn resolved
+    created = models.DateTimeField(auto_now_add=True)
+    seconds = models.FloatField(default=0)  # Wall time of the whole turn
+    queries = models.IntegerField(default=0)
+    query_seconds = models.FloatField(default=0)
+    phases = models.JSONField(default=dict)  # {phase: {"seconds": 0.1, "queries": 3, "query_seconds": 0.01}}
+    actions = models.JSONField(default=dict)  # Actions handled per type, e.g. {"move_goods": 10}
+    rows_written = models.JSONField(default=dict)  # Rows created/updated/deleted per model
+    summary = models.JSONField(default=dict)  # Counts returned by resolve_turn
+    workers = models.IntegerField(default=0)  # TURN_RESOLUTION_WORKERS used
+
+    def __str__(self):
+        return f"Turn report for {self.game_date} ({self.seconds:.2f}s)"
+
+
+# Map versions, so clients can fetch only the tiles changed since the version they have
+class MapVersion(models.Model):
+    created = models.DateTimeField(auto_now_add=True)
+    reason = models.CharField(max_length=50, blank=True, default='')  # e.g., "turn"
+    everything = models.BooleanField(default=False)  # Too many changes to list, clients reload
+
+    @classmethod
+    def current(cls):
+        return cls.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    @classmethod
+    def record(cls, tile_ids, reason=''):
+        """Start a new version listing the given tiles as changed; returns it (None if no tiles)."""
+        tile_ids = set(tile_ids)
+        if not tile_ids:
+            return None
+        version = cls.objects.create(reason=reason)
+        MapChange.objects.bulk_create(
+            [MapChange(version=version, tile_id=tile_id) for tile_id in tile_ids], batch_size=500,
+        )
+        publish_on_commit({'type': 'map', 'version': version.id})
+        return version
+
+    @classmethod
+    def record_all(cls, reason=''):
+        """Start a new version after which every client reloads the whole map."""
+        version = cls.objects.create(reason=reason, everything=True)
+        publish_on_commit({'type': 'map', 'version': version.id})
+        return version
+
+    @classmethod
+    def prune(cls):
+        """Forget all but the newest MAP_VERSIONS_KEPT versions; clients that far behind reload the map."""
+        cutoff = cls.objects.order_by('-id').values_list('id', flat=True)[
+            settings.MAP_VERSIONS_KEPT:settings.MAP_VERSIONS_KEPT + 1].first()
+        if cutoff is None:
+            return 0
+        return cls.objects.filter(id__lte=cutoff).delete()[1].get('game.MapVersion', 0)
+
+    @classmethod
+    def changed_since(cls, version):
+        """Ids of the tiles changed after a version, or None if the client has to reload."""
+        oldest = cls.objects.order_by('id').values_list('id', flat=True).first()
+        if oldest is not None and oldest > version + 1:
+            return None
+        if cls.objects.filter(id__gt=version, everything=True).exists():
+            return None
+        return set(MapChange.objects.filter(version_id__gt=version).values_list('tile_id', flat=True))
+
+    def __str__(self):
+        return f"Map version {self.id}"
+
+
+class MapChange(models.Model):
+    version = models.ForeignKey(MapVersion, on_delete=models.CASCADE, related_name='changes')
+    tile_id = models.BigIntegerField()  # Not a foreign key, deleted tiles are changes too
+
+
+# Logging everybody out at the end of a turn: sessions remember the epoch they were
+# started in and SessionEpochMiddleware ends those from an older one, so one UPDATE
+# logs out every player
+class SessionEpoch(models.Model):
+    number = models.IntegerField(default=0)
+    changed = models.DateTimeField(auto_now=True)
+
+    CACHE_KEY = 'game:session-epoch'
+
+    @classmethod
+    def current(cls):
+        """The current epoch, cached for SESSION_EPOCH_CACHE_SECONDS."""
+        number = cache.get(cls.CACHE_KEY)
+        if number is None:
+            number = cls.objects.filter(pk=1).values_list('number', flat=True).first() or 0
+            cache.set(cls.CACHE_KEY, number, settings.SESSION_EPOCH_CACHE_SECONDS)
+        return number
+
+    @classmethod
+    def bump(cls):
+        """Start a new epoch, ending every session of a non-staff player; returns its number."""
+        epoch, created = cls.objects.get_or_create(pk=1)
+        cls.objects.filter(pk=1).update(number=models.F('number') + 1, changed=timezone.now())
+        cache.delete(cls.CACHE_KEY)
+        return epoch.number + 1
+
+    def __str__(self):
+        return f"Session epoch {self.number}"
+
+
+# Totals per player, kept up to date with deltas so pages don't have to sum over tiles
+class PlayerStats(models.Model):
+    class Meta:
+        verbose_name = "Player Stats"
+        verbose_name_plural = "Player Stats"
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    tiles = models.IntegerField(default=0)  # Tiles owned
+    population = models.IntegerField(default=0)  # Population of the tiles owned
+    goods = models.JSONField(default=dict)  # Goods held on the tiles owned, e.g. {"iron": 30}
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Apply changes given as {user_id: {'tiles': 1, 'population': 5, 'goods': {'iron': -3}}}.
+
+        Every key is optional and user_id None (unowned tiles) is skipped. Returns the number
+        of rows written.
+        """
+        deltas = {user_id: delta for user_id, delta in deltas.items() if user_id is not None}
+        if not deltas:
+            return 0
+        with transaction.atomic():
+            stats = cls.objects.select_for_update().in_bulk(list(deltas))
+            created = []
+            for user_id, delta in deltas.items():
+                row = stats.get(user_id)
+                if row is None:
+                    # Users get their row with their first tile
+                    row = cls(user_id=user_id)
+                    created.append(row)
+                row.tiles += delta.get('tiles', 0)
+                row.population += delta.get('population', 0)
+                for name, quantity in delta.get('goods', {}).items():
+                    total = row.goods.get(name, 0) + quantity
+                    if total:
+                        row.goods[name] = total
+                    else:
+                        row.goods.pop(name, None)
+            cls.objects.bulk_create(created)
+            cls.objects.bulk_update(list(stats.values()), ['tiles', 'population', 'goods'], batch_size=500)
+        return len(deltas)
+
+    @classmethod
+    def rebuild(cls, user_ids=None):
+        """Recompute the stats from the tiles, for the given users or everybody; returns rows written."""
+        users = User.objects.all()
+        tiles = Tile.objects.exclude(owner=None)
+        inventory = TileInventory.objects.exclude(tile__owner=None)
+        if user_ids is not None:
+            users = users.filter(id__in=user_ids)
+            tiles = tiles.filter(owner_id__in=user_ids)
+            inventory = inventory.filter(tile__owner_id__in=user_ids)
+
+        stats = {user_id: cls(user_id=user_id) for user_id in users.values_list('id', flat=True)}
+        for owner_id, count, population in tiles.values_list('owner_id').annotate(
+                models.Count('id'), models.Sum('population')).order_by():
+            stats[owner_id].tiles = count
+            stats[owner_id].population = population or 0
+        for owner_id, name, quantity in inventory.values_list('tile__owner_id', 'good__name').annotate(
+                models.Sum('quantity')).order_by():
+            if quantity:
+                stats[owner_id].goods[name] = quantity
+
+        with transaction.atomic():
+            existing = cls.objects.all() if user_ids is None else cls.objects.filter(user_id__in=user_ids)
+            existing.delete()
+            cls.objects.bulk_create(stats.values(), batch_size=500)
+        return len(stats)
+
+    @classmethod
+    def for_user(cls, user):
+        try:
+            return cls.objects.get(user=user)
+        except cls.DoesNotExist:
+            cls.rebuild([user.id])
+            return cls.objects.get(user=user)
+
+    def __str__(self):
+        return f"Stats of {self.user}"
+
+
 class GameDate(models.Model):
     current_date = models.DateField(default=date(1100, 1, 1))  # Default start: January 1, 1100
 
     def __str__(self):
         return self.current_date.strftime('%B %d, %Y')
 
-# Receiver to handle adding goods to all tiles
-@receiver(post_save, sender=UniversalGoods)
-def add_good_to_tiles(sender, instance, created, **kwargs):
-    if created:  # Only run when a new good is added
-        good_name = instance.name
-        for tile in Tile.objects.all():
-            tile.add_good(good_name)
-
-
-# Receiver to handle removing goods from all tiles
-@receiver(post_delete, sender=UniversalGoods)
+# Deleting a good deletes its TileInventory rows in one cascaded DELETE; record the tiles
+# that held it as map changes first. Adding a good needs nothing, tiles without a row hold none.
+@receiver(pre_delete, sender=UniversalGoods)
 def remove_good_from_tiles(sender, instance, **kwargs):
-    good_name = instance.name
-    for tile in Tile.objects.all():
-        tile.remove_good(good_name)
+    MapVersion.record(instance.inventory.values_list('tile_id', flat=True), reason='goods')
+    held = instance.inventory.exclude(tile__owner=None).values_list('tile__owner_id').annotate(models.Sum('quantity'))
+    PlayerStats.add({owner_id: {'goods': {instance.name: -quantity}} for owner_id, quantity in held.order_by()})
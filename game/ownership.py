@@ -0,0 +1,76 @@
+"""
+Per-player index of owned tiles, kept in Django's cache.
+
+Each player's tile ids are cached as a sorted array of 64-bit ints (8 bytes a tile),
+looked up with bisect, so ownership checks don't touch the database once a player's
+index is loaded. Loading it is one query. The signals in signals.py drop the index of
+both players when a tile changes hands or is deleted, once the transaction commits;
+bulk changes bypassing signals call invalidate_all().
+
+The default cache is per process: another process may answer from its copy for up to
+OWNERSHIP_CACHE_SECONDS after a change. Use a shared cache (Redis, Memcached) for
+changes to show everywhere at once, sized to hold an entry per active player.
+"""
+from array import array
+from bisect import bisect_left
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Tile
+
+GENERATION_KEY = 'game:owned:generation'
+
+
+def _key(user_id):
+    # A new generation on invalidate_all() orphans every player's entry at once. Generations
+    # are random, so if the cache evicts this key no old entries become valid again.
+    generation = cache.get_or_set(GENERATION_KEY, _new_generation, None)
+    return f'game:owned:{generation}:{user_id}'
+
+
+def _new_generation():
+    return uuid4().hex
+
+
+def owned_tiles(user_id):
+    """Sorted array of the ids of the tiles user_id owns."""
+    key = _key(user_id)
+    data = cache.get(key)
+    if data is None:
+        ids = array('q', Tile.objects.filter(owner_id=user_id).order_by('id').values_list('id', flat=True))
+        data = ids.tobytes()
+        cache.set(key, data, settings.OWNERSHIP_CACHE_SECONDS)
+    ids = array('q')
+    ids.frombytes(data)
+    return ids
+
+
+def _contains(ids, tile_id):
+    i = bisect_left(ids, tile_id)
+    return i < len(ids) and ids[i] == tile_id
+
+
+def owns(user_id, tile_id):
+    """Whether user_id owns the tile."""
+    return _contains(owned_tiles(user_id), int(tile_id))
+
+
+def owned_among(user_id, tile_ids):
+    """The ids among tile_ids of tiles user_id owns."""
+    ids = owned_tiles(user_id)
+    return {tile_id for tile_id in map(int, tile_ids) if _contains(ids, tile_id)}
+
+
+def invalidate(*user_ids):
+    """Drop the index of these players when the current transaction commits."""
+    keys = [user_id for user_id in user_ids if user_id is not None]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many([_key(user_id) for user_id in keys]))
+
+
+def invalidate_all():
+    """Drop every player's index, after changes that bypassed the signals."""
+    cache.set(GENERATION_KEY, _new_generation(), None)
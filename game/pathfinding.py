@@ -1,5 +1,13 @@
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from heapq import heappush, heappop
+from itertools import repeat
 from math import inf
+import threading
+
+from django.conf import settings
+from django.db.models import Max, Min
 
 TERRAIN_COSTS = {
     'plains': 1,
@@ -10,28 +18,324 @@ TERRAIN_COSTS = {
     'city': 1,
 }
 
+# Terrain types in code order; the grid stores terrain as index + 1 (0 means "no tile")
+TERRAIN_TYPES = list(TERRAIN_COSTS)
+
+# Neighbour order matters for tie-breaking, keep it stable
+NEIGHBOR_OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+class TerrainGrid:
+    """
+    Process-wide terrain grid for the whole map.
+
+    Terrain codes, movement costs and tile ids live in flat arrays indexed by
+    (y - min_y) * width + (x - min_x), so pathfinding never has to hit the database.
+    The grid is loaded lazily and patched from the Tile post_save/post_delete signals.
+    Bulk writes (bulk_create, queryset.update) bypass those signals and must call
+    invalidate() themselves.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.version = 0  # Bumped whenever the terrain of any tile changes
+        self.min_x = 0
+        self.min_y = 0
+        self.width = 0
+        self.height = 0
+        self.terrain = array('B')
+        self.costs = array('B')
+        self.tile_ids = array('q')
+        self.positions = {}  # tileId -> (x, y)
+        self.listeners = []  # Called with the changed array index, or None after a reload
+
+    def __getstate__(self):
+        # Sent to route matrix worker processes: arrays only, no lock or listeners
+        state = self.__dict__.copy()
+        del state['lock']
+        state['listeners'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def _notify(self, index):
+        for listener in self.listeners:
+            listener(index)
+
+    def load(self):
+        """(Re)build the grid from the Tile table."""
+        # Imported here so worker processes can unpickle a grid without the app registry
+        from .models import Tile
+
+        with self.lock:
+            bounds = Tile.objects.aggregate(
+                min_x=Min('x'), max_x=Max('x'),
+                min_y=Min('y'), max_y=Max('y'),
+            )
+            if bounds['min_x'] is None:
+                self._allocate(0, 0, 0, 0)
+            else:
+                self._allocate(
+                    bounds['min_x'], bounds['min_y'],
+                    bounds['max_x'] - bounds['min_x'] + 1,
+                    bounds['max_y'] - bounds['min_y'] + 1,
+                )
+                rows = Tile.objects.values_list('id', 'x', 'y', 'terrain').iterator(chunk_size=10000)
+                for tile_id, x, y, terrain in rows:
+                    self._set(self.index(x, y), tile_id, x, y, terrain)
+            self.loaded = True
+            self.version += 1
+            self._notify(None)
+
+    def _allocate(self, min_x, min_y, width, height):
+        size = width * height
+        self.min_x = min_x
+        self.min_y = min_y
+        self.width = width
+        self.height = height
+        self.terrain = array('B', bytes(size))
+        self.costs = array('B', bytes(size))
+        self.tile_ids = array('q', bytes(8 * size))
+        self.positions = {}
+
+    def _set(self, index, tile_id, x, y, terrain):
+        code = TERRAIN_TYPES.index(terrain) + 1 if terrain in TERRAIN_COSTS else 0
+        self.terrain[index] = code
+        self.costs[index] = TERRAIN_COSTS[terrain] if code else 0
+        self.tile_ids[index] = tile_id
+        self.positions[tile_id] = (x, y)
+
+    def _clear(self, index):
+        tile_id = self.tile_ids[index]
+        self.terrain[index] = 0
+        self.costs[index] = 0
+        self.tile_ids[index] = 0
+        self.positions.pop(tile_id, None)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def invalidate(self):
+        """Drop the grid; it is reloaded on next use."""
+        with self.lock:
+            self.loaded = False
+            self.version += 1
+            self._notify(None)
+
+    def index(self, x, y):
+        """Return the flat array index for (x, y), or None if it is outside the grid."""
+        x -= self.min_x
+        y -= self.min_y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return None
+
+    def contains(self, pos):
+        index = self.index(pos[0], pos[1])
+        return index is not None and self.tile_ids[index] != 0
+
+    def cost_at(self, pos):
+        """Movement cost of entering pos (KeyError if there is no tile there)."""
+        index = self.index(pos[0], pos[1])
+        if index is None or not self.costs[index]:
+            raise KeyError(pos)
+        return self.costs[index]
+
+    def tile_id_at(self, pos):
+        index = self.index(pos[0], pos[1])
+        if index is None or not self.tile_ids[index]:
+            raise KeyError(pos)
+        return self.tile_ids[index]
+
+    def update_tile(self, tile_id, x, y, terrain):
+        """Patch a single saved tile into the grid."""
+        with self.lock:
+            if not self.loaded:
+                return
+            old_pos = self.positions.get(tile_id)
+            index = self.index(x, y)
+            if index is None:
+                # Outside the current bounds, the grid has to be resized
+                self.invalidate()
+                return
+
+            changed = old_pos != (x, y)
+            if old_pos is not None and changed:
+                old_index = self.index(*old_pos)
+                self._clear(old_index)
+                self._notify(old_index)
+            if self.tile_ids[index] and self.tile_ids[index] != tile_id:
+                self._clear(index)
+
+            old_code = self.terrain[index]
+            self._set(index, tile_id, x, y, terrain)
+            if changed or old_code != self.terrain[index]:
+                self.version += 1
+                self._notify(index)
+
+    def remove_tile(self, tile_id):
+        """Remove a deleted tile from the grid."""
+        with self.lock:
+            if not self.loaded:
+                return
+            pos = self.positions.get(tile_id)
+            if pos is not None:
+                index = self.index(*pos)
+                self._clear(index)
+                self.version += 1
+                self._notify(index)
+
+
+terrain_grid = TerrainGrid()
+
+
+def get_terrain_grid():
+    """Return the process-wide terrain grid, loading it from the database on first use."""
+    terrain_grid.ensure_loaded()
+    return terrain_grid
+
+
+class PathCache:
+    """
+    Bounded LRU cache for find_path results.
+
+    Keys include the terrain grid version, so a terrain change makes every older
+    entry unreachable; those entries simply age out of the LRU order.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """Counters used to size the cache."""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+path_cache = PathCache(getattr(settings, 'PATH_CACHE_SIZE', 1024))
+
+
+def plan_path(start, goal, speed=2):
+    """
+    Return (path, time) from start to goal, served from the path cache when possible.
+
+    Short routes are searched within the bounding box of start and goal (plus a one tile
+    margin), and with the hierarchical engine if the box holds no route. Routes longer
+    than HIERARCHICAL_PATH_DISTANCE always use the hierarchical engine. The path is empty
+    if goal can't be reached. The returned path is shared with the cache and must not be
+    modified.
+    """
+    grid = get_terrain_grid()
+    key = (start, goal, speed, grid.version)
+    result = path_cache.get(key)
+    if result is not None:
+        return result
+    if chebyshev_distance(start, goal) <= getattr(settings, 'HIERARCHICAL_PATH_DISTANCE', 64):
+        bounds = (
+            min(start[0], goal[0]) - 1,
+            min(start[1], goal[1]) - 1,
+            max(start[0], goal[0]) + 1,
+            max(start[1], goal[1]) + 1,
+        )
+        result = find_path(start, goal, grid, speed, bounds=bounds)
+    if (not result or not result[0]) and grid.contains(start) and grid.contains(goal):
+        # Long, or the way round leaves the box
+        from .hierarchical import hierarchical_pathfinder
+        result = hierarchical_pathfinder.find_path(start, goal, speed)
+    path_cache.put(key, result)
+    return result
+
+
 def chebyshev_distance(start, goal):
     """Calculate Chebyshev distance between two points."""
     return max(abs(start[0] - goal[0]), abs(start[1] - goal[1]))
 
-def find_path(start, goal, terrain_data, tile_mapping, speed=2):
+
+def find_path(start, goal, grid, speed=2, bounds=None, allowed=None):
     """
     Find the path using A* and calculate movement costs dynamically.
 
     Args:
         start: Tuple (x, y) of start position.
         goal: Tuple (x, y) of goal position.
-        terrain_data: Dictionary mapping (x, y) -> terrain type.
-        tile_mapping: Dictionary mapping (x, y) -> tileId.
+        grid: TerrainGrid to search.
         speed: Movement budget per turn.
+        bounds: Optional (min_x, min_y, max_x, max_y) box the search may not leave.
+        allowed: Optional callable (x, y) -> bool restricting the tiles the search may use.
 
     Returns:
         A tuple (formatted_path, cost) where formatted_path is a list of tile dictionaries,
-        and cost is the monetary cost based on the length of the path.
+        and cost is the monetary cost based on the length of the path. Both are empty
+        ([], 0) if goal can't be reached.
     """
-    # Handle adjacent tiles directly
+    # Handle adjacent tiles directly: one stop, one turn (turn resolution expects a stop per turn)
     if chebyshev_distance(start, goal) == 1:
-        return [{"tileId": tile_mapping[goal], "x": goal[0], "y": goal[1]}], TERRAIN_COSTS[terrain_data[goal]]
+        return [{"tileId": grid.tile_id_at(goal), "x": goal[0], "y": goal[1]}], 1
+
+    path = search_path(start, goal, grid, bounds, allowed)
+    if path is None:
+        return [], 0
+    return format_path(path, goal, grid, speed)
+
+
+def search_path(start, goal, grid, bounds=None, allowed=None):
+    """
+    A* search on the terrain grid.
+
+    Returns the tiles after start up to and including goal, or None if goal can't be
+    reached. See find_path for the arguments.
+    """
+    if bounds is None:
+        bounds = (grid.min_x, grid.min_y, grid.min_x + grid.width - 1, grid.min_y + grid.height - 1)
+    min_x = max(bounds[0], grid.min_x)
+    min_y = max(bounds[1], grid.min_y)
+    max_x = min(bounds[2], grid.min_x + grid.width - 1)
+    max_y = min(bounds[3], grid.min_y + grid.height - 1)
+    costs = grid.costs
+    width = grid.width
+    origin_x = grid.min_x
+    origin_y = grid.min_y
 
     # A* algorithm setup
     open_set = []
@@ -45,26 +349,30 @@ def find_path(start, goal, terrain_data, tile_mapping, speed=2):
         if current == goal:
             break
 
-        # Generate all 8 possible neighbors (diagonal + orthogonal)
-        neighbors = [
-            (current[0] + dx, current[1] + dy)
-            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
-        ]
-
-        for neighbor in neighbors:
-            if neighbor not in terrain_data:
+        current_g = g_score[current]
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx = current[0] + dx
+            ny = current[1] + dy
+            if nx < min_x or nx > max_x or ny < min_y or ny > max_y:
                 continue  # Ignore out-of-bound tiles.
 
-            terrain = terrain_data[neighbor]
-            terrain_cost = TERRAIN_COSTS.get(terrain, inf)
+            terrain_cost = costs[(ny - origin_y) * width + (nx - origin_x)]
+            if not terrain_cost:
+                continue  # No tile here.
+            if allowed is not None and not allowed(nx, ny):
+                continue
 
             # Calculate the g_score
-            tentative_g_score = g_score[current] + terrain_cost
+            neighbor = (nx, ny)
+            tentative_g_score = current_g + terrain_cost
 
             if tentative_g_score < g_score.get(neighbor, inf):
                 came_from[neighbor] = current
                 g_score[neighbor] = tentative_g_score
-                heappush(open_set, (g_score[neighbor] + chebyshev_distance(neighbor, goal), neighbor))
+                heappush(open_set, (tentative_g_score + chebyshev_distance(neighbor, goal), neighbor))
+
+    if goal != start and goal not in came_from:
+        return None
 
     # Reconstruct path
     path = []
@@ -73,19 +381,150 @@ def find_path(start, goal, terrain_data, tile_mapping, speed=2):
         path.append(current)
         current = came_from[current]
     path.reverse()
+    return path
+
+
+def dijkstra(source, grid, speed=2, max_turns=None):
+    """
+    Dijkstra from source over the terrain grid.
+
+    Yields (pos, turns, cost, parent) for every reachable tile (source excluded) in order of
+    increasing cost. turns is counted the same way find_path counts the time of a route,
+    cost is the summed terrain cost of the cheapest route and parent is the previous tile
+    on that route. With max_turns the search stops at tiles that take longer than that.
+    """
+    if not grid.contains(source):
+        raise KeyError(source)
+
+    costs = grid.costs
+    width = grid.width
+    height = grid.height
+    origin_x = grid.min_x
+    origin_y = grid.min_y
+
+    best = {source: 0}
+    state = {source: (0, 0, None)}  # (completed turns, movement carried into the turn, parent)
+    open_set = [(0, source)]
+
+    while open_set:
+        cost, current = heappop(open_set)
+        if cost > best[current]:
+            continue
+
+        stops, carry, parent = state[current]
+        turns = stops + (1 if carry else 0)
+        if max_turns is not None and turns > max_turns:
+            continue  # Turn counts never decrease along a route
+        if current != source:
+            yield current, turns, cost, parent
+
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx = current[0] + dx - origin_x
+            ny = current[1] + dy - origin_y
+            if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                continue
+            terrain_cost = costs[ny * width + nx]
+            if not terrain_cost:
+                continue
+
+            neighbor = (current[0] + dx, current[1] + dy)
+            tentative = cost + terrain_cost
+            if tentative < best.get(neighbor, inf):
+                best[neighbor] = tentative
+                moved = carry + terrain_cost
+                if moved >= speed:
+                    state[neighbor] = (stops + 1, 0, current)
+                else:
+                    state[neighbor] = (stops, moved, current)
+                heappush(open_set, (tentative, neighbor))
+
+
+def reachable_tiles(source, grid, speed=2, max_turns=10):
+    """Return {(x, y): (turns, cost, parent)} for every tile reachable within max_turns."""
+    return {
+        pos: (turns, cost, parent)
+        for pos, turns, cost, parent in dijkstra(source, grid, speed, max_turns)
+    }
+
+
+def route_costs(source, targets, grid, speed=2, max_cost=None):
+    """
+    Return {target: (turns, cost)} for the targets reachable from source.
+
+    A single Dijkstra serves all targets and stops as soon as the last one is settled.
+    Targets no route can enter are left out up front. With max_cost the search also stops
+    at routes costing more than that, which bounds it for targets that are unreachable in
+    other ways (e.g. on another island).
+    """
+    remaining = set(targets)
+    results = {}
+    if source in remaining:
+        results[source] = (0, 0)
+        remaining.discard(source)
+    remaining = {target for target in remaining if _enterable(grid, target)}
+    if not remaining or not grid.contains(source):
+        return results
+
+    for pos, turns, cost, _ in dijkstra(source, grid, speed):
+        if max_cost is not None and cost > max_cost:
+            break  # Tiles come in order of cost, the rest cost even more
+        if pos in remaining:
+            results[pos] = (turns, cost)
+            remaining.discard(pos)
+            if not remaining:
+                break
+    return results
+
+
+def _enterable(grid, pos):
+    try:
+        return bool(grid.cost_at(pos))
+    except KeyError:
+        return False
+
+
+# Grid of a route matrix worker process, set by the pool initializer
+_worker_grid = None
+
+
+def _init_route_worker(grid):
+    global _worker_grid
+    _worker_grid = grid
+
+
+def _route_row(source, targets, speed, max_cost):
+    return route_costs(source, targets, _worker_grid, speed, max_cost)
+
+
+def route_matrix(sources, targets, grid, speed=2, workers=None, max_cost=None):
+    """
+    Travel times and costs from every source to every target.
+
+    Returns one {target: (turns, cost)} dict per source, leaving out targets not reachable
+    for at most max_cost. With workers the rows are computed in a process pool, each worker
+    getting its own copy of the grid.
+    """
+    if not workers or len(sources) < 2:
+        return [route_costs(source, targets, grid, speed, max_cost) for source in sources]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_route_worker, initargs=(grid,)) as pool:
+        chunksize = max(1, len(sources) // (workers * 4))
+        return list(pool.map(
+            _route_row, sources, repeat(targets), repeat(speed), repeat(max_cost), chunksize=chunksize,
+        ))
+
 
+def format_path(path, goal, grid, speed):
+    """Split a tile-by-tile path into per-turn stops and format them for the client."""
     # Calculate speed intervals
     interval_path = []
-    cost = 0
     current_speed = 0
     for tile in path:
-        terrain_cost = TERRAIN_COSTS[terrain_data[tile]]
-        current_speed += terrain_cost
+        current_speed += grid.cost_at(tile)
 
         if current_speed >= speed:
             interval_path.append(tile)
             current_speed = 0
-        cost += terrain_cost
 
     # Ensure the goal is always included
     if not interval_path or interval_path[-1] != goal:
@@ -93,7 +532,7 @@ def find_path(start, goal, terrain_data, tile_mapping, speed=2):
 
     # Format path with tileId, x, and y
     formatted_path = [
-        {"tileId": tile_mapping[tile], "x": tile[0], "y": tile[1]}
+        {"tileId": grid.tile_id_at(tile), "x": tile[0], "y": tile[1]}
         for tile in interval_path
     ]
 
@@ -0,0 +1,35 @@
+"""
+End-of-turn logout.
+
+Sessions hold the SessionEpoch they were started in. log_out_users() starts a new epoch
+and SessionEpochMiddleware logs out sessions of non-staff users from an older one, or with
+no epoch at all, on their next request. That costs a cached read per request whatever the
+number of players, and sessions nobody uses again are never touched.
+"""
+from django.contrib.auth import logout
+
+from .models import SessionEpoch
+
+SESSION_KEY = '_game_epoch'
+
+
+def stamp_session(request):
+    """Mark the session as started in the current epoch."""
+    request.session[SESSION_KEY] = SessionEpoch.current()
+
+
+class SessionEpochMiddleware:
+    """Logs out sessions of non-staff users not started in the current epoch."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.session.session_key is not None:
+            epoch = request.session.get(SESSION_KEY)
+            if epoch != SessionEpoch.current() and request.user.is_authenticated:
+                if request.user.is_staff:
+                    stamp_session(request)  # Staff carry on
+                else:
+                    logout(request)  # Unstamped sessions too, they may predate any number of turns
+        return self.get_response(request)
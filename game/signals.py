@@ -1,9 +1,123 @@
-from django.db.models.signals import post_save
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Profile
+from django.contrib.auth.signals import user_logged_in
+from .models import MapVersion, PlayerStats, Profile, Tile
+from .pathfinding import terrain_grid
+from . import maptiles, ownership
+from .sessions import stamp_session
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance, display_name=instance.username)
+        PlayerStats.objects.create(user=instance)  # So PlayerStats.for_user() needn't rebuild
+
+@receiver(user_logged_in)
+def start_session_epoch(sender, request, user, **kwargs):
+    if request is not None:
+        stamp_session(request)
+
+# Drop the cached map images showing a changed tile, where it is and where it was
+@receiver(post_save, sender=Tile)
+def invalidate_tile_images(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'x', 'y', 'terrain', 'owner'} & set(update_fields):
+        return
+    positions = [(instance.x, instance.y)]
+    before = getattr(instance, '_before', None)
+    if before:
+        positions.append((before['x'], before['y']))
+    maptiles.invalidate_positions(positions)
+
+@receiver(post_delete, sender=Tile)
+def remove_tile_images(sender, instance, **kwargs):
+    maptiles.invalidate_positions([(instance.x, instance.y)])
+
+# Owner borders use the profile colour
+@receiver(post_save, sender=Profile)
+def invalidate_owner_images(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and 'color' not in update_fields):
+        return
+    maptiles.invalidate_positions(Tile.objects.filter(owner_id=instance.user_id).values_list('x', 'y'))
+
+# Map versions for the delta feed
+@receiver(post_save, sender=Tile)
+@receiver(post_delete, sender=Tile)
+def record_tile_change(sender, instance, **kwargs):
+    MapVersion.record([instance.id], reason='tile')
+
+@receiver(post_save, sender=Profile)
+def record_owner_change(sender, instance, created, update_fields=None, **kwargs):
+    # Tiles show the owner's display name and colour
+    if created or (update_fields is not None and not {'display_name', 'color'} & set(update_fields)):
+        return
+    MapVersion.record(Tile.objects.filter(owner_id=instance.user_id).values_list('id', flat=True), reason='owner')
+
+# The saved owner, population and position of a changed tile, for the receivers below and
+# the map images above
+@receiver(pre_save, sender=Tile)
+def remember_tile(sender, instance, update_fields=None, **kwargs):
+    instance._before = None
+    if instance.pk is None or (update_fields is not None and not {'owner', 'population', 'x', 'y'} & set(update_fields)):
+        return
+    instance._before = Tile.objects.filter(pk=instance.pk).values('owner_id', 'population', 'x', 'y').first()
+
+# Player stats follow tile ownership and population. Bulk updates bypass these, run
+# `rebuild_player_stats` after those.
+
+@receiver(post_save, sender=Tile)
+def update_player_stats(sender, instance, created, **kwargs):
+    before = getattr(instance, '_before', None)
+    if before is None and not created:
+        return
+    before = before or {'owner_id': None, 'population': 0}
+    if before['owner_id'] == instance.owner_id:
+        if instance.population != before['population']:
+            PlayerStats.add({instance.owner_id: {'population': instance.population - before['population']}})
+        return
+    # The tile changed hands, and the goods on it with it
+    goods = dict(instance.inventory.values_list('good__name', 'quantity')) if not created else {}
+    PlayerStats.add({
+        before['owner_id']: {
+            'tiles': -1, 'population': -before['population'],
+            'goods': {name: -quantity for name, quantity in goods.items()},
+        },
+        instance.owner_id: {'tiles': 1, 'population': instance.population, 'goods': goods},
+    })
+
+@receiver(pre_delete, sender=Tile)
+def remove_from_player_stats(sender, instance, **kwargs):
+    # Before the tile's inventory is deleted with it
+    if instance.owner_id:
+        PlayerStats.add({instance.owner_id: {
+            'tiles': -1, 'population': -instance.population,
+            'goods': {name: -quantity for name, quantity in instance.inventory.values_list('good__name', 'quantity')},
+        }})
+
+# Ownership index: drop the cached tiles of both players when a tile changes hands
+@receiver(post_save, sender=Tile)
+def update_ownership_index(sender, instance, created, **kwargs):
+    before = getattr(instance, '_before', None)
+    if created:
+        ownership.invalidate(instance.owner_id)
+    elif before is not None and before['owner_id'] != instance.owner_id:
+        ownership.invalidate(before['owner_id'], instance.owner_id)
+
+@receiver(post_delete, sender=Tile)
+def remove_from_ownership_index(sender, instance, **kwargs):
+    ownership.invalidate(instance.owner_id)
+
+# Keep the in-memory terrain grid in step with single-tile saves, once they are committed
+# so a rolled back change never reaches the grid (or the paths cached for its version)
+@receiver(post_save, sender=Tile)
+def update_terrain_grid(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'x', 'y', 'terrain'} & set(update_fields):
+        return
+    transaction.on_commit(partial(terrain_grid.update_tile, instance.id, instance.x, instance.y, instance.terrain))
+
+@receiver(post_delete, sender=Tile)
+def remove_from_terrain_grid(sender, instance, **kwargs):
+    transaction.on_commit(partial(terrain_grid.remove_tile, instance.id))
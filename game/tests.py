@@ -1,3 +1,1030 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import tempfile
+from datetime import timedelta
+from time import sleep
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, models, transaction
+from django.http import JsonResponse
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import maptiles, ownership
+from .backup import export_world, import_world
+from .benchmark import build_world
+from .hierarchical import HierarchicalPathfinder
+from .instrumentation import QueryBudgetExceeded, QueryInstrumentationMiddleware, query_budget
+from .jobs import JobProgress, claim_next_job, enqueue_turn, read_progress, recover_stale_jobs, run_job
+from .mapcodec import MapSnapshot
+from .models import (
+    GameDate, MapVersion, PlayerStats, Profile, ProgressAction, QueuedAction, SessionEpoch, Shipment, StatusAction,
+    Tile, TileInventory, TurnJob, TurnReport,
+)
+from .pathfinding import (
+    TERRAIN_COSTS, PathCache, TerrainGrid, find_path, format_path, get_terrain_grid, path_cache, plan_path, route_costs,
+    route_matrix, search_path, terrain_grid,
+)
+from .sessions import SESSION_KEY
+from .turns import resolve_turn
+from .views import log_out_users, map_chunks
+
+
+class Rollback(Exception):
+    pass
+
+
+def game_state():
+    """The outcome of resolving turns, without row ids that differ between runs."""
+    return {
+        'inventory': sorted(TileInventory.objects.values_list('tile_id', 'good__name', 'quantity')),
+        'money': sorted(Profile.objects.values_list('user_id', 'money')),
+        'actions': sorted(
+            (action.user_id, action.turn, json.dumps(action.details, sort_keys=True))
+            for action in ProgressAction.objects.all()
+        ),
+        'shipments': sorted(Shipment.objects.values_list('owner_id', 'good', 'quantity', 'tile_id', 'step')),
+        'statuses': [
+            (status.user_id, json.dumps(status.details, sort_keys=True))
+            for status in StatusAction.objects.order_by('id')
+        ],
+        'queued': QueuedAction.objects.count(),
+        'stats': sorted(
+            (stats.user_id, stats.tiles, stats.population, sorted((k, v) for k, v in stats.goods.items() if v))
+            for stats in PlayerStats.objects.all()
+        ),
+        'date': GameDate.objects.get().current_date,
+    }
+
+
+def resolve(turns=1, workers=0, resolver=resolve_turn):
+    """Resolve turns with that many workers, roll them back and return (summaries, game_state())."""
+    try:
+        with transaction.atomic():
+            with override_settings(TURN_RESOLUTION_WORKERS=workers, TURN_REGION_SIZE=4):
+                summaries = [resolver() for turn in range(turns)]
+            state = game_state()
+            raise Rollback
+    except Rollback:
+        pass
+    return summaries, state
+
+
+def resolve_one_by_one():
+    """
+    The turn as the original resolve_actions view resolved it, one action and one query
+    at a time, on today's tables.
+    """
+    game_date = GameDate.objects.get()
+    today = game_date.current_date
+
+    def status(action, details, outcome, tile):
+        StatusAction.objects.create(
+            user_id=action.user_id, action_type='move_goods', completion_date=today,
+            details={**details, 'status': {**outcome, 'tile': {'x': tile[0], 'y': tile[1]}}},
+        )
+
+    for action in QueuedAction.objects.order_by('id'):
+        if action.action_type != 'move_goods':
+            continue
+        details = action.details
+        from_tile = Tile.objects.get(id=details['from']['tileId'])
+        goods = from_tile.goods
+        profile = Profile.objects.get(user_id=action.user_id)
+        if goods.get(details['good'], 0) < details['quantity']:
+            status(action, details, {'error': 'not enough goods'}, (from_tile.x, from_tile.y))
+            continue
+        if profile.money < details['cost']:
+            status(action, details, {'error': 'not enough money'}, (from_tile.x, from_tile.y))
+            continue
+        from_tile.set_goods({**goods, details['good']: goods[details['good']] - details['quantity']})
+        profile.money -= details['cost']
+        profile.save()
+        ProgressAction.objects.create(user_id=action.user_id, action_type='move_goods', details=details, turn=0)
+    QueuedAction.objects.all().delete()
+
+    for action in ProgressAction.objects.order_by('id'):
+        details = action.details
+        turn, path, good, quantity = action.turn, details['path'], details['good'], details['quantity']
+        current = Tile.objects.get(id=path[turn]['tileId'])
+        shipment = Shipment.objects.filter(action=action).first()
+        if turn > 0 and (shipment is None or shipment.quantity < quantity):
+            previous = Tile.objects.filter(id=path[turn - 1]['tileId']).first()
+            position = (previous.x, previous.y) if previous else (path[turn - 1]['x'], path[turn - 1]['y'])
+            status(action, {**details, 'turn': turn}, {'error': 'goods were lost'}, position)
+            action.delete()
+            continue
+        if shipment is None:
+            shipment = Shipment(action=action, owner_id=action.user_id, good=good, quantity=quantity)
+        shipment.tile = current
+        shipment.step = turn
+        shipment.save()
+        action.turn += 1
+        action.save()
+        if action.turn >= details['time']:
+            goods = current.goods
+            current.set_goods({**goods, good: goods.get(good, 0) + quantity})
+            status(action, {**details, 'turn': action.turn}, {'success': 'goods moved successfully'}, (current.x, current.y))
+            action.delete()
+
+    game_date.current_date += timedelta(days=1)
+    game_date.save()
+
+
+class TurnResolutionTests(TestCase):
+    """The bulk resolver gives the same results as resolving one action at a time."""
+
+    def setUp(self):
+        self.world = build_world(users=4, tiles=400, queued=60, in_flight=60, seed=2)
+        # Failures of every kind alongside the moves that go through
+        Profile.objects.filter(user=self.world.players[0]).update(money=0)
+        for action in QueuedAction.objects.order_by('id')[:10]:
+            action.details['quantity'] = 1000
+            action.save()
+        shipments = list(Shipment.objects.order_by('id')[:10])
+        Shipment.objects.filter(id__in=[shipment.id for shipment in shipments[:5]]).delete()
+        Shipment.objects.filter(id__in=[shipment.id for shipment in shipments[5:]]).update(quantity=models.F('quantity') - 1)
+
+    def test_same_as_one_by_one(self):
+        summaries, bulk = resolve(turns=4)
+        self.assertEqual(bulk, resolve(turns=4, resolver=resolve_one_by_one)[1])
+        # The fixture covers every outcome
+        self.assertTrue(all(sum(summary[key] for summary in summaries) for key in ('failed', 'advanced', 'completed')))
+
+    def test_parallel_same_as_one_by_one(self):
+        self.assertEqual(resolve(turns=4, workers=2)[1], resolve(turns=4, resolver=resolve_one_by_one)[1])
+
+    def test_details_written_once(self):
+        # Moving shipments on only updates the turn, tile and step columns
+        before = {action.id: action.details for action in ProgressAction.objects.all()}
+        with CaptureQueriesContext(connection) as queries:
+            resolve_turn()
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "game_progressaction"')]
+        self.assertTrue(updates)
+        self.assertFalse([sql for sql in updates if '"details"' in sql])
+        for action in ProgressAction.objects.filter(id__in=before):
+            self.assertEqual(action.details, before[action.id])
+
+        self.client.force_login(self.world.players[1])
+        progress = self.client.get('/get_user_data/').json()['progress']
+        self.assertTrue(progress)
+        turns = dict(ProgressAction.objects.filter(user=self.world.players[1]).values_list('id', 'turn'))
+        self.assertEqual({action['id']: action['action_data']['turn'] for action in progress}, turns)
+
+    def test_report(self):
+        with CaptureQueriesContext(connection) as queries:
+            summary = resolve_turn()
+        report = TurnReport.objects.get()
+        self.assertEqual(report.summary, summary)
+        self.assertEqual(list(report.phases), ['loading', 'queued actions', 'shipments', 'saving', 'status actions'])
+        for phase in report.phases.values():
+            self.assertGreaterEqual(phase['seconds'], phase['query_seconds'])
+        # The report is written after counting, in the turn's savepoint which is released after it
+        self.assertEqual(report.queries, len(queries) - 2)
+        self.assertEqual(sum(phase['queries'] for phase in report.phases.values()), report.queries - 1)
+        self.assertGreater(report.phases['loading']['queries'], 0)
+        self.assertGreater(report.phases['saving']['queries'], 0)
+        self.assertEqual(sum(report.actions['queued'].values()), summary['queued'])
+        self.assertEqual(report.rows_written['StatusAction']['created'], summary['failed'] + summary['completed'])
+
+    def test_report_queries_do_not_grow_with_actions(self):
+        def queries():
+            resolve_turn()
+            return TurnReport.objects.first().queries
+
+        [fewer] = resolve(resolver=queries)[0]
+        self.world.params.update(queued=120, in_flight=120)
+        self.world.refill()
+        [more] = resolve(resolver=queries)[0]
+        # Twice the actions, only queries skipped when there is nothing to write can be added
+        self.assertLessEqual(more, fewer + 2)
+
+    def test_player_stats_follow_inventory(self):
+        def resolve_and_rebuild():
+            resolve_turn()
+            resolved = game_state()['stats']
+            PlayerStats.rebuild()
+            return resolved, game_state()['stats']
+
+        for resolved, rebuilt in resolve(turns=4, resolver=resolve_and_rebuild)[0]:
+            self.assertEqual(resolved, rebuilt)
+
+
+class InventoryTests(TestCase):
+    """Tile goods as TileInventory rows and the economy totals the database computes from them."""
+
+    def setUp(self):
+        self.world = build_world(users=3, tiles=400, queued=0, in_flight=0)
+        self.client.force_login(self.world.players[0])
+
+    def holdings(self):
+        totals = {}
+        for owner, good, quantity in TileInventory.objects.exclude(tile__owner=None).values_list(
+                'tile__owner_id', 'good__name', 'quantity'):
+            totals[owner, good] = totals.get((owner, good), 0) + quantity
+        return totals
+
+    def test_totals(self):
+        rows = self.client.get('/economy/totals/').json()['totals']
+        self.assertEqual({(row['user'], row['good']): row['quantity'] for row in rows}, self.holdings())
+        self.assertEqual([row['quantity'] for row in rows], sorted((row['quantity'] for row in rows), reverse=True))
+
+        wood = self.client.get('/economy/totals/', {'good': 'wood', 'limit': 2}).json()['totals']
+        self.assertEqual([row['quantity'] for row in wood], sorted(
+            (quantity for (owner, good), quantity in self.holdings().items() if good == 'wood'), reverse=True,
+        )[:2])
+
+    def test_good_totals(self):
+        goods = self.client.get('/economy/goods/').json()['goods']
+        for row in goods:
+            held = TileInventory.objects.filter(good__name=row['good'])
+            self.assertEqual(row['quantity'], sum(held.values_list('quantity', flat=True)))
+            self.assertEqual(row['tiles'], held.count())
+
+    def test_set_goods(self):
+        tile_id, x, y = self.world.owned[self.world.players[0].id][0]
+        tile = Tile.objects.get(id=tile_id)
+        tile.set_goods({'iron': 5, 'wood': 0, 'gold': 2})
+        self.assertEqual(Tile.objects.get(id=tile_id).goods, {'iron': 5, 'gold': 2})
+        # No rows for goods the tile doesn't hold
+        self.assertEqual(TileInventory.objects.filter(tile=tile).count(), 2)
+        # The owner's stats follow the change
+        stats = game_state()['stats']
+        PlayerStats.rebuild()
+        self.assertEqual(stats, game_state()['stats'])
+
+
+class ParallelTurnTests(TestCase):
+    """Resolving shipments per region gives the same results as resolving them in order."""
+
+    def setUp(self):
+        self.world = build_world(users=4, tiles=400, queued=40, in_flight=60, seed=1)
+
+    def test_same_as_serial(self):
+        self.assertEqual(resolve(turns=3, workers=2), resolve(turns=3))
+
+    def test_previous_tile_deleted(self):
+        # Delete a tile some shipment just left that no other action needs this turn
+        needed = set()
+        for action in QueuedAction.objects.all():
+            needed.add(int(action.details['from']['tileId']))
+            needed.add(int(action.details['path'][0]['tileId']))
+        progress_actions = list(ProgressAction.objects.all())
+        for action in progress_actions:
+            needed.add(int(action.details['path'][action.turn]['tileId']))
+        previous = [
+            int(action.details['path'][action.turn - 1]['tileId'])
+            for action in progress_actions if action.turn > 0
+        ]
+        Tile.objects.filter(id=next(tile_id for tile_id in previous if tile_id not in needed)).delete()
+
+        serial = resolve()
+        self.assertGreater(serial[0][0]['failed'], 0)
+        self.assertEqual(resolve(workers=2), serial)
+
+
+class TurnJobTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=5, in_flight=5)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overrides = override_settings(TURN_JOB_PROGRESS_DIR=directory.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_resolve_actions_queues_turn(self):
+        self.client.force_login(self.world.staff)
+        today = GameDate.objects.get().current_date
+        response = self.client.post('/resolve_actions/')
+        job = TurnJob.objects.get()
+        self.assertRedirects(response, f'/admin/game/turnjob/{job.id}/change/', fetch_redirect_response=False)
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(GameDate.objects.get().current_date, today)
+
+        job = run_job(claim_next_job())
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(GameDate.objects.get().current_date, today + timedelta(days=1))
+        self.assertIsNone(read_progress(job.id))
+
+    def test_logout_failure_keeps_the_turn(self):
+        today = GameDate.objects.get().current_date
+        enqueue_turn(end_turn=True)
+        with mock.patch('game.views.log_out_users', side_effect=RuntimeError("cache down")), \
+                self.assertLogs('game.jobs', 'ERROR'):
+            job = run_job(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertIn("cache down", job.error)
+        self.assertEqual(GameDate.objects.get().current_date, today + timedelta(days=1))
+        self.assertIsNone(claim_next_job())  # Nothing left to resolve the turn again
+
+    def test_progress_file(self):
+        job = TurnJob.objects.create(status='running', started=timezone.now())
+        reporter = JobProgress(job, interval=0.01)
+        reporter.start()
+        reporter('shipments', 5, 10)
+        sleep(0.1)
+        self.assertEqual(
+            {key: value for key, value in read_progress(job.id).items() if key != 'updated'},
+            {'phase': 'shipments', 'processed': 5, 'total': 10},
+        )
+        self.assertEqual(reporter.stop(), ('shipments', 5, 10))
+        self.assertIsNone(read_progress(job.id))
+
+    def test_recover_stale_jobs(self):
+        started = timezone.now() - timedelta(minutes=10)
+        lost = TurnJob.objects.create(status='running', started=started)
+        alive = TurnJob.objects.create(status='running', started=started)
+        reporter = JobProgress(alive)
+        reporter.start()
+        self.addCleanup(reporter.stop)
+
+        with self.assertLogs('game.jobs', 'WARNING'):
+            self.assertEqual(recover_stale_jobs(), [lost])
+        lost.refresh_from_db()
+        self.assertEqual(lost.status, 'failed')
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, 'running')
+
+    def test_recover_job_whose_turn_committed(self):
+        job = TurnJob.objects.create(status='running', started=timezone.now() - timedelta(minutes=10))
+        TurnReport.objects.create(game_date=GameDate.objects.get().current_date, summary={'queued': 3})
+        with self.assertLogs('game.jobs', 'WARNING'):
+            recover_stale_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.summary), ('done', {'queued': 3}))
+
+
+class SessionEpochTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=1, tiles=400, queued=0, in_flight=0)
+        self.addCleanup(cache.delete, SessionEpoch.CACHE_KEY)
+
+    def login(self, user, stamped=True):
+        self.client.force_login(user)
+        if not stamped:
+            session = self.client.session
+            del session[SESSION_KEY]
+            session.save()
+
+    def logged_in(self):
+        return self.client.get('/get_user_data/').status_code == 200
+
+    def test_end_of_turn_logs_out_players(self):
+        self.login(self.world.players[0])
+        self.assertTrue(self.logged_in())
+        log_out_users()
+        self.assertFalse(self.logged_in())
+        self.login(self.world.players[0])  # A new login starts in the new epoch
+        self.assertTrue(self.logged_in())
+
+    def test_unstamped_player_sessions_end(self):
+        self.login(self.world.players[0], stamped=False)
+        self.assertFalse(self.logged_in())
+
+    def test_staff_sessions_are_restamped(self):
+        self.login(self.world.staff, stamped=False)
+        self.assertTrue(self.logged_in())
+        self.assertEqual(self.client.session[SESSION_KEY], SessionEpoch.current())
+        log_out_users()
+        self.assertTrue(self.logged_in())
+        self.assertEqual(self.client.session[SESSION_KEY], SessionEpoch.current())
+
+
+@override_settings(EVENTS_STREAM_SECONDS=0)
+class EventStreamTests(TestCase):
+    """A reconnecting /events/ stream is sent the turns resolved while it was away."""
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=5, in_flight=5)
+        self.client = AsyncClient()
+        self.client.force_login(self.world.players[0])
+
+    async def events(self, **headers):
+        response = await self.client.get('/events/', {'since': 0}, headers=headers)
+        return ''.join([chunk.decode() async for chunk in response.streaming_content])
+
+    def event_id(self, body):
+        return [line[4:] for line in body.splitlines() if line.startswith('id: ')][-1]
+
+    async def test_reconnect_after_turn(self):
+        body = await self.events()
+        self.assertIn('event: turn', body)
+        last_id = self.event_id(body)
+
+        # Nothing new
+        body = await self.events(last_event_id=last_id)
+        self.assertNotIn('event: turn', body)
+
+        # A turn resolved while the client was away
+        await GameDate.objects.aupdate(current_date=models.F('current_date') + timedelta(days=1))
+        body = await self.events(last_event_id=last_id)
+        self.assertIn('event: turn', body)
+        self.assertIn('event: actions', body)
+        self.assertNotEqual(self.event_id(body), last_id)
+
+
+class MapChunksTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=5)
+        self.factory = RequestFactory()
+
+    def chunks(self, chunks):
+        request = self.factory.get('/map_chunks/', {'chunks': chunks})
+        request.user = self.world.players[0]
+        return json.loads(map_chunks(request).content)
+
+    def test_three_queries_for_any_number_of_chunks(self):
+        with self.assertNumQueries(3):
+            one = self.chunks('0,0')
+        with self.assertNumQueries(3):
+            four = self.chunks('0,0;0,1;1,0;1,1')
+        self.assertEqual(four['chunks'][0], one['chunks'][0])
+        self.assertEqual(sum(len(chunk['tiles']) for chunk in four['chunks']), Tile.objects.count())
+
+    def test_position_index(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Tile._meta.db_table)
+        self.assertIn(['x', 'y'], [c['columns'] for c in constraints.values() if c['index']])
+
+
+class MapDeltaTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+        self.tiles = list(Tile.objects.order_by('id')[:5])
+        self.client.force_login(self.world.players[0])
+
+    def test_not_modified_until_the_map_changes(self):
+        response = self.client.get('/map_delta/', {'since': 0})
+        etag = response['ETag']
+        response = self.client.get('/map_delta/', {'since': 0}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        tile = self.tiles[0]
+        tile.population += 1
+        tile.save()
+        response = self.client.get('/map_delta/', {'since': 0}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_changed_and_deleted_tiles(self):
+        since = MapVersion.current()
+        changed, deleted = self.tiles[:2]
+        changed.population += 7
+        changed.save()
+        deleted_id = deleted.id
+        deleted.delete()
+        delta = self.client.get('/map_delta/', {'since': since}).json()
+        self.assertEqual(delta['version'], MapVersion.current())
+        self.assertFalse(delta['full'])
+        self.assertEqual([tile['id'] for tile in delta['tiles']], [changed.id])
+        self.assertEqual(delta['tiles'][0]['population'], changed.population)
+        self.assertEqual(delta['deleted'], [deleted_id])
+        # Up to date: nothing to send
+        delta = self.client.get('/map_delta/', {'since': delta['version']}).json()
+        self.assertEqual((delta['tiles'], delta['deleted']), ([], []))
+
+    @override_settings(MAP_VERSIONS_KEPT=3)
+    def test_pruned_versions_reload_the_map(self):
+        since = MapVersion.current()
+        for tile in self.tiles[:5]:
+            tile.save()
+        versions = MapVersion.objects.count()
+        self.assertEqual(MapVersion.prune(), versions - 3)
+        self.assertEqual(MapVersion.objects.count(), 3)
+        self.assertTrue(self.client.get('/map_delta/', {'since': since}).json()['full'])
+        recent = MapVersion.current() - 2
+        self.assertFalse(self.client.get('/map_delta/', {'since': recent}).json()['full'])
+
+    @override_settings(MAP_VERSIONS_KEPT=3)
+    def test_turns_prune_versions(self):
+        for tile in self.tiles[:5]:
+            tile.save()
+        resolve_turn()
+        self.assertEqual(MapVersion.objects.count(), 3)
+
+
+class MapImageTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overrides = override_settings(MEDIA_ROOT=directory.name, MAP_IMAGE_SIZE=8, MAP_IMAGE_ZOOMS=2)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.client.force_login(self.world.players[0])
+
+    def test_outside_the_map(self):
+        # 20 x 20 tiles in 8 x 8 images at zoom 0
+        self.assertEqual(self.client.get('/map_image/0/2/2.png').status_code, 200)
+        for ix, iy in [(3, 0), (0, 3), (-1, 0), (100000, 100000)]:
+            self.assertEqual(self.client.get(f'/map_image/0/{ix}/{iy}.png').status_code, 404)
+        self.assertEqual(len(os.listdir(os.path.join(maptiles.image_dir(), '0'))), 1)
+
+    def test_moved_tile(self):
+        self.client.get('/map_image/0/0/0.png')
+        self.assertTrue(os.path.exists(maptiles.image_path(0, 0, 0)))
+
+        tile = Tile.objects.get(x=0, y=0)
+        tile.x = 30
+        terrain_grid.invalidate()  # As in a process that never loaded the grid
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            tile.save()
+            self.assertTrue(os.path.exists(maptiles.image_path(0, 0, 0)))  # Not before the commit
+        self.assertTrue(callbacks)
+        self.assertFalse(os.path.exists(maptiles.image_path(0, 0, 0)))
+
+
+class MapSnapshotTests(TestCase):
+
+    def test_64_bit_tile_ids(self):
+        build_world(users=2, tiles=400, queued=0, in_flight=0)
+        Tile.objects.create(id=2 ** 32 + 5, x=20, y=20, terrain='plains')
+        data = MapSnapshot.load().to_bytes()
+        snapshot = MapSnapshot.from_bytes(data)
+        self.assertEqual(snapshot.tile(20, 20)['id'], 2 ** 32 + 5)
+        self.assertEqual(snapshot.tile(0, 0)['id'], Tile.objects.get(x=0, y=0).id)
+        # The tile ids column can be wrapped in a BigUint64Array
+        self.assertEqual(data.index(snapshot.tile_ids.tobytes()) % 8, 0)
+
+
+class RouteMatrixTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+
+    def matrix(self, user, **data):
+        self.client.force_login(user)
+        with mock.patch('game.views.route_matrix', wraps=route_matrix) as spy:
+            response = self.client.post('/route_matrix/', json.dumps(data), content_type='application/json')
+        return response.json(), spy.call_args.args[4]
+
+    def test_parallel_only_for_staff(self):
+        land = [{'x': x, 'y': y} for tile_id, x, y in self.world.owned[self.world.players[0].id]]
+        data = {'sources': land[:2], 'targets': land[:2], 'parallel': True}
+        with override_settings(ROUTE_MATRIX_POOL_THRESHOLD=1, ROUTE_MATRIX_WORKERS=2):
+            player, player_workers = self.matrix(self.world.players[0], **data)
+            staff, staff_workers = self.matrix(self.world.staff, **data)
+        self.assertIsNone(player_workers)
+        self.assertEqual(staff_workers, 2)
+        self.assertEqual(player, staff)
+
+    def test_unreachable_targets_are_bounded(self):
+        grid = get_terrain_grid()
+        tile_id, *source = self.world.owned[self.world.players[0].id][0]
+        source = tuple(source)
+        with self.captureOnCommitCallbacks(execute=True):
+            Tile.objects.get(x=5, y=5).delete()
+        with mock.patch('game.pathfinding.dijkstra') as search:
+            self.assertEqual(route_costs(source, [(5, 5), (1000, 1000)], grid), {})
+        search.assert_not_called()
+
+        everything = route_costs(source, list(grid.positions.values()), grid)
+        cheap = route_costs(source, list(grid.positions.values()), grid, max_cost=5)
+        self.assertEqual(cheap, {pos: route for pos, route in everything.items() if route[1] <= 5})
+
+
+class HierarchicalPathTests(TestCase):
+
+    def setUp(self):
+        # A maze of holes, many of them crossed only diagonally
+        self.rng = random.Random(1)
+        self.grid = TerrainGrid()
+        self.grid._allocate(0, 0, 40, 40)
+        for y in range(40):
+            for x in range(40):
+                if self.rng.random() < 0.55:
+                    self.grid._set(self.grid.index(x, y), y * 40 + x + 1, x, y, 'plains')
+        self.grid.loaded = True
+        self.hpa = HierarchicalPathfinder(self.grid, 4)
+
+    def test_finds_a_route_exactly_when_there_is_one(self):
+        land = list(self.grid.positions.values())
+        calls = []
+
+        def flat(*args):
+            calls.append(self.hpa.lock._is_owned())
+            return find_path(*args)
+
+        with mock.patch('game.hierarchical.find_path', side_effect=flat):
+            for i in range(300):
+                start, goal = self.rng.sample(land, 2)
+                if max(abs(start[0] - goal[0]), abs(start[1] - goal[1])) <= 1:
+                    continue
+                path, time = self.hpa.find_path(start, goal)
+                reachable = search_path(start, goal, self.grid) is not None
+                self.assertEqual(bool(path), reachable, (start, goal))
+                self.assertEqual(bool(time), reachable)
+                if path:
+                    self.assertEqual(path[-1], {'tileId': self.grid.tile_id_at(goal), 'x': goal[0], 'y': goal[1]})
+        self.assertNotIn(True, calls)
+
+    def test_no_route(self):
+        # An empty column cuts the map in two
+        for y in range(40):
+            self.grid._clear(self.grid.index(20, y))
+        start = next(pos for pos in self.grid.positions.values() if pos[0] < 4)
+        goal = next(pos for pos in self.grid.positions.values() if pos[0] > 36)
+        with mock.patch('game.hierarchical.find_path') as flat, \
+                mock.patch.object(self.hpa, 'abstract_search', wraps=self.hpa.abstract_search) as abstract:
+            self.assertEqual(self.hpa.find_path(start, goal), ([], 0))
+        abstract.assert_called_once()
+        flat.assert_not_called()
+
+
+class TerrainGridTests(TestCase):
+
+    def setUp(self):
+        build_world(users=2, tiles=400, queued=0, in_flight=0)
+        self.grid = get_terrain_grid()
+        self.tile = Tile.objects.get(x=3, y=3)
+        self.tile.terrain = 'mountains' if self.tile.terrain != 'mountains' else 'plains'
+
+    def test_save_patches_the_grid_on_commit(self):
+        version = self.grid.version
+        cost = self.grid.cost_at((3, 3))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tile.save()
+            # Not before the commit
+            self.assertEqual((self.grid.cost_at((3, 3)), self.grid.version), (cost, version))
+        self.assertEqual(self.grid.cost_at((3, 3)), TERRAIN_COSTS[self.tile.terrain])
+        self.assertEqual(self.grid.version, version + 1)
+        self.assertTrue(self.grid.loaded)
+
+    def test_delete_patches_the_grid_on_commit(self):
+        version = self.grid.version
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tile.delete()
+        self.assertFalse(self.grid.contains((3, 3)))
+        self.assertEqual(self.grid.version, version + 1)
+
+    def test_rolled_back_change_never_reaches_the_grid(self):
+        version = self.grid.version
+        cost = self.grid.cost_at((3, 3))
+        try:
+            with transaction.atomic():
+                self.tile.save()
+                Tile.objects.get(x=4, y=4).delete()
+                raise Rollback
+        except Rollback:
+            pass
+        self.assertEqual(self.grid.cost_at((3, 3)), cost)
+        self.assertTrue(self.grid.contains((4, 4)))
+        self.assertEqual(self.grid.version, version)
+
+
+class PathPlanningTests(TestCase):
+
+    def setUp(self):
+        build_world(users=2, tiles=400, queued=0, in_flight=0)
+        Tile.objects.update(terrain='plains')
+        terrain_grid.invalidate()
+        path_cache.clear()
+
+    def test_route_around_the_box(self):
+        # A wall across the search box of (2, 5) -> (2, 7), open beyond x = 8
+        Tile.objects.filter(y=6, x__lte=8).delete()
+        terrain_grid.invalidate()
+        path, time = plan_path((2, 5), (2, 7), speed=1)
+        self.assertEqual(path[-1]['tileId'], Tile.objects.get(x=2, y=7).id)
+        self.assertTrue(any(step['x'] > 8 for step in path))
+
+    def test_unreachable(self):
+        Tile.objects.filter(y=6).delete()
+        terrain_grid.invalidate()
+        self.assertEqual(plan_path((2, 5), (2, 7)), ([], 0))
+        self.assertEqual(find_path((2, 5), (2, 7), get_terrain_grid()), ([], 0))
+        response = self.client.get('/calculate_path/', {'start_x': 2, 'start_y': 5, 'goal_x': 2, 'goal_y': 7})
+        self.assertEqual(response.json(), {'success': False, 'error': "No route to the destination tile"})
+
+
+class MovementRangeTests(TestCase):
+
+    def setUp(self):
+        build_world(users=2, tiles=400, queued=0, in_flight=0)
+        Tile.objects.update(terrain='plains')
+        terrain_grid.invalidate()
+
+    def movement_range(self, **params):
+        return self.client.get('/movement_range/', params).json()
+
+    def test_range_bounds(self):
+        # All plains at speed 2: a turn covers two tiles in any direction
+        data = self.movement_range(x=10, y=10, speed=2, max_turns=2)
+        positions = {(row[1], row[2]) for row in data['tiles']}
+        self.assertEqual(positions, {
+            (x, y) for x in range(6, 15) for y in range(6, 15) if (x, y) != (10, 10)
+        })
+        self.assertEqual(data['origin'], {'tileId': Tile.objects.get(x=10, y=10).id, 'x': 10, 'y': 10})
+
+        with override_settings(MOVEMENT_RANGE_MAX_TURNS=1):
+            data = self.movement_range(x=10, y=10, speed=2, max_turns=50)
+        self.assertEqual(max(row[3] for row in data['tiles']), 1)
+        self.assertEqual(len(data['tiles']), 24)
+
+        self.assertFalse(self.movement_range(x=100, y=100)['success'])
+
+    def test_turns_cost_and_parents(self):
+        Tile.objects.filter(x=11).update(terrain='mountains')
+        terrain_grid.invalidate()
+        grid = get_terrain_grid()
+        data = self.movement_range(x=10, y=10, speed=2, max_turns=4)
+        rows = {row[0]: row for row in data['tiles']}
+        origin = data['origin']['tileId']
+        for tile_id, x, y, turns, cost, parent in data['tiles']:
+            # The cost is that of the cheapest route, the parent one step back on it
+            route = search_path((10, 10), (x, y), grid)
+            self.assertEqual(cost, sum(grid.cost_at(step) for step in route))
+            if parent == origin:
+                self.assertEqual(cost, grid.cost_at((x, y)))
+            else:
+                self.assertEqual(cost, rows[parent][4] + grid.cost_at((x, y)))
+            # Turns as find_path counts them for the route through the parents
+            step = tile_id
+            route = []
+            while step != origin:
+                route.append((rows[step][1], rows[step][2]))
+                step = rows[step][5]
+            self.assertEqual(turns, format_path(route[::-1], (x, y), grid, 2)[1])
+            self.assertLessEqual(turns, 4)
+
+    def test_adjacent_tiles_as_find_path(self):
+        # Every kind of terrain around (5, 5)
+        for (x, y), terrain in zip(
+            [(4, 4), (5, 4), (6, 4), (4, 5), (6, 5), (4, 6), (5, 6), (6, 6)],
+            ['water', 'mountains', 'forest', 'fields', 'city', 'water', 'plains', 'mountains'],
+        ):
+            Tile.objects.filter(x=x, y=y).update(terrain=terrain)
+        terrain_grid.invalidate()
+        grid = get_terrain_grid()
+
+        data = self.movement_range(x=5, y=5, speed=2)
+        adjacent = [row for row in data['tiles'] if max(abs(row[1] - 5), abs(row[2] - 5)) == 1]
+        self.assertEqual(len(adjacent), 8)
+        for tile_id, x, y, turns, cost, parent in adjacent:
+            path, time = find_path((5, 5), (x, y), grid, 2)
+            self.assertEqual((turns, path[-1]['tileId']), (time, tile_id))
+            self.assertEqual(turns, 1)
+            self.assertEqual(cost, grid.cost_at((x, y)))
+
+
+class PathCacheTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+        Tile.objects.update(terrain='plains')
+        terrain_grid.invalidate()
+        path_cache.clear()
+
+    def stats(self):
+        self.client.force_login(self.world.staff)
+        return self.client.get('/path_cache_stats/').json()
+
+    def test_hits_and_misses(self):
+        first = plan_path((0, 0), (6, 3))
+        self.assertIs(plan_path((0, 0), (6, 3)), first)
+        plan_path((0, 0), (3, 6))
+        self.assertEqual(self.stats(), {
+            'size': 2, 'maxsize': path_cache.maxsize, 'hits': 1, 'misses': 2, 'evictions': 0,
+        })
+
+    def test_evictions(self):
+        small = PathCache(2)
+        for key in 'abc':
+            small.put(key, key)
+        small.get('b')
+        self.assertIsNone(small.get('a'))
+        self.assertEqual(small.info(), {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 1})
+
+    def test_terrain_change_invalidates_paths(self):
+        path, time = plan_path((0, 0), (4, 0), speed=1)
+        self.assertEqual(time, 4)
+        tile = Tile.objects.get(x=2, y=0)
+        tile.terrain = 'water'
+        with self.captureOnCommitCallbacks(execute=True):
+            tile.save()
+        # A new grid version, so the cached path is not used
+        self.assertNotEqual(plan_path((0, 0), (4, 0), speed=1), (path, time))
+        self.assertEqual(path_cache.info()['hits'], 0)
+
+
+class QueueActionsTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+        self.player = self.world.players[0]
+        self.client.force_login(self.player)
+        get_terrain_grid()  # Loaded once per process, not within the view's budget
+
+    def queue(self, *moves):
+        actions = [
+            {'action_type': 'move_goods', 'good': 'iron', 'quantity': 1, 'from': from_id, 'to': to_id}
+            for from_id, to_id in moves
+        ]
+        return self.client.post('/queue_actions/', json.dumps({'actions': actions}), content_type='application/json')
+
+    def test_queue(self):
+        (from_id, *start), (to_id, *goal) = self.world.owned[self.player.id][:2]
+        response = self.queue((from_id, to_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(QueuedAction.objects.get().details['from']['tileId'], str(from_id))
+
+    def test_tile_lost_after_the_index_was_cached(self):
+        (from_id, *start), (to_id, *goal) = self.world.owned[self.player.id][:2]
+        self.assertTrue(ownership.owns(self.player.id, from_id))
+        # As a change made in another process, the index here keeps its copy
+        Tile.objects.filter(id=from_id).update(owner=self.world.players[1])
+        self.assertTrue(ownership.owns(self.player.id, from_id))
+
+        response = self.queue((to_id, to_id), (from_id, to_id))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], {
+            '0': "Goods are already there", '1': "You don't own the tile goods are taken from",
+        })
+        self.assertFalse(QueuedAction.objects.exists())
+
+    def test_unreachable_destination(self):
+        from_id, x, y = self.world.owned[self.player.id][0]
+        with self.captureOnCommitCallbacks(execute=True):
+            island = Tile.objects.create(x=30, y=30, terrain='plains', owner=self.player)
+        get_terrain_grid()  # Resized for the new tile
+        money = Profile.objects.get(user=self.player).money
+
+        response = self.queue((from_id, island.id))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], {'0': "No route to the destination tile"})
+        self.assertFalse(QueuedAction.objects.exists())
+        self.assertEqual(Profile.objects.get(user=self.player).money, money)
+
+    def test_adjacent_move_onto_rough_terrain(self):
+        # One stop on the path, so the move has to take one turn whatever the terrain costs
+        grid = get_terrain_grid()
+        from_id, x, y = self.world.owned[self.player.id][0]
+        goal = next(
+            (x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            if (dx, dy) != (0, 0) and grid.contains((x + dx, y + dy))
+        )
+        tile = Tile.objects.get(x=goal[0], y=goal[1])
+        tile.owner = self.player
+        tile.terrain = 'water'
+        with self.captureOnCommitCallbacks(execute=True):
+            tile.save()
+        self.assertEqual(grid.cost_at(goal), 4)
+
+        self.assertEqual(self.queue((from_id, tile.id)).status_code, 200)
+        self.assertEqual(QueuedAction.objects.get().details['time'], 1)
+        for turn in range(2):
+            resolve_turn()
+        self.assertFalse(ProgressAction.objects.exists())
+        self.assertEqual(StatusAction.objects.get().details['status']['success'], "goods moved successfully")
+
+
+class OwnershipIndexTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=2, tiles=400, queued=0, in_flight=0)
+        self.player, self.other = self.world.players
+        ownership.invalidate_all()  # Ids are reused once a test's rows are rolled back
+
+    def check(self, data):
+        self.client.force_login(self.player)
+        return self.client.post('/check_ownership/', json.dumps(data), content_type='application/json').json()
+
+    def test_batch(self):
+        mine = [tile_id for tile_id, x, y in self.world.owned[self.player.id][:2]]
+        theirs = self.world.owned[self.other.id][0][0]
+        unowned = Tile.objects.filter(owner=None).values_list('id', flat=True).first()
+        self.assertEqual(self.check({'tile_ids': [*mine, theirs, unowned, 10 ** 9]}), {'owned': {
+            str(mine[0]): True, str(mine[1]): True, str(theirs): False, str(unowned): False, str(10 ** 9): False,
+        }})
+        self.assertEqual(self.check({'tile_id': mine[0]}), {'is_owner': True})
+        with override_settings(OWNERSHIP_CHECK_MAX_TILES=2):
+            self.assertEqual(self.check({'tile_ids': [*mine, theirs]}), {'error': 'Too many tiles'})
+
+    def test_change_seen_after_save(self):
+        tile = Tile.objects.get(id=self.world.owned[self.other.id][0][0])
+        self.assertEqual(self.check({'tile_ids': [tile.id]}), {'owned': {str(tile.id): False}})
+        self.assertTrue(ownership.owns(self.other.id, tile.id))  # Both indexes cached
+        with self.captureOnCommitCallbacks(execute=True):
+            tile.owner = self.player
+            tile.save()
+        self.assertEqual(self.check({'tile_ids': [tile.id]}), {'owned': {str(tile.id): True}})
+        self.assertFalse(ownership.owns(self.other.id, tile.id))
+        tile_id = tile.id
+        with self.captureOnCommitCallbacks(execute=True):
+            tile.delete()
+        self.assertEqual(self.check({'tile_id': tile_id}), {'is_owner': False})
+
+    def test_generation_evicted(self):
+        tile_id = self.world.owned[self.player.id][0][0]
+        cache.clear()  # A fresh process
+        self.assertTrue(ownership.owns(self.player.id, tile_id))
+        ownership.invalidate_all()
+        Tile.objects.filter(id=tile_id).update(owner=self.other)  # Bypassing the signals
+        cache.delete(ownership.GENERATION_KEY)  # As culled by the cache
+        self.assertFalse(ownership.owns(self.player.id, tile_id))
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=1, tiles=400, queued=0, in_flight=0)
+        self.factory = RequestFactory()
+
+    def request(self, view):
+        request = self.factory.get('/counted/')
+        request.user = self.world.players[0]
+        return QueryInstrumentationMiddleware(view)(request)
+
+    def test_budget(self):
+        @query_budget(1)
+        def view(request):
+            return JsonResponse({'tiles': Tile.objects.count(), 'goods': TileInventory.objects.count()})
+
+        self.assertTrue(settings.QUERY_BUDGET_RAISE)  # Set by the test runner
+        with self.assertRaisesMessage(QueryBudgetExceeded, "GET /counted/ ran 2 queries, its budget is 1"):
+            self.request(view)
+        with override_settings(QUERY_BUDGET_RAISE=False), self.assertLogs('game.instrumentation', 'WARNING') as logs:
+            self.assertEqual(self.request(view).status_code, 200)
+        self.assertIn("ran 2 queries, its budget is 1", logs.output[0])
+        self.assertEqual(self.request(query_budget(2)(view.__wrapped__)).status_code, 200)
+
+    @override_settings(QUERY_INSTRUMENTATION_HEADERS=True, QUERY_SLOW_REQUEST_SECONDS=0)
+    def test_middleware(self):
+        with self.assertLogs('game.instrumentation', 'INFO') as logs:
+            response = self.request(lambda request: JsonResponse({'tiles': Tile.objects.count()}))
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertIn('X-Query-Time', response)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        self.assertIn("GET /counted/ spent", logs.output[0])
+        self.assertIn("SELECT COUNT(*)", logs.output[0])
+        with override_settings(QUERY_INSTRUMENTATION_HEADERS=False, QUERY_SLOW_REQUEST_SECONDS=60):
+            self.assertNotIn('X-Query-Count', self.request(lambda request: JsonResponse({})))
+
+
+class BackupTests(TestCase):
+
+    def setUp(self):
+        self.world = build_world(users=3, tiles=400, queued=5, in_flight=5)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'world.jsonl.gz')
+
+    def tiles(self):
+        return list(Tile.objects.order_by('id').values_list(
+            'id', 'x', 'y', 'owner_id', 'population', 'buildings', 'resources', 'terrain'))
+
+    def test_round_trip(self):
+        resolve_turn()
+        self.world.refill()  # Status actions and queued ones
+        state, tiles = game_state(), self.tiles()
+        exported = export_world(self.path)
+        with self.assertRaises(ValueError):
+            import_world(self.path)
+        with self.captureOnCommitCallbacks(execute=True):
+            imported = import_world(self.path, replace=True)
+        self.assertEqual(imported, exported)
+        self.assertEqual(game_state(), state)
+        self.assertEqual(self.tiles(), tiles)
+        self.assertTrue(state['queued'] and state['statuses'] and state['shipments'])
+
+
+class BenchmarkCommandTests(TestCase):
+
+    def test_require_baseline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            missing = os.path.join(directory, 'baseline.json')
+            with self.assertRaisesMessage(CommandError, f"No baseline at {missing}"):
+                call_command('benchmark', '--require-baseline', baseline=missing)
+
+
+class GenerateMapCommandTests(TestCase):
+
+    def generate(self, *args, **options):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('generate_map', 12, 10, *args, stdout=io.StringIO(), **options)
+        return list(Tile.objects.order_by('y', 'x').values_list('x', 'y', 'terrain', 'population'))
+
+    def test_same_seed_same_map(self):
+        tiles = self.generate(seed=3)
+        self.assertEqual(len(tiles), 120)
+        self.assertEqual(self.generate('--clear', seed=3), tiles)
+        self.assertNotEqual(self.generate('--clear', seed=4), tiles)
+
+    def test_refuses_to_overwrite_tiles(self):
+        tiles = self.generate(seed=3)
+        with self.assertRaisesMessage(CommandError, "There are tiles in that area already"):
+            self.generate(seed=4, x=6)
+        self.assertEqual(list(Tile.objects.order_by('y', 'x').values_list('x', 'y', 'terrain', 'population')), tiles)
+        # Next to the map is fine
+        self.assertEqual(len(self.generate(seed=3, x=12)), 240)
@@ -0,0 +1,466 @@
+"""
+End of turn resolution.
+
+All goods, shipments and profiles the turn needs are loaded up front, the queued actions
+and shipments are applied in memory and everything is written back with bulk queries
+inside a single transaction. Actions are handled in the same order and with the same
+checks as the original one-action-at-a-time loop.
+
+Goods in transit live in the Shipment table, one row per ProgressAction, so moving a
+shipment only changes its tile and step and the action's turn column; the action's
+details, path included, are written once when it starts. Goods on tiles live in TileInventory and only
+the rows for the (tile, good) pairs given or received are loaded, so a goods check is a
+lookup of a single row.
+"""
+import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import connection, transaction
+
+from .events import publish_on_commit
+from .instrumentation import PhaseTimer, QueryRecorder
+from .models import (
+    Tile, TileInventory, UniversalGoods, Profile, PlayerStats, QueuedAction, ProgressAction, Shipment, StatusAction,
+    GameDate, TurnReport, MapVersion,
+)
+
+# Rows per UPDATE/INSERT/DELETE statement
+BATCH_SIZE = 500
+
+# How often (in actions) progress is reported within a phase
+PROGRESS_EVERY = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_turn(progress=None):
+    """
+    Resolve all queued actions, advance every shipment one step and move the date on.
+
+    progress, if given, is called as progress(phase, processed, total) while resolving.
+    Timings, query counts and rows written are saved as a TurnReport.
+    Returns a dict with the number of actions handled per outcome.
+    """
+    if progress is None:
+        progress = _no_progress
+    recorder = QueryRecorder()
+    timer = PhaseTimer(recorder)
+
+    with connection.execute_wrapper(recorder), transaction.atomic():
+        timer.start('loading')
+        progress('loading', 0, 0)
+        game_date = GameDate.objects.first()
+        if not game_date:
+            game_date = GameDate.objects.create()  # Initialize if missing
+        today = game_date.current_date
+
+        queued = list(QueuedAction.objects.order_by('id'))
+        progress_actions = list(ProgressAction.objects.order_by('id'))
+        logger.info("Processing %d actions...", len(queued))
+
+        stock, inventory, positions, owners, shipments_by_action, profiles = _preload(queued, progress_actions)
+        loaded_stock = dict(stock)
+
+        statuses = []
+        changed_tiles = set()
+        changed_profiles = set()
+        summary = {'queued': len(queued), 'started': 0, 'shipments': 0, 'failed': 0, 'advanced': 0, 'completed': 0}
+
+        def fail(action, details, error, tile_id):
+            x, y = positions[tile_id]
+            statuses.append(StatusAction(
+                user_id=action.user_id,
+                action_type='move_goods',
+                details={**details, "status": {"error": error, "tile": {"x": x, "y": y}}},
+                completion_date=today,
+            ))
+            summary['failed'] += 1
+
+        # Handle queued actions
+        timer.start('queued actions')
+        started = []
+        for processed, action in enumerate(queued):
+            if processed % PROGRESS_EVERY == 0:
+                progress('queued actions', processed, len(queued))
+            if action.action_type != 'move_goods':
+                continue
+            details = action.details
+            from_id = _tile_id(positions, details['from']['tileId'])
+            good = details['good']
+            quantity = details['quantity']
+            cost = details['cost']
+            profile = profiles[action.user_id]
+
+            # Check conditions: enough goods and money
+            if stock.get((from_id, good), 0) < quantity:
+                fail(action, details, "not enough goods", from_id)
+                continue
+            if profile.money < cost:
+                fail(action, details, "not enough money", from_id)
+                continue
+
+            # Deduct resources and money
+            stock[(from_id, good)] -= quantity
+            changed_tiles.add(from_id)
+            profile.money -= cost
+            changed_profiles.add(profile.user_id)
+
+            started.append(ProgressAction(
+                user_id=action.user_id,
+                action_type='move_goods',
+                details=details,
+                turn=0,
+            ))
+        summary['started'] = len(started)
+
+        # Handle progress actions, shipments started this turn move right away
+        timer.start('shipments')
+        logger.info("Progressing %d actions...", len(progress_actions) + len(started))
+        actions = progress_actions + started
+        summary['shipments'] = len(actions)
+        # Tiles shipments leave, for the map changes
+        departed = {shipment.tile_id for shipment in shipments_by_action.values()}
+        items = [
+            (key, action.user_id, action.details, action.turn, shipments_by_action.get(action.pk))
+            for key, action in enumerate(actions)
+        ]
+        workers = getattr(settings, 'TURN_RESOLUTION_WORKERS', 0)
+        if workers:
+            results, changed = _advance_parallel(items, stock, positions, workers, progress)
+        else:
+            results, changed = _advance(items, stock, positions, progress)
+        changed_tiles.update(changed)
+
+        advanced = []
+        moving = []
+        finished = []
+        for key, turn, done, status, shipment in results:
+            action = actions[key]
+            action.turn = turn
+            if not done:
+                summary['advanced'] += 1
+                advanced.append(action)
+                shipment.action = action
+                moving.append(shipment)
+                continue
+            finished.append(action)
+            summary['failed' if 'error' in status['status'] else 'completed'] += 1
+            statuses.append(StatusAction(
+                user_id=action.user_id,
+                action_type='move_goods',
+                details=status,
+                completion_date=today,
+            ))
+
+        # Write everything back
+        timer.start('saving')
+        progress('saving', 0, 0)
+        written = defaultdict(Counter)
+        written['TileInventory'].update(_save_stock(stock, loaded_stock, inventory))
+        holdings = defaultdict(Counter)
+        for (tile_id, good), quantity in stock.items():
+            if quantity != loaded_stock.get((tile_id, good), 0):
+                holdings[owners[tile_id]][good] += quantity - loaded_stock.get((tile_id, good), 0)
+        written['PlayerStats']['updated'] = PlayerStats.add({
+            owner_id: {'goods': goods} for owner_id, goods in holdings.items()
+        })
+        written['Profile']['updated'] = Profile.objects.bulk_update(
+            [profiles[i] for i in changed_profiles], ['money'], batch_size=BATCH_SIZE)
+        written['ProgressAction']['updated'] = ProgressAction.objects.bulk_update(
+            [a for a in advanced if a.pk], ['turn'], batch_size=BATCH_SIZE)
+        written['ProgressAction']['created'] = _create(ProgressAction, [a for a in advanced if not a.pk])
+        written['Shipment']['updated'] = Shipment.objects.bulk_update(
+            [s for s in moving if s.pk], ['tile', 'step'], batch_size=BATCH_SIZE)
+        written['Shipment']['created'] = len(Shipment.objects.bulk_create(
+            [s for s in moving if not s.pk], batch_size=BATCH_SIZE))
+        # Deleting the actions also drops their shipments
+        for model, count in _delete_ids(ProgressAction, [a.pk for a in finished if a.pk]).items():
+            written[model]['deleted'] += count
+        if queued:
+            # Actions queued while the turn was resolving stay for the next one
+            written['QueuedAction']['deleted'] = QueuedAction.objects.filter(id__lte=queued[-1].id).delete()[0]
+
+        # Tiles whose goods or goods in transit changed
+        MapVersion.record(changed_tiles | departed | {shipment.tile_id for shipment in moving}, reason='turn')
+        MapVersion.prune()  # Once a turn keeps the feed bounded
+
+        timer.start('status actions')
+        written['StatusAction']['created'] = len(StatusAction.objects.bulk_create(statuses, batch_size=BATCH_SIZE))
+
+        # Increment the date (simulate end turn)
+        game_date.current_date += timedelta(days=1)
+        game_date.save()
+        timer.stop()
+
+        TurnReport.objects.create(
+            game_date=today,
+            seconds=timer.total,
+            queries=recorder.count,
+            query_seconds=recorder.time,
+            phases=timer.phases,
+            actions={
+                'queued': Counter(action.action_type for action in queued),
+                'progress': Counter(action.action_type for action in actions),
+            },
+            rows_written={model: dict(counts) for model, counts in written.items()},
+            summary=summary,
+            workers=workers,
+        )
+
+        # Let open /events/ streams know, once everything above is committed
+        publish_on_commit({'type': 'turn', 'date': game_date.current_date.isoformat()})
+
+    return summary
+
+
+def _no_progress(phase, processed, total):
+    pass
+
+
+def _tile_id(positions, tile_id):
+    tile_id = int(tile_id)
+    if tile_id not in positions:
+        raise Tile.DoesNotExist(f"Tile {tile_id} does not exist.")
+    return tile_id
+
+
+def _advance(items, stock, positions, progress=_no_progress):
+    """
+    Move shipments one step along their path.
+
+    items are (key, user_id, details, turn, shipment) tuples in resolution order, shipment
+    being None for shipments that have not moved yet. stock maps (tile id, good) to the
+    quantity held for the goods delivered and positions maps tile id to (x, y) for every tile
+    on the way. Stock and shipments are updated in place. Returns
+    ([(key, turn, finished, status_details, shipment)], changed tile ids), where turn is
+    the action's new turn and status_details is the details of the StatusAction to record
+    for finished shipments.
+    """
+    results = []
+    changed = set()
+    for processed, (key, user_id, details, turn, shipment) in enumerate(items):
+        if processed % PROGRESS_EVERY == 0:
+            progress('shipments', processed, len(items))
+        path = details['path']
+        good = details['good']
+        quantity = details['quantity']
+        time = details['time']
+
+        # Get current tile
+        current_id = _tile_id(positions, path[turn]['tileId'])
+
+        if turn > 0:
+            # Goods are lost if the shipment (or its tile) was removed or emptied on the way
+            if shipment is None or shipment.quantity < quantity:
+                prev = path[turn - 1]
+                x, y = positions.get(int(prev['tileId']), (prev['x'], prev['y']))
+                status = {"error": "goods were lost", "tile": {"x": x, "y": y}}
+                results.append((key, turn, True, {**details, "turn": turn, "status": status}, shipment))
+                continue
+        else:
+            shipment = Shipment(owner_id=user_id, good=good, quantity=quantity)
+
+        # Move forward
+        shipment.tile_id = current_id
+        shipment.step = turn
+        turn += 1
+
+        # If action is complete
+        if turn >= time:
+            # Transfer goods to destination
+            stock[(current_id, good)] = stock.get((current_id, good), 0) + quantity
+            changed.add(current_id)
+
+            x, y = positions[current_id]
+            status = {"success": "goods moved successfully", "tile": {"x": x, "y": y}}
+            results.append((key, turn, True, {**details, "turn": turn, "status": status}, shipment))
+        else:
+            results.append((key, turn, False, None, shipment))
+    return results, changed
+
+
+def _advance_batch(items, stock, positions):
+    """Process pool task: advance a batch of regions and send back the stock it changed."""
+    results, changed = _advance(items, stock, positions)
+    return results, changed, {key: quantity for key, quantity in stock.items() if key[0] in changed}
+
+
+def _advance_parallel(items, stock, positions, workers, progress=_no_progress):
+    """
+    Advance shipments region by region in a process pool.
+
+    The map is cut into TURN_REGION_SIZE squares. Shipments whose tiles for this step all lie
+    in one region are resolved with the rest of that region in a worker. Shipments crossing
+    a region border, together with every region they touch, are resolved afterwards in a
+    serial pass. No two groups share a tile, so the outcome is the same as resolving every
+    shipment in order.
+    """
+    size = getattr(settings, 'TURN_REGION_SIZE', 32)
+
+    def steps(item):
+        details, turn = item[2], item[3]
+        return [int(step['tileId']) for step in details['path'][max(turn - 1, 0):turn + 1]]
+
+    def region(tile_id):
+        x, y = positions[tile_id]
+        return x // size, y // size
+
+    regions = defaultdict(list)
+    crossing = []
+    for item in items:
+        tile_ids = steps(item)
+        touched = {region(tile_id) for tile_id in tile_ids if tile_id in positions}
+        if len(touched) == 1 and all(tile_id in positions for tile_id in tile_ids):
+            regions[touched.pop()].append(item)
+        else:
+            # Crossing a border, or a tile was deleted: the serial pass reports it like _advance does
+            crossing.append((item, touched))
+
+    serial = []
+    for item, touched in crossing:
+        for key in touched:
+            serial.extend(regions.pop(key, ()))
+        serial.append(item)
+    serial.sort(key=lambda item: item[0])
+
+    # Spread the regions over a few batches per worker, biggest regions first
+    batches = [[] for _ in range(min(len(regions), workers * 4))]
+    for group in sorted(regions.values(), key=len, reverse=True):
+        min(batches, key=len).extend(group)
+
+    results = []
+    changed = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+        futures = []
+        for batch in batches:
+            tile_ids = {tile_id for item in batch for tile_id in steps(item)}
+            futures.append(pool.submit(
+                _advance_batch,
+                batch,
+                {key: quantity for key, quantity in stock.items() if key[0] in tile_ids},
+                {tile_id: positions[tile_id] for tile_id in tile_ids},
+            ))
+        for done, future in enumerate(futures):
+            batch_results, batch_changed, batch_stock = future.result()
+            results += batch_results
+            changed.update(batch_changed)
+            stock.update(batch_stock)
+            progress('shipments', done + 1, len(futures) + 1)
+
+    serial_results, serial_changed = _advance(serial, stock, positions)
+    results += serial_results
+    changed.update(serial_changed)
+    results.sort(key=lambda result: result[0])
+    return results, changed
+
+
+def _preload(queued, progress):
+    """
+    Fetch what the actions refer to in a handful of queries.
+
+    Returns (stock, inventory, positions, owners, shipments, profiles): stock maps
+    (tile id, good) to the quantity held for every tile and good that goods are taken from
+    or delivered to, inventory maps the same keys to the id of their TileInventory row
+    where there is one, positions has (x, y) for every tile a shipment passes this turn,
+    owners has the owner id of the tiles in stock and shipments are by action id.
+    """
+    pairs = set()
+    step_ids = set()
+    user_ids = set()
+    for action in queued:
+        user_ids.add(action.user_id)
+        if action.action_type == 'move_goods':
+            details = action.details
+            path = details.get('path') or []
+            pairs.add((int(details['from']['tileId']), details['good']))
+            step_ids.update(int(step['tileId']) for step in path[:1])
+            if path and details['time'] <= 1:
+                pairs.add((int(path[0]['tileId']), details['good']))
+    for action in progress:
+        user_ids.add(action.user_id)
+        details = action.details
+        turn = action.turn
+        path = details['path']
+        step_ids.update(int(step['tileId']) for step in path[max(turn - 1, 0):turn + 1])
+        if turn + 1 >= details['time'] and turn < len(path):
+            pairs.add((int(path[turn]['tileId']), details['good']))
+
+    stock = {}
+    inventory = {}
+    tile_ids = list({tile_id for tile_id, _ in pairs})
+    goods = {good for _, good in pairs}
+    for start in range(0, len(tile_ids), BATCH_SIZE):
+        rows = TileInventory.objects.filter(
+            tile_id__in=tile_ids[start:start + BATCH_SIZE], good__name__in=goods,
+        ).values_list('id', 'tile_id', 'good__name', 'quantity')
+        for row_id, tile_id, good, quantity in rows:
+            if (tile_id, good) in pairs:
+                stock[(tile_id, good)] = quantity
+                inventory[(tile_id, good)] = row_id
+
+    positions = {}
+    owners = {}
+    rest = list(step_ids.union(tile_ids))
+    for start in range(0, len(rest), BATCH_SIZE):
+        rows = Tile.objects.filter(id__in=rest[start:start + BATCH_SIZE]).values_list('id', 'x', 'y', 'owner_id')
+        for tile_id, x, y, owner_id in rows:
+            positions[tile_id] = (x, y)
+            owners[tile_id] = owner_id
+    shipments = Shipment.objects.in_bulk([action.pk for action in progress], field_name='action_id')
+    profiles = {profile.user_id: profile for profile in Profile.objects.filter(user_id__in=user_ids)}
+    return stock, inventory, positions, owners, shipments, profiles
+
+
+def _save_stock(stock, loaded, inventory):
+    """
+    Write the quantities in stock that differ from loaded back to TileInventory.
+
+    Rows at zero are deleted, goods are stored sparsely. Returns rows created, updated and
+    deleted.
+    """
+    changed = {key: quantity for key, quantity in stock.items() if quantity != loaded.get(key, 0)}
+    names = {good for _, good in changed}
+    good_ids = dict(UniversalGoods.objects.filter(name__in=names).values_list('name', 'id'))
+    if names - good_ids.keys():
+        # Delivered goods nobody had added to UniversalGoods
+        UniversalGoods.objects.bulk_create(
+            [UniversalGoods(name=name) for name in names - good_ids.keys()], ignore_conflicts=True,
+        )
+        good_ids = dict(UniversalGoods.objects.filter(name__in=names).values_list('name', 'id'))
+
+    created, updated, deleted = [], [], []
+    for (tile_id, good), quantity in changed.items():
+        row_id = inventory.get((tile_id, good))
+        if row_id is None:
+            created.append(TileInventory(tile_id=tile_id, good_id=good_ids[good], quantity=quantity))
+        elif quantity:
+            updated.append(TileInventory(id=row_id, quantity=quantity))
+        else:
+            deleted.append(row_id)
+    return {
+        'created': len(TileInventory.objects.bulk_create(created, batch_size=BATCH_SIZE)),
+        'updated': TileInventory.objects.bulk_update(updated, ['quantity'], batch_size=BATCH_SIZE),
+        'deleted': _delete_ids(TileInventory, deleted).get('TileInventory', 0),
+    }
+
+
+def _create(model, objects):
+    """bulk_create that leaves every object with its primary key set; returns the count."""
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+    else:
+        for obj in objects:
+            obj.save()
+    return len(objects)
+
+
+def _delete_ids(model, ids):
+    """Delete rows by id in batches; returns rows deleted per model name, cascades included."""
+    deleted = Counter()
+    for start in range(0, len(ids), BATCH_SIZE):
+        deleted.update(model.objects.filter(id__in=ids[start:start + BATCH_SIZE]).delete()[1])
+    return {label.split('.')[-1]: count for label, count in deleted.items()}
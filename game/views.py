@@ -1,25 +1,40 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
-from django.contrib.auth import logout
 from django.contrib.admin.views.decorators import staff_member_required
-from .models import Tile, QueuedAction, ProgressAction, StatusAction, GameDate
-from .pathfinding import find_path
-from django.db import models
-from django.http import JsonResponse
+from .models import Tile, TileInventory, PlayerStats, UniversalGoods, QueuedAction, ProgressAction, Shipment, StatusAction, GameDate, MapVersion, SessionEpoch
+from .jobs import enqueue_turn
+from .events import broker, format_event
+from .instrumentation import query_budget
+from .mapcodec import MapSnapshot, CONTENT_TYPE as SNAPSHOT_CONTENT_TYPE
+from . import maptiles, ownership
+from .pathfinding import plan_path, path_cache, get_terrain_grid, reachable_tiles, route_matrix
+from django.db import models, transaction
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+from django.views.decorators.http import condition
+from datetime import datetime, timezone
+from time import monotonic
+import os
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 import json
-from datetime import timedelta
 
 
+@query_budget(5)
 @login_required
 def map_view(request):
     user = request.user
-    tiles = Tile.objects.all()
 
-    # Calculate population for user's owned tiles
-    user_population = tiles.filter(owner=user).aggregate(total_population=models.Sum('population'))[
-                          'total_population'] or 0
+    # Tiles are loaded chunk by chunk by the page, it only needs the extent of the map
+    bounds = Tile.objects.aggregate(
+        min_x=models.Min('x'), max_x=models.Max('x'), min_y=models.Min('y'), max_y=models.Max('y'),
+    )
+    if bounds['min_x'] is None:
+        bounds = {'min_x': 0, 'max_x': -1, 'min_y': 0, 'max_y': -1}
+
+    # Population and holdings of the user's tiles, kept up to date in PlayerStats
+    stats = PlayerStats.for_user(user)
 
     # Get user's money
     money = user.profile.money
@@ -28,30 +43,326 @@ def map_view(request):
     display_name = user.profile.display_name
 
     return render(request, 'map.html', {
-        'tiles': tiles,
-        'user_population': user_population,
+        'map_bounds': {
+            'min_x': bounds['min_x'],
+            'min_y': bounds['min_y'],
+            'width': bounds['max_x'] - bounds['min_x'] + 1,
+            'height': bounds['max_y'] - bounds['min_y'] + 1,
+        },
+        'chunk_size': settings.MAP_CHUNK_SIZE,
+        'chunks_per_request': settings.MAP_CHUNKS_PER_REQUEST,
+        'image_size': settings.MAP_IMAGE_SIZE,
+        'image_zooms': settings.MAP_IMAGE_ZOOMS,
+        'interactive_scale': settings.MAP_INTERACTIVE_SCALE,
+        'map_version': MapVersion.current(),
+        'poll_seconds': settings.MAP_POLL_SECONDS,
+        'user_population': stats.population,
+        'user_tiles': stats.tiles,
+        'holdings': sorted(stats.goods.items()),
         'money': money,
         'display_name':display_name
     })
 
+
+def _map_tiles(tiles):
+    """Tiles with what _tile_data needs fetched along."""
+    inventory = TileInventory.objects.select_related('good')
+    return tiles.select_related('owner__profile').prefetch_related(models.Prefetch('inventory', queryset=inventory))
+
+
+def _tile_data(tile, in_transit):
+    """JSON for one tile as the map page renders it, fetch the tiles with _map_tiles."""
+    profile = tile.owner.profile if tile.owner else None
+    return {
+        'id': tile.id,
+        'x': tile.x,
+        'y': tile.y,
+        'color': tile.terrain_color,
+        'buildings': tile.buildings or '',
+        'resources': tile.resources or '',
+        'population': tile.population,
+        'goods': tile.goods,
+        'movingGoods': in_transit.get(tile.id, {}),
+        'owner': tile.owner_id,
+        'display': profile.display_name if profile else '',
+        'ownerColor': profile.color if profile else '',
+        'image': tile.image.url if tile.image else '',
+    }
+
+
+@query_budget(4)
+@login_required
+def map_chunks(request):
+    """
+    API returning the tiles of one or more map chunks.
+
+    Chunks are MAP_CHUNK_SIZE x MAP_CHUNK_SIZE squares of tiles, chunk (cx, cy) starting at
+    tile (cx * size, cy * size). Pass them as ?chunks=cx,cy;cx,cy. Three queries whatever the
+    number of chunks: the tiles with their owners (by the (x, y) index), their goods and the
+    goods in transit.
+    """
+    try:
+        size = settings.MAP_CHUNK_SIZE
+        keys = []
+        for part in request.GET['chunks'].split(';'):
+            cx, cy = part.split(',')
+            keys.append((int(cx), int(cy)))
+        keys = list(dict.fromkeys(keys))
+        if len(keys) > settings.MAP_CHUNKS_PER_REQUEST:
+            return JsonResponse({'success': False, 'error': 'Too many chunks requested'}, status=400)
+
+        area = models.Q()
+        for cx, cy in keys:
+            area |= models.Q(
+                x__gte=cx * size, x__lt=(cx + 1) * size,
+                y__gte=cy * size, y__lt=(cy + 1) * size,
+            )
+        tiles = list(_map_tiles(Tile.objects.filter(area)))
+        in_transit = Shipment.in_transit([tile.id for tile in tiles])
+
+        chunks = {key: [] for key in keys}
+        for tile in tiles:
+            chunks[(tile.x // size, tile.y // size)].append(_tile_data(tile, in_transit))
+
+        return JsonResponse({
+            'success': True,
+            'size': size,
+            'chunks': [{'cx': cx, 'cy': cy, 'tiles': chunks[(cx, cy)]} for cx, cy in keys],
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+def _map_etag(request):
+    return f'map-{MapVersion.current()}'
+
+
+@query_budget(9)
+@login_required
+@condition(etag_func=_map_etag)
+def map_delta(request):
+    """
+    API returning the tiles changed since the map version given as ?since=.
+
+    The ETag is the current map version, so a client sending back the ETag of the version
+    it has gets a 304 until the map changes again. "full" means the client is too far
+    behind for a delta and should reload the map instead.
+    """
+    try:
+        return JsonResponse(_map_delta(int(request.GET['since'])))
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+
+def _map_delta(since):
+    version = MapVersion.current()
+    changed = MapVersion.changed_since(since) if since < version else set()
+    if changed is None or len(changed) > settings.MAP_DELTA_MAX_TILES:
+        return {'success': True, 'version': version, 'full': True, 'tiles': [], 'deleted': []}
+
+    tiles = list(_map_tiles(Tile.objects.filter(id__in=changed)))
+    in_transit = Shipment.in_transit([tile.id for tile in tiles])
+    return {
+        'success': True,
+        'version': version,
+        'full': False,
+        'tiles': [_tile_data(tile, in_transit) for tile in tiles],
+        'deleted': sorted(changed - {tile.id for tile in tiles}),
+    }
+
+
+def _stream_user(request):
+    return request.user if request.user.is_authenticated else None
+
+
+def _stream_updates(user, state):
+    """
+    SSE messages for what changed since `state` ({'version', 'date'}), updating it.
+
+    A date of None means the client's date is unknown, it gets the turn and its actions.
+    """
+    messages = []
+    if MapVersion.current() != state['version']:
+        delta = _map_delta(state['version'])
+        state['version'] = delta['version']
+        messages.append(format_event('map', delta, _event_id(state)))
+
+    date = GameDate.objects.values_list('current_date', flat=True).first()
+    if date is not None and date != state['date']:
+        messages.append(format_event('turn', {'current_date': date.strftime('%B %d, %Y')}))
+        # Only once the client has everything for the new date does the event id carry it
+        state['date'] = date
+        messages.append(format_event(
+            'actions', dict(_user_data(user), queued=_queued_actions(user)), _event_id(state),
+        ))
+    return messages
+
+
+def _event_id(state):
+    # A reconnecting EventSource sends the last id back as Last-Event-ID, see _parse_event_id
+    if state['date'] is None:
+        return str(state['version'])
+    return f"{state['version']}:{state['date'].isoformat()}"
+
+
+def _parse_event_id(value):
+    """(map version, date or None) from an event id."""
+    version, _, date = value.partition(':')
+    return int(version), datetime.strptime(date, '%Y-%m-%d').date() if date else None
+
+
+async def events(request):
+    """
+    Server-Sent Events stream of map deltas, new turns and the player's own actions.
+
+    Sends "map" (a /map_delta/ payload), "turn" and "actions" (the /get_user_data/
+    payload plus the queued actions) as soon as a turn or tile change commits, see
+    game/events.py. Event ids are "<map version>:<date>" of what the client has been
+    sent, so a reconnecting EventSource resumes from its Last-Event-ID and is sent the
+    turns resolved while it was away. A new stream starts from ?since=<map version> and
+    is sent the turn and actions straight away. Streams end after EVENTS_STREAM_SECONDS
+    and the browser reconnects.
+
+    Streaming needs the ASGI application in wargame/asgi.py; under WSGI this answers 204,
+    which tells EventSource not to reconnect, and the page keeps polling /map_delta/.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return HttpResponse(status=403)
+    try:
+        if 'Last-Event-ID' in request.headers:
+            version, date = _parse_event_id(request.headers['Last-Event-ID'])
+        else:
+            version, date = int(request.GET['since']), None
+    except (KeyError, ValueError):
+        version, date = await sync_to_async(MapVersion.current)(), None
+
+    async def stream():
+        subscription = broker.subscribe()
+        try:
+            state = {'version': version, 'date': date}
+            # Catch up on anything missed before subscribing
+            for message in await sync_to_async(_stream_updates)(user, state):
+                yield message
+            deadline = monotonic() + settings.EVENTS_STREAM_SECONDS
+            while monotonic() < deadline:
+                published = await subscription.wait(settings.EVENTS_POLL_SECONDS)
+                # Also checked on timeouts, for turns resolved in other processes
+                messages = await sync_to_async(_stream_updates)(user, state)
+                for message in messages:
+                    yield message
+                if not messages and not published:
+                    yield ': keep-alive\n\n'
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx hold events back
+    return response
+
+
+@login_required
+def map_snapshot(request):
+    """
+    API returning the whole map, or one chunk with ?chunk=cx,cy, as a packed MapSnapshot.
+
+    See game/mapcodec.py for the binary layout.
+    """
+    try:
+        if 'chunk' in request.GET:
+            size = settings.MAP_CHUNK_SIZE
+            cx, cy = (int(value) for value in request.GET['chunk'].split(','))
+            snapshot = MapSnapshot.load(cx * size, cy * size, size, size)
+        else:
+            snapshot = MapSnapshot.load()
+        return HttpResponse(snapshot.to_bytes(), content_type=SNAPSHOT_CONTENT_TYPE)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+def _map_image_modified(request, zoom, ix, iy):
+    if int(zoom) not in maptiles.zoom_levels():
+        raise Http404("No such zoom level")
+    if not maptiles.in_extent(int(zoom), int(ix), int(iy)):
+        raise Http404("No such map image")
+    path = maptiles.get_image(int(zoom), int(ix), int(iy))
+    return datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+
+
+@login_required
+@condition(last_modified_func=_map_image_modified)
+def map_image(request, zoom, ix, iy):
+    """PNG of the map at a zoom level, rendered on first request; see game/maptiles.py."""
+    response = FileResponse(open(maptiles.image_path(int(zoom), int(ix), int(iy)), 'rb'), content_type='image/png')
+    # Images are replaced when tiles change, always revalidate (a 304 is cheap)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@query_budget(2)
+@login_required
+def economy_totals(request):
+    """
+    API returning the goods players hold, summed per player and good by the database.
+
+    Filter with ?good=<name> and/or ?user=<id>; ?limit=N keeps the N biggest holdings,
+    e.g. ?good=wood&limit=10 for the ten biggest holders of wood.
+    """
+    try:
+        user = request.GET.get('user')
+        limit = request.GET.get('limit')
+        rows = TileInventory.totals(
+            good=request.GET.get('good') or None,
+            owner=int(user) if user else None,
+            limit=int(limit) if limit else None,
+        )
+        return JsonResponse({'success': True, 'totals': [
+            {'user': row['owner'], 'display': row['display'] or '', 'good': row['good_name'], 'quantity': row['total']}
+            for row in rows
+        ]})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+
+@query_budget(2)
+@login_required
+def economy_goods(request):
+    """API returning how much of each good there is on the map and on how many tiles."""
+    rows = TileInventory.good_totals()
+    return JsonResponse({'success': True, 'goods': [
+        {'good': row['good_name'], 'quantity': row['total'], 'tiles': row['tiles']} for row in rows
+    ]})
+
+
+@query_budget(2)
 @login_required
 def check_ownership(request):
+    """
+    API telling whether the user owns a tile, {"tile_id": 1}, or which of many tiles,
+    {"tile_ids": [1, 2]} returning {"owned": {"1": true, "2": false}}. Answered from the
+    cached ownership index; unknown tiles are simply not owned.
+    """
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            tile_id = data.get('tile_id')
-            tile = Tile.objects.get(id=tile_id)
+            if 'tile_ids' in data:
+                tile_ids = [int(tile_id) for tile_id in data['tile_ids']]
+                if len(tile_ids) > settings.OWNERSHIP_CHECK_MAX_TILES:
+                    return JsonResponse({'error': 'Too many tiles'}, status=400)
+                owned = ownership.owned_among(request.user.id, tile_ids)
+                return JsonResponse({'owned': {str(tile_id): tile_id in owned for tile_id in tile_ids}})
 
             # Check if the current user owns the tile
-            is_owner = tile.owner == request.user
+            is_owner = ownership.owns(request.user.id, data['tile_id'])
             return JsonResponse({'is_owner': is_owner})
 
-        except Tile.DoesNotExist:
-            return JsonResponse({'is_owner': False}, status=404)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
+
+@query_budget(2)
 @csrf_exempt
 def queue_action(request):
     if request.method == 'POST':
@@ -64,6 +375,89 @@ def queue_action(request):
         return JsonResponse({'success': True, 'action_id': action.id})
     return JsonResponse({'success': False}, status=400)
 
+@query_budget(6)  # Loading a cold terrain grid comes on top
+@login_required
+def queue_actions(request):
+    """
+    API queueing several move_goods actions at once, all or none.
+
+    POST {"actions": [{"action_type": "move_goods", "good": "iron", "quantity": 3,
+    "from": 12, "to": 40}, ...]} with tile ids. Routes are planned here with the cached
+    pathfinder at MOVE_GOODS_SPEED, one stop per turn, and the cost is quantity x turns,
+    so turn resolution only has to step along the stored path. Invalid actions are
+    reported by index as {"success": false, "errors": {"0": "..."}} and nothing is queued.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request method'}, status=405)
+    try:
+        actions = json.loads(request.body)['actions']
+        if not isinstance(actions, list) or not actions:
+            raise ValueError("actions must be a non-empty list")
+        if len(actions) > settings.QUEUE_ACTIONS_MAX:
+            raise ValueError(f"At most {settings.QUEUE_ACTIONS_MAX} actions at once")
+        moves = [_parse_move(action) for action in actions]
+    except KeyError as e:
+        return JsonResponse({'success': False, 'error': f"Missing field {e}"}, status=400)
+    except (TypeError, ValueError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    # Checked and queued in one transaction, against one state of the map
+    with transaction.atomic():
+        tile_ids = {move['from'] for move in moves} | {move['to'] for move in moves}
+        positions = {}
+        owners = {}
+        for tile_id, x, y, owner_id in Tile.objects.filter(id__in=tile_ids).values_list('id', 'x', 'y', 'owner_id'):
+            positions[tile_id] = (x, y)
+            owners[tile_id] = owner_id
+        goods = set(UniversalGoods.objects.filter(name__in={move['good'] for move in moves}).values_list('name', flat=True))
+
+        errors = {}
+        queued = []
+        for index, move in enumerate(moves):
+            if move['good'] not in goods:
+                errors[str(index)] = f"Unknown good {move['good']}"
+            elif owners.get(move['from']) != request.user.id:
+                # From the database, not the ownership index another process may have a stale copy of
+                errors[str(index)] = "You don't own the tile goods are taken from"
+            elif move['to'] not in positions:
+                errors[str(index)] = "Unknown destination tile"
+            elif move['to'] == move['from']:
+                errors[str(index)] = "Goods are already there"
+            else:
+                start, goal = positions[move['from']], positions[move['to']]
+                path, time = plan_path(start, goal, settings.MOVE_GOODS_SPEED)
+                if not path:
+                    errors[str(index)] = "No route to the destination tile"
+                    continue
+                queued.append(QueuedAction(user=request.user, action_type='move_goods', details={
+                    'good': move['good'],
+                    'quantity': move['quantity'],
+                    'cost': move['quantity'] * time,
+                    'from': {'tileId': str(move['from']), 'x': start[0], 'y': start[1]},
+                    'to': {'tileId': str(move['to']), 'x': goal[0], 'y': goal[1]},
+                    'path': path,
+                    'time': time,
+                }))
+        if errors:
+            return JsonResponse({'success': False, 'errors': errors}, status=400)
+
+        queued = QueuedAction.objects.bulk_create(queued)
+    return JsonResponse({'success': True, 'actions': [
+        {'id': action.id, 'path': action.details['path'], 'time': action.details['time'], 'cost': action.details['cost']}
+        for action in queued
+    ]})
+
+
+def _parse_move(action):
+    """The checked fields of one action posted to queue_actions."""
+    if action.get('action_type') != 'move_goods':
+        raise ValueError(f"Unsupported action type {action.get('action_type')!r}")
+    quantity = action['quantity']
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+        raise ValueError("quantity must be a positive whole number")
+    return {'good': str(action['good']), 'quantity': quantity, 'from': int(action['from']), 'to': int(action['to'])}
+
+@query_budget(3)
 @login_required
 def remove_action(request, action_id):
     if request.method == 'POST':  # Ensure it's a POST request
@@ -76,10 +470,15 @@ def remove_action(request, action_id):
     return JsonResponse({'success': False, 'error': 'Invalid request method.'})
 
 
+@query_budget(2)
 @login_required
 def get_user_actions(request):
-    actions = QueuedAction.objects.filter(user=request.user).order_by('timestamp')
-    action_list = [
+    return JsonResponse({'actions': _queued_actions(request.user)})
+
+
+def _queued_actions(user):
+    actions = QueuedAction.objects.filter(user=user).order_by('timestamp')
+    return [
         {
             'id': action.id,
             'action_type': action.action_type,
@@ -87,16 +486,20 @@ def get_user_actions(request):
         }
         for action in actions
     ]
-    return JsonResponse({'actions': action_list})
 
+@query_budget(6)
 @login_required
 def get_user_data(request):
+    return JsonResponse(_user_data(request.user))
+
+
+def _user_data(user):
     # Fetch the current game date
     game_date = GameDate.objects.first()
 
     # Fetch all actions
-    progress_actions = ProgressAction.objects.filter(user=request.user)
-    status_actions = StatusAction.objects.filter(user=request.user)
+    progress_actions = ProgressAction.objects.filter(user=user)
+    status_actions = StatusAction.objects.filter(user=user)
 
     # Organize actions into categories
     progress = []
@@ -108,7 +511,7 @@ def get_user_data(request):
         progress.append({
             'id': action.id,
             'action_type': action.action_type,
-            'action_data': action.details,
+            'action_data': {**action.details, 'turn': action.turn},
         })
 
     # Handle Status Actions
@@ -129,177 +532,37 @@ def get_user_data(request):
         else:
             completed.append(formatted_action)
 
-    # Return data as JSON
-    return JsonResponse({
+    stats = PlayerStats.for_user(user)
+
+    return {
         'current_date': game_date.current_date.strftime('%B %d, %Y'),
+        'money': user.profile.money,
+        'population': stats.population,
+        'holdings': stats.goods,
         'progress': progress,
         'failed': failed,
         'completed': completed,
-    })
+    }
 
 
 @staff_member_required
 def resolve_actions(request):
     if request.method == 'POST':
-        # Retrieve the game date
-        game_date = GameDate.objects.first()
-        if not game_date:
-            game_date = GameDate.objects.create()  # Initialize if missing
-
-        # Handle queued actions
-        actions = QueuedAction.objects.all()
-        print(f"Processing {actions.count()} actions...")
-        for action in actions:
-            print(f"Resolving action: {action.id}, Type: {action.action_type}")
-            if action.action_type == 'move_goods':
-                details = action.details
-                from_tile = Tile.objects.get(id=details['from']['tileId'])
-                good = details['good']
-                quantity = details['quantity']
-                cost = details['cost']
-                user = action.user
-
-                # Check conditions: enough goods and money
-                if from_tile.goods.get(good, 0) < quantity:
-                    StatusAction.objects.create(
-                        user=user,
-                        action_type='move_goods',
-                        details={**details, "status": {"error": "not enough goods", "tile": {"x": from_tile.x, "y": from_tile.y}}},
-                        completion_date=game_date.current_date
-                    )
-                    continue
-
-                if user.profile.money < cost:
-                    StatusAction.objects.create(
-                        user=user,
-                        action_type='move_goods',
-                        details={**details, "status": {"error": "not enough money", "tile": {"x": from_tile.x, "y": from_tile.y}}},
-                        completion_date=game_date.current_date
-                    )
-                    continue
-
-                # Deduct resources and money
-                from_tile.goods[good] -= quantity
-                from_tile.save()
-                user.profile.money -= cost
-                user.profile.save()
-
-                # Add action to ProgressAction
-                ProgressAction.objects.create(
-                    user=user,
-                    action_type='move_goods',
-                    details={**details, "turn": 0}  # Start with turn 0
-                )
-
-        # Clear processed queued actions
-        actions.delete()
-
-        # Handle progress actions
-        progress_actions = ProgressAction.objects.all()
-        print(f"Progressing {progress_actions.count()} actions...")
-
-        for progress in progress_actions:
-            print(f"Advancing action: {progress.id}, Type: {progress.action_type}")
-            details = progress.details
-            turn = details['turn']
-            path = details['path']
-            good = details['good']
-            quantity = details['quantity']
-            time = details['time']
-            user = progress.user
-            display_name = user.profile.display_name
-
-            # Get current and previous tiles
-            current_tile_data = path[turn]
-            current_tile = Tile.objects.get(id=current_tile_data['tileId'])
-
-            if turn > 0:  # Remove from previous tile's moving_goods
-                prev_tile_data = path[turn - 1]
-                prev_tile = Tile.objects.get(id=prev_tile_data['tileId'])
-
-                # Update moving_goods in the previous tile for the specific user
-                if prev_tile.moving_goods.get(display_name, {}).get(good, 0) < quantity:
-                    StatusAction.objects.create(
-                        user=user,
-                        action_type='move_goods',
-                        details={**details, "status": {"error": f"goods were lost", "tile": {"x": prev_tile.x, "y": prev_tile.y}}},
-                        completion_date=game_date.current_date
-                    )
-                    progress.delete()
-                    continue
-                else:
-                    prev_tile.moving_goods[display_name][good] = prev_tile.moving_goods.get(display_name, {}).get(good, 0) - quantity
-                    prev_tile.save()
-
-            # Add to current tile's moving_goods for the specific user
-            if display_name not in current_tile.moving_goods:
-                current_tile.moving_goods[display_name] = {}
-
-            current_tile.moving_goods[display_name][good] = current_tile.moving_goods[display_name].get(good, 0) + quantity
-            current_tile.save()
-
-            # Move forward
-            progress.details['turn'] += 1
-            progress.save()
-
-            # If action is complete
-            if progress.details['turn'] >= time:
-                # Transfer goods to destination
-                current_tile.goods[good] = current_tile.goods.get(good, 0) + quantity
-
-                # Remove from current tile's moving_goods
-                current_tile.moving_goods[display_name][good] -= quantity
-                if current_tile.moving_goods[display_name][good] <= 0:
-                    del current_tile.moving_goods[display_name][good]
-
-                current_tile.save()
-
-                # Mark as completed
-                StatusAction.objects.create(
-                    user=progress.user,
-                    action_type='move_goods',
-                    details={**details, "status": {"success": "goods moved successfully", "tile": {"x": current_tile.x, "y": current_tile.y}}},
-                    completion_date=game_date.current_date
-                )
-
-                # Remove completed progress action
-                progress.delete()
-
-        # Increment the date (simulate end turn)
-        game_date.current_date += timedelta(days=1)
-        game_date.save()
-
-        # Optionally, add logic here for logging out users except admins
-        if request.POST.get('end_turn', False):  # Check if it's the end turn action
-            log_out_users()
-
-        # Redirect back to admin
-        return redirect('admin:index')
+        # Queue the turn for the worker (manage.py resolve_turns), which also logs
+        # players out for the end turn action, and follow its progress in the admin
+        job = enqueue_turn(user=request.user, end_turn=bool(request.POST.get('end_turn', False)))
+        return redirect('admin:game_turnjob_change', job.id)
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
 def log_out_users():
     """
     Logs out all users except for staff/admin users.
-    """
-    users = User.objects.exclude(is_staff=True)  # Get all users except staff/admin
-    for user in users:
-        logout(user)
 
+    Starts a new session epoch; SessionEpochMiddleware ends older sessions of non-staff
+    users on their next request, so this is one query however many players there are.
+    """
+    SessionEpoch.bump()
 
-def get_terrain_and_tile_data(tiles):
-    """Fetch terrain and tile data for a batch of tiles."""
-    query = Tile.objects.filter(
-        x__in=[t[0] for t in tiles],
-        y__in=[t[1] for t in tiles]
-    )
-    terrain_data = {}
-    tile_mapping = {}
-
-    for tile in query:
-        terrain_data[(tile.x, tile.y)] = tile.terrain
-        tile_mapping[(tile.x, tile.y)] = tile.id
-
-    return terrain_data, tile_mapping
 
 def calculate_path(request):
     """API to calculate the path and return the intervals and cost."""
@@ -308,18 +571,84 @@ def calculate_path(request):
         goal = (int(request.GET['goal_x']), int(request.GET['goal_y']))
         speed = int(request.GET.get('speed', 4))
 
-        # Fetch all tiles within the bounding box of start and goal
-        min_x = min(start[0], goal[0]) - 1
-        max_x = max(start[0], goal[0]) + 1
-        min_y = min(start[1], goal[1]) - 1
-        max_y = max(start[1], goal[1]) + 1
+        # Perform pathfinding (cached per terrain version)
+        path, time = plan_path(start, goal, speed)
+        if not path:
+            return JsonResponse({'success': False, 'error': "No route to the destination tile"})
 
-        tiles = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
-        terrain_data, tile_mapping = get_terrain_and_tile_data(tiles)
+        return JsonResponse({'success': True, 'path': path, 'time': time})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
 
-        # Perform pathfinding
-        path, time = find_path(start, goal, terrain_data, tile_mapping, speed)
 
-        return JsonResponse({'success': True, 'path': path, 'time': time})
+def movement_range(request):
+    """
+    API returning every tile reachable from a source tile within max_turns.
+
+    Tiles are sent as compact [tileId, x, y, turns, cost, parentTileId] rows so the client
+    can colour the whole range and rebuild the route to any of them without another request.
+    """
+    try:
+        source = (int(request.GET['x']), int(request.GET['y']))
+        speed = int(request.GET.get('speed', 2))
+        max_turns = min(int(request.GET.get('max_turns', 10)), settings.MOVEMENT_RANGE_MAX_TURNS)
+
+        grid = get_terrain_grid()
+        reachable = reachable_tiles(source, grid, speed, max_turns)
+
+        tiles = [
+            [grid.tile_id_at(pos), pos[0], pos[1], turns, cost, grid.tile_id_at(parent)]
+            for pos, (turns, cost, parent) in reachable.items()
+        ]
+        return JsonResponse({
+            'success': True,
+            'origin': {'tileId': grid.tile_id_at(source), 'x': source[0], 'y': source[1]},
+            'speed': speed,
+            'fields': ['tileId', 'x', 'y', 'turns', 'cost', 'parent'],
+            'tiles': tiles,
+        })
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
+
+
+@login_required
+def calculate_route_matrix(request):
+    """
+    API to calculate travel times and costs from every source to every target.
+
+    Runs one Dijkstra per source; pairs with no route costing at most ROUTE_MATRIX_MAX_COST
+    are null. Staff can have large matrices spread over a process pool by passing
+    "parallel": true.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    try:
+        data = json.loads(request.body)
+        sources = [(int(tile['x']), int(tile['y'])) for tile in data['sources']]
+        targets = [(int(tile['x']), int(tile['y'])) for tile in data['targets']]
+        speed = int(data.get('speed', 2))
+
+        pairs = len(sources) * len(targets)
+        if pairs > settings.ROUTE_MATRIX_MAX_PAIRS:
+            return JsonResponse({'success': False, 'error': 'Too many routes requested'}, status=400)
+
+        # Starting a pool costs more than most matrices, and ties up that many cores
+        workers = None
+        if data.get('parallel') and request.user.is_staff and pairs >= settings.ROUTE_MATRIX_POOL_THRESHOLD:
+            workers = settings.ROUTE_MATRIX_WORKERS
+
+        rows = route_matrix(sources, targets, get_terrain_grid(), speed, workers, settings.ROUTE_MATRIX_MAX_COST)
+
+        return JsonResponse({
+            'success': True,
+            'times': [[row[target][0] if target in row else None for target in targets] for row in rows],
+            'costs': [[row[target][1] if target in row else None for target in targets] for row in rows],
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+
+@staff_member_required
+def path_cache_stats(request):
+    """Hit/miss/eviction counters of the path cache."""
+    return JsonResponse(path_cache.info())
@@ -3,41 +3,60 @@ document.addEventListener('DOMContentLoaded', function () {
     const mapElement = document.getElementById('map');
     const panzoom = Panzoom(mapElement, {
         maxScale: 5,
-        minScale: 0.5,
+        minScale: 0.05,
         contain: 'outside'
     });
     mapElement.addEventListener('wheel', panzoom.zoomWithWheel);
 
-    // Set up tiles for interaction
-    const tiles = document.querySelectorAll('.tile');
-    tiles.forEach(function (tile) {
-        tile.addEventListener('click', function () {
-            if (moveInProgress) {
-                event.stopPropagation(); // Prevent default click behavior
-                return;
-            }
-            const tileId = tile.getAttribute('data-id');
-            const x = tile.getAttribute('data-x');
-            const y = tile.getAttribute('data-y');
-            const buildings = tile.getAttribute('data-buildings');
-            const resources = tile.getAttribute('data-resources');
-            const ownerDisplayName = tile.getAttribute('data-display');
-            const population = tile.getAttribute('data-population');
-            const goods = tile.getAttribute('data-goods')
-            const moving_goods = tile.getAttribute('data-moving-goods')
-            showTileDetails(tileId, x, y, buildings, resources, goods, moving_goods, ownerDisplayName, population);
-        });
+    // Load what is in view now and whenever the map moves
+    mapElement.addEventListener('panzoomchange', scheduleMapUpdate);
+    window.addEventListener('resize', scheduleMapUpdate);
+    updateMapView();
+
+    // Pick up tiles changed by turns and other players, pushed when served over ASGI
+    mapVersion = parseInt(mapElement.dataset.version);
+    openEventStream();
+    setInterval(pollMapDelta, parseInt(mapElement.dataset.pollSeconds) * 1000);
+
+    // One set of listeners on the map handles every tile, loaded now or later
+    mapElement.addEventListener('click', function (event) {
+        const tile = event.target.closest('.tile');
+        if (!tile) return;
+        const tileId = tile.getAttribute('data-id');
+        const x = tile.getAttribute('data-x');
+        const y = tile.getAttribute('data-y');
+        if (moveInProgress) {
+            event.stopPropagation(); // Prevent default click behavior
+            selectMoveTo(tileId, x, y);
+            return;
+        }
+        const buildings = tile.getAttribute('data-buildings');
+        const resources = tile.getAttribute('data-resources');
+        const ownerDisplayName = tile.getAttribute('data-display');
+        const population = tile.getAttribute('data-population');
+        const goods = tile.getAttribute('data-goods')
+        const moving_goods = tile.getAttribute('data-moving-goods')
+        showTileDetails(tileId, x, y, buildings, resources, goods, moving_goods, ownerDisplayName, population);
     });
 
-    tiles.forEach(function (tile) {
-        const owner = tile.getAttribute('data-owner');
-        const ownerColor = tile.getAttribute('data-owner-color');
-        if (owner) {
-            tile.style.border = `2px solid ${hexToRgba(ownerColor, 0.3)}`;
-        } else {
-            tile.style.border = 'none';
+    mapElement.addEventListener('mousemove', function (event) {
+        const tile = event.target.closest('.tile');
+        if (!tile) {
+            hideTooltip();
+            return;
         }
+        showTooltip(
+            event,
+            tile.getAttribute('data-id'),
+            tile.getAttribute('data-x'),
+            tile.getAttribute('data-y'),
+            tile.getAttribute('data-buildings'),
+            tile.getAttribute('data-resources'),
+            tile.getAttribute('data-display'),
+            tile.getAttribute('data-population')
+        );
     });
+    mapElement.addEventListener('mouseleave', hideTooltip);
 
     // Initialize default Tile tab behavior
     selectTab('details');
@@ -52,6 +71,274 @@ document.addEventListener('DOMContentLoaded', function () {
     loadUserData()
 });
 
+// MAP CHUNKS
+const TILE_PITCH = 105; // Tile size plus grid gap, in px
+const loadedChunks = new Set(); // "cx,cy" of chunks requested so far
+const deltaTiles = new Set(); // Ids of tiles added by map deltas, a chunk still loading may bring them again
+const loadedImages = new Set(); // "ix,iy" of map images shown at imageZoom
+let imageZoom = null;
+let mapTimer = null;
+let selectedOwner = null; // Owner highlighted by the last tile selection
+let mapVersion = 0; // Map version the loaded tiles are at
+let eventStream = null; // EventSource for /events/
+
+function scheduleMapUpdate() {
+    clearTimeout(mapTimer);
+    mapTimer = setTimeout(updateMapView, 100);
+}
+
+// Part of the map in view, in tile columns/rows from the map's top left corner
+function visibleArea() {
+    const mapElement = document.getElementById('map');
+    const width = parseInt(mapElement.dataset.width);
+    const height = parseInt(mapElement.dataset.height);
+    const view = mapElement.parentElement.getBoundingClientRect();
+    const rect = mapElement.getBoundingClientRect();
+    const scale = rect.width / mapElement.offsetWidth || 1;
+    const clamp = (value, max) => Math.min(Math.max(value, 0), max - 1);
+    return {
+        minX: parseInt(mapElement.dataset.minX),
+        minY: parseInt(mapElement.dataset.minY),
+        scale: scale,
+        firstCol: clamp(Math.floor((view.left - rect.left) / scale / TILE_PITCH) - 1, width),
+        lastCol: clamp(Math.floor((view.right - rect.left) / scale / TILE_PITCH) + 1, width),
+        firstRow: clamp(Math.floor((view.top - rect.top) / scale / TILE_PITCH) - 1, height),
+        lastRow: clamp(Math.floor((view.bottom - rect.top) / scale / TILE_PITCH) + 1, height),
+    };
+}
+
+// Interactive tiles when zoomed in, server rendered images when zoomed out
+function updateMapView() {
+    const mapElement = document.getElementById('map');
+    if (parseInt(mapElement.dataset.width) <= 0 || parseInt(mapElement.dataset.height) <= 0) return;
+    const area = visibleArea();
+    const zoomedOut = area.scale < parseFloat(mapElement.dataset.interactiveScale);
+    mapElement.classList.toggle('zoomed-out', zoomedOut);
+    if (zoomedOut) {
+        loadVisibleImages(area);
+    } else {
+        loadVisibleChunks(area);
+    }
+}
+
+// Key in loadedChunks of the chunk holding map position (x, y)
+function chunkKey(x, y) {
+    const size = parseInt(document.getElementById('map').dataset.chunkSize);
+    return `${Math.floor(x / size)},${Math.floor(y / size)}`;
+}
+
+// Fetch the chunks intersecting the visible part of the map that are not loaded yet
+function loadVisibleChunks(area) {
+    const mapElement = document.getElementById('map');
+    const size = parseInt(mapElement.dataset.chunkSize);
+    const perRequest = parseInt(mapElement.dataset.chunksPerRequest);
+
+    const missing = [];
+    for (let cy = Math.floor((area.minY + area.firstRow) / size); cy <= Math.floor((area.minY + area.lastRow) / size); cy++) {
+        for (let cx = Math.floor((area.minX + area.firstCol) / size); cx <= Math.floor((area.minX + area.lastCol) / size); cx++) {
+            const key = `${cx},${cy}`;
+            if (!loadedChunks.has(key)) {
+                loadedChunks.add(key);
+                missing.push(key);
+            }
+        }
+    }
+    for (let i = 0; i < missing.length; i += perRequest) {
+        loadChunks(missing.slice(i, i + perRequest));
+    }
+}
+
+// Show the map images covering the visible part of the map, at the zoom level closest
+// to the current scale
+function loadVisibleImages(area) {
+    const mapElement = document.getElementById('map');
+    const layer = document.getElementById('map-images');
+    const imageSize = parseInt(mapElement.dataset.imageSize);
+    const zooms = parseInt(mapElement.dataset.imageZooms);
+    const zoom = Math.min(Math.max(Math.ceil(Math.log2(TILE_PITCH * area.scale)), 0), zooms - 1);
+    const span = imageSize >> zoom; // Map tiles per image side
+
+    if (zoom !== imageZoom) {
+        clearMapImages();
+        imageZoom = zoom;
+    }
+
+    for (let iy = Math.floor((area.minY + area.firstRow) / span); iy <= Math.floor((area.minY + area.lastRow) / span); iy++) {
+        for (let ix = Math.floor((area.minX + area.firstCol) / span); ix <= Math.floor((area.minX + area.lastCol) / span); ix++) {
+            const key = `${ix},${iy}`;
+            if (loadedImages.has(key)) continue;
+            loadedImages.add(key);
+            const image = document.createElement('img');
+            image.className = 'map-image';
+            image.src = `/map_image/${zoom}/${ix}/${iy}.png`;
+            image.style.left = `${(ix * span - area.minX) * TILE_PITCH}px`;
+            image.style.top = `${(iy * span - area.minY) * TILE_PITCH}px`;
+            image.style.width = `${span * TILE_PITCH}px`;
+            image.style.height = `${span * TILE_PITCH}px`;
+            layer.appendChild(image);
+        }
+    }
+}
+
+// Listen for map, turn and action updates; the server closes the stream with 204 when it can't push
+function openEventStream() {
+    eventStream = new EventSource(`/events/?since=${mapVersion}`);
+    eventStream.addEventListener('map', event => applyMapDelta(JSON.parse(event.data)));
+    eventStream.addEventListener('turn', event => {
+        document.getElementById('current-date').textContent = JSON.parse(event.data).current_date;
+    });
+    eventStream.addEventListener('actions', event => {
+        const data = JSON.parse(event.data);
+        renderUserData(data);
+        renderQueuedActions(data.queued);
+    });
+}
+
+// Fetch the tiles changed since mapVersion and swap them in; 304 when nothing changed
+function pollMapDelta() {
+    if (eventStream && eventStream.readyState === EventSource.OPEN) return; // Pushed instead
+    fetch(`/map_delta/?since=${mapVersion}`, { headers: { 'If-None-Match': `"map-${mapVersion}"` } })
+        .then(response => {
+            if (response.status === 304) return null;
+            return response.json();
+        })
+        .then(data => {
+            if (data) applyMapDelta(data);
+        })
+        .catch(error => console.error('Error loading map changes:', error));
+}
+
+function applyMapDelta(data) {
+    if (!data.success) {
+        console.error('Error loading map changes:', data.error);
+        return;
+    }
+    if (data.version <= mapVersion && !data.full) return; // Already applied
+    if (data.full) {
+        reloadMap();
+    } else {
+        const mapElement = document.getElementById('map');
+        data.tiles.forEach(tile => {
+            const current = document.querySelector(`.tile[data-id="${tile.id}"]`);
+            if (!loadedChunks.has(chunkKey(tile.x, tile.y))) {
+                // Moved out of the loaded chunks, it comes with its chunk when in view
+                if (current) current.remove();
+                return;
+            }
+            const updated = renderTile(tile);
+            if (current) {
+                updated.className = current.className; // Keep move highlights
+                current.replaceWith(updated);
+            } else {
+                // New in a chunk already loaded
+                mapElement.appendChild(updated);
+                deltaTiles.add(String(tile.id));
+            }
+        });
+        data.deleted.forEach(tileId => {
+            const current = document.querySelector(`.tile[data-id="${tileId}"]`);
+            if (current) current.remove();
+        });
+        if (data.tiles.length || data.deleted.length) {
+            clearMapImages();
+        }
+    }
+    mapVersion = data.version;
+    updateMapView();
+}
+
+// Drop every loaded tile and image and load the view again
+function reloadMap() {
+    document.querySelectorAll('#map .tile').forEach(tile => tile.remove());
+    loadedChunks.clear();
+    deltaTiles.clear();
+    clearMapImages();
+}
+
+function clearMapImages() {
+    document.getElementById('map-images').innerHTML = '';
+    loadedImages.clear();
+    imageZoom = null;
+}
+
+function loadChunks(keys) {
+    return fetch(`/map_chunks/?chunks=${keys.join(';')}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            const mapElement = document.getElementById('map');
+            const fragment = document.createDocumentFragment();
+            data.chunks.forEach(chunk => chunk.tiles.forEach(tile => {
+                if (deltaTiles.delete(String(tile.id))) {
+                    const current = document.querySelector(`.tile[data-id="${tile.id}"]`);
+                    if (current) current.remove();
+                }
+                fragment.appendChild(renderTile(tile));
+            }));
+            mapElement.appendChild(fragment);
+        })
+        .catch(error => {
+            // Allow another attempt on the next pan
+            keys.forEach(key => loadedChunks.delete(key));
+            console.error('Error loading map chunks:', error);
+        });
+}
+
+// Build the element of one tile from its chunk data
+function renderTile(tile) {
+    const mapElement = document.getElementById('map');
+    const element = document.createElement('div');
+    element.className = 'tile';
+    element.dataset.id = tile.id;
+    element.dataset.x = tile.x;
+    element.dataset.y = tile.y;
+    element.dataset.buildings = tile.buildings;
+    element.dataset.resources = tile.resources;
+    element.dataset.population = tile.population;
+    element.dataset.goods = JSON.stringify(tile.goods);
+    element.dataset.movingGoods = JSON.stringify(tile.movingGoods);
+    element.dataset.owner = tile.owner === null ? '' : tile.owner;
+    element.dataset.display = tile.display;
+    element.dataset.ownerColor = tile.ownerColor;
+    element.style.gridColumn = tile.x - parseInt(mapElement.dataset.minX) + 1;
+    element.style.gridRow = tile.y - parseInt(mapElement.dataset.minY) + 1;
+    element.style.backgroundColor = tile.color;
+
+    if (tile.image) {
+        const image = document.createElement('img');
+        image.src = tile.image;
+        image.alt = 'Tile Image';
+        image.style.width = '100%';
+        image.style.height = '100%';
+        element.appendChild(image);
+    } else {
+        const label = document.createElement('p');
+        label.textContent = `${tile.x}, ${tile.y}`;
+        element.appendChild(label);
+    }
+
+    applyOwnerBorder(element);
+    if (movementRange && movementRange.has(String(tile.id))) {
+        element.classList.add('highlight-range');
+    }
+    return element;
+}
+
+// Faint border in the owner's colour, solid for the owner of the selected tile
+function applyOwnerBorder(tile) {
+    const owner = tile.getAttribute('data-owner');
+    const ownerColor = tile.getAttribute('data-owner-color');
+    if (!owner) {
+        tile.style.border = 'none';
+    } else if (owner === selectedOwner) {
+        tile.style.border = `2px solid ${ownerColor}`;
+    } else {
+        tile.style.border = `2px solid ${hexToRgba(ownerColor, 0.3)}`;
+    }
+}
+
 // HELPER FUNCTIONS
 // Converts a hex color to rgba format with adjustable transparency (alpha).
 function hexToRgba(hex, alpha) {
@@ -113,33 +400,16 @@ function showTileDetails(tileId, x, y, buildings, resources, goods, moving_goods
         <p><strong>Owner:</strong> ${ownerDisplayName || 'None'}</p>
     `;
 
-    const tiles = document.querySelectorAll('.tile');
-    tiles.forEach(function (tile) {
-        const owner = tile.getAttribute('data-owner');
-        const ownerColor = tile.getAttribute('data-owner-color');
-        if (owner) {
-            tile.style.border = `2px solid ${hexToRgba(ownerColor, 0.3)}`;
-        }
-    });
-
-    const selectedTile = document.querySelector(`[data-id="${tileId}"]`);
-    const selectedOwner = selectedTile.getAttribute('data-owner');
-    if (selectedOwner !== "None") {
-        tiles.forEach(function (tile) {
-            const owner = tile.getAttribute('data-owner');
-            if (owner && owner === selectedOwner) {
-                const ownerColor = tile.getAttribute('data-owner-color');
-                tile.style.border = `2px solid ${ownerColor}`;
-            }
-        });
-    }
+    // Highlight every loaded tile of the selected tile's owner
+    const selectedTile = document.querySelector(`.tile[data-id="${tileId}"]`);
+    selectedOwner = selectedTile.getAttribute('data-owner') || null;
+    document.querySelectorAll('.tile').forEach(applyOwnerBorder);
 
     showGoodsTab(goods, moving_goods, tileId, x, y); // Populate the Goods tab with current tile's goods
 }
 
 function showGoodsTab(goods, moving_goods, tileId, x, y) {
     const goodsList = document.getElementById('goods-tab');
-    goods = goods.replace(/'/g, '"'); // Replace single quotes with double quotes for proper JSON parsing
 
     // Clear existing goods display
     goodsList.innerHTML = '';
@@ -156,7 +426,6 @@ function showGoodsTab(goods, moving_goods, tileId, x, y) {
     const hasValidGoods = Object.entries(goods).some(([_, quantity]) => quantity > 0);
 
     // Parse moving_goods if present
-    moving_goods = moving_goods.replace(/'/g, '"');
     let movingGoods = {};
     try {
         movingGoods = JSON.parse(moving_goods);
@@ -257,18 +526,32 @@ function toggleSection(sectionId) {
 function loadUserData() {
     fetch('/get_user_data/')
         .then(response => response.json())
-        .then(data => {
-            // Display current date
-            document.getElementById('current-date').textContent = data.current_date;
-
-            // Render categorized actions
-            renderActions('in-progress-list', data.progress, renderProgressActionTemplate);
-            renderActions('failed-list', data.failed, renderStatusActionTemplate);
-            renderActions('completed-list', data.completed, renderStatusActionTemplate);
-        })
+        .then(renderUserData)
         .catch(error => console.error('Error loading user data:', error));
 }
 
+function renderUserData(data) {
+    // Display current date
+    document.getElementById('current-date').textContent = data.current_date;
+
+    // Money, population and holdings change as turns resolve
+    document.getElementById('user-money').textContent = data.money;
+    document.getElementById('user-population').textContent = data.population;
+    const holdings = document.getElementById('user-holdings');
+    const goods = Object.keys(data.holdings).sort();
+    holdings.innerHTML = goods.length ? '' : '<li>No goods</li>';
+    goods.forEach(good => {
+        const item = document.createElement('li');
+        item.textContent = `${good}: ${data.holdings[good]}`;
+        holdings.appendChild(item);
+    });
+
+    // Render categorized actions
+    renderActions('in-progress-list', data.progress, renderProgressActionTemplate);
+    renderActions('failed-list', data.failed, renderStatusActionTemplate);
+    renderActions('completed-list', data.completed, renderStatusActionTemplate);
+}
+
 // Render list of actions
 function renderActions(listId, actions, renderTemplate) {
     const list = document.getElementById(listId);
@@ -328,6 +611,7 @@ let moveInProgress = false; // Flag to check if a move is in progress
 let path=[];
 let time = 0;
 let cost = 0;
+let movementRange = null; // Reachable tiles of the current move, keyed by tileId
 
 // Function to initiate the move
 function initiateMove(good, maxQuantity, tileId, x, y) {
@@ -363,16 +647,17 @@ function selectMoveFrom(good, tileId) {
         currentTile.classList.add('highlight-blue');
     }
 
-    const tiles = document.querySelectorAll('.tile');
-    tiles.forEach(tile => {
-        tile.onclick = function (event) {
-            event.stopPropagation(); // Prevent default event bubbling
-            const tileId = tile.getAttribute('data-id');
-            const x = tile.getAttribute('data-x');
-            const y = tile.getAttribute('data-y');
-            selectMoveTo(tileId, x, y);
-        };
-    });
+    // Load and shade every tile reachable from the origin
+    loadMovementRange(moveFromTile.x, moveFromTile.y).then(range => {
+        movementRange = range;
+        range.forEach((entry, rangeTileId) => {
+            const rangeTile = document.querySelector(`.tile[data-id='${rangeTileId}']`);
+            if (rangeTile) {
+                rangeTile.classList.add('highlight-range');
+            }
+        });
+    }).catch(error => console.error('Error loading movement range:', error));
+    // Clicks on tiles now pick the destination, see the map click listener
 }
 
 // Function to handle selecting the destination tile
@@ -385,8 +670,10 @@ function selectMoveTo(tileId, x, y) {
     const quantity = document.getElementById('move-quantity');
     quantity.addEventListener('input', updateMoveCost);
 
-    // Calculate path
-    calculatePath(moveFromTile.x, moveFromTile.y, x, y).then(result => {
+    // Use the movement range when possible, otherwise ask the server for the path
+    const localRoute = routeFromRange(tileId);
+    const route = localRoute ? Promise.resolve(localRoute) : calculatePath(moveFromTile.x, moveFromTile.y, x, y);
+    route.then(result => {
         if (result) {
             path = result.path;
             time = result.time;
@@ -455,30 +742,33 @@ function confirmMove() {
         return;
     }
 
-    fetch('/queue_action/', {
+    // The server plans the route and cost again, those shown here are a preview
+    fetch('/queue_actions/', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': getCookie('csrftoken'),
+        },
         body: JSON.stringify({
-            action_type: 'move_goods',
-            details: {
+            actions: [{
+                action_type: 'move_goods',
                 good: moveGood.good,
                 quantity: parseInt(quantity),
-                from: moveFromTile,
-                to: moveToTile,
-                path: path,
-                time: time,
-                cost: cost,
-            },
+                from: moveFromTile.tileId,
+                to: moveToTile.tileId,
+            }],
         }),
-    }).then(response => {
-        if (response.ok) {
+    }).then(response => response.json().then(data => {
+        if (data.success) {
             alert('Action queued successfully!');
             resetMoveState();
             loadUserActions()
         } else {
-            alert('Failed to queue action. Please try again.');
+            // One move is posted, so its error is the only one
+            const errors = Object.values(data.errors || {});
+            alert(`Failed to queue action: ${errors.length ? errors.join(' ') : data.error || 'please try again.'}`);
         }
-    }).catch(error => {
+    })).catch(error => {
         console.error('Error:', error);
         alert('An error occurred. Please try again.');
     });
@@ -490,13 +780,10 @@ function resetMoveState() {
 
     // Remove highlights
     document.querySelectorAll('.tile').forEach(tile => {
-        tile.classList.remove('highlight-blue', 'highlight-red', 'highlight-white');
+        tile.classList.remove('highlight-blue', 'highlight-red', 'highlight-white', 'highlight-range');
 
         const span = tile.querySelector('span');
         if (span) span.remove(); // Remove old numbers
-
-        // Remove custom JavaScript onclick handler
-        tile.onclick = null;
     });
 
     // Re-enable all Move buttons
@@ -514,29 +801,32 @@ function resetMoveState() {
     // Clear state variables
     moveFromTile = null;
     moveToTile = null;
+    movementRange = null;
 }
 
 // ACTION LOGIC
 function loadUserActions() {
     fetch('/get_user_actions/')
         .then(response => response.json())
-        .then(data => {
-            const actionList = document.getElementById('action-list');
-            actionList.innerHTML = '';
-
-            if (data.actions.length === 0) {
-                actionList.innerHTML = '<li>No actions</li>';
-            } else {
-                data.actions.forEach(action => {
-                    const actionItem = document.createElement('li');
-                    actionItem.innerHTML = renderActionTemplate(action);
-                    actionList.appendChild(actionItem);
-                });
-            }
-        })
+        .then(data => renderQueuedActions(data.actions))
         .catch(error => console.error('Error loading user actions:', error));
 }
 
+function renderQueuedActions(actions) {
+    const actionList = document.getElementById('action-list');
+    actionList.innerHTML = '';
+
+    if (actions.length === 0) {
+        actionList.innerHTML = '<li>No actions</li>';
+    } else {
+        actions.forEach(action => {
+            const actionItem = document.createElement('li');
+            actionItem.innerHTML = renderActionTemplate(action);
+            actionList.appendChild(actionItem);
+        });
+    }
+}
+
 function renderActionTemplate(action) {
     const { id, action_type, action_data } = action;
 
@@ -612,7 +902,7 @@ function removeAction(actionId) {
 }
 
 
-// Tooltip handlers
+// Tooltip handlers, called from the map's mousemove listener
 function showTooltip(event, tileId, x, y, buildings, resources, display, population) {
     const tooltip = document.getElementById("tooltip");
     tooltip.style.display = 'block';
@@ -653,6 +943,57 @@ function calculatePath(startX, startY, goalX, goalY, speed = 2) {
     });
 }
 
+// Fetch every tile reachable from (x, y) in one request
+function loadMovementRange(x, y, speed = 2) {
+    return fetch(`/movement_range/?x=${x}&y=${y}&speed=${speed}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            // Rows are [tileId, x, y, turns, cost, parentTileId]
+            const range = new Map();
+            data.tiles.forEach(row => range.set(String(row[0]), row));
+            return range;
+        });
+}
+
+// Build the per-turn path to a tile of the movement range, same intervals as the server
+function routeFromRange(tileId, speed = 2) {
+    if (!movementRange || !movementRange.has(String(tileId))) {
+        return null;
+    }
+
+    // Follow parents back to the origin (which is not part of the range)
+    const cells = [];
+    let entry = movementRange.get(String(tileId));
+    while (entry) {
+        cells.push(entry);
+        entry = movementRange.get(String(entry[5]));
+    }
+    cells.reverse();
+
+    const routePath = [];
+    let moved = 0;
+    let previousCost = 0;
+    cells.forEach(cell => {
+        moved += cell[4] - previousCost;
+        previousCost = cell[4];
+        if (moved >= speed) {
+            routePath.push({ tileId: cell[0], x: cell[1], y: cell[2] });
+            moved = 0;
+        }
+    });
+
+    // Ensure the goal is always included
+    const goal = cells[cells.length - 1];
+    if (routePath.length === 0 || routePath[routePath.length - 1].tileId !== goal[0]) {
+        routePath.push({ tileId: goal[0], x: goal[1], y: goal[2] });
+    }
+
+    return { path: routePath, time: goal[3] };
+}
+
 // Function to update the move cost when the quantity input changes
 function updateMoveCost() {
     const quantity = document.getElementById('move-quantity').value || 0;
@@ -42,11 +42,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'game.instrumentation.QueryInstrumentationMiddleware',  # First, to count every query
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'game.sessions.SessionEpochMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -136,6 +138,99 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 LOGIN_REDIRECT_URL = '/map/'
 
+# Number of routes kept in the in-process path cache
+PATH_CACHE_SIZE = 1024
+
+# Routes longer than this (in tiles) use hierarchical pathfinding over clusters of this size
+HIERARCHICAL_PATH_DISTANCE = 64
+HPA_CLUSTER_SIZE = 16
+
+# Upper bound on the turns a movement range request may ask for
+MOVEMENT_RANGE_MAX_TURNS = 30
+
+# Route matrix limits: routes costing more than ROUTE_MATRIX_MAX_COST movement points are
+# reported unreachable; with "parallel" requested by staff, matrices of at least
+# ROUTE_MATRIX_POOL_THRESHOLD routes are computed by ROUTE_MATRIX_WORKERS processes
+ROUTE_MATRIX_MAX_PAIRS = 10000
+ROUTE_MATRIX_MAX_COST = 400
+ROUTE_MATRIX_POOL_THRESHOLD = 400
+ROUTE_MATRIX_WORKERS = 4
+
+# The map page loads tiles in MAP_CHUNK_SIZE x MAP_CHUNK_SIZE chunks,
+# at most MAP_CHUNKS_PER_REQUEST per request
+MAP_CHUNK_SIZE = 16
+MAP_CHUNKS_PER_REQUEST = 16
+
+# Zoomed out below MAP_INTERACTIVE_SCALE the map shows MAP_IMAGE_SIZE px images,
+# rendered at MAP_IMAGE_ZOOMS levels (1, 2, 4, ... px per tile) under MEDIA_ROOT/map_tiles
+MAP_IMAGE_SIZE = 256
+MAP_IMAGE_ZOOMS = 5
+MAP_INTERACTIVE_SCALE = 0.4
+
+# Map delta feed: versions kept for clients catching up, the most tiles sent as a delta
+# (further behind clients reload) and how often the map page polls
+MAP_VERSIONS_KEPT = 1000
+MAP_DELTA_MAX_TILES = 5000
+MAP_POLL_SECONDS = 15
+
+# /events/ streams check for turns resolved by other processes this often (seconds) and
+# end after EVENTS_STREAM_SECONDS, the browser then reconnects
+EVENTS_POLL_SECONDS = 5
+EVENTS_STREAM_SECONDS = 300
+
+# Turn resolution: with TURN_RESOLUTION_WORKERS > 0 shipments are advanced per
+# TURN_REGION_SIZE x TURN_REGION_SIZE region in that many processes; 0 resolves serially
+TURN_RESOLUTION_WORKERS = 0
+TURN_REGION_SIZE = 32
+
+# Turn jobs: the worker writes a running job's progress under TURN_JOB_PROGRESS_DIR,
+# which the web processes must be able to read, and a running job whose progress has
+# not been written for TURN_JOB_STALE_SECONDS is taken to have lost its worker
+TURN_JOB_PROGRESS_DIR = BASE_DIR / 'turn_jobs'
+TURN_JOB_STALE_SECONDS = 60
+
+# Per-request SQL instrumentation: query counts and time as response headers,
+# requests spending at least QUERY_SLOW_REQUEST_SECONDS in SQL logged with their
+# QUERY_SLOWEST_KEPT slowest statements, and @query_budget breaches raised instead of
+# logged when QUERY_BUDGET_RAISE is set (the test runner and the benchmark set it)
+QUERY_INSTRUMENTATION_HEADERS = DEBUG
+QUERY_SLOW_REQUEST_SECONDS = 0.5
+QUERY_SLOWEST_KEPT = 5
+QUERY_BUDGET_RAISE = False
+
+TEST_RUNNER = 'game.testing.TestRunner'
+
+# End-of-turn logout: seconds each process may keep using the session epoch it read, so
+# players are logged out at most this long after the turn ends
+SESSION_EPOCH_CACHE_SECONDS = 5
+
+# Ownership index: seconds a process may answer from its cached copy of a player's
+# tiles (changes in other processes show up after this unless the cache is shared), and
+# the most tiles one check_ownership request may ask about
+OWNERSHIP_CACHE_SECONDS = 300
+OWNERSHIP_CHECK_MAX_TILES = 10000
+
+# The in-process cache holds an ownership index per active player besides the session
+# epoch; Django's default of 300 entries would keep evicting them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# queue_actions: goods move MOVE_GOODS_SPEED movement points a turn, as the map page
+# plans them, and one request queues at most QUEUE_ACTIONS_MAX actions
+MOVE_GOODS_SPEED = 2
+QUEUE_ACTIONS_MAX = 100
+
+# Benchmark: results are compared with BENCHMARK_BASELINE and fail when a scenario is
+# more than BENCHMARK_THRESHOLD (a fraction) slower or runs that much more queries.
+# Record the baseline with `manage.py benchmark --save-baseline` (same world options as
+# the runs compared with it); `--require-baseline` makes a missing file an error
+BENCHMARK_BASELINE = BASE_DIR / 'benchmark_baseline.json'
+BENCHMARK_THRESHOLD = 0.25
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -15,12 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.conf.urls.static import static
 from django.conf import settings
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from game.views import map_view, queue_action, resolve_actions, check_ownership, get_user_actions, remove_action, calculate_path, get_user_data
+from game.views import map_view, queue_action, queue_actions, resolve_actions, check_ownership, get_user_actions, remove_action, calculate_path, get_user_data, path_cache_stats, movement_range, calculate_route_matrix, map_chunks, map_snapshot, map_image, map_delta, events, economy_totals, economy_goods
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -28,12 +28,23 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(next_page='/'), name='logout'),
     path('map/', map_view, name='map'),  # Map view
     path('queue_action/', queue_action, name='queue_action'),
+    path('queue_actions/', queue_actions, name='queue_actions'),
     path('resolve_actions/', resolve_actions, name='resolve_actions'),
     path('check_ownership/', check_ownership, name='check_ownership'),
     path('get_user_actions/', get_user_actions, name='get_user_actions'),
     path('remove_action/<int:action_id>/', remove_action, name='remove_action'),
     path('calculate_path/', calculate_path, name='calculate_path'),
     path('get_user_data/', get_user_data, name='get_user_data'),
+    path('path_cache_stats/', path_cache_stats, name='path_cache_stats'),
+    path('movement_range/', movement_range, name='movement_range'),
+    path('route_matrix/', calculate_route_matrix, name='route_matrix'),
+    path('map_chunks/', map_chunks, name='map_chunks'),
+    path('map_snapshot/', map_snapshot, name='map_snapshot'),
+    path('map_delta/', map_delta, name='map_delta'),
+    path('events/', events, name='events'),
+    path('economy/totals/', economy_totals, name='economy_totals'),
+    path('economy/goods/', economy_goods, name='economy_goods'),
+    re_path(r'^map_image/(?P<zoom>\d+)/(?P<ix>-?\d+)/(?P<iy>-?\d+)\.png$', map_image, name='map_image'),
 ]
 
 if settings.DEBUG: